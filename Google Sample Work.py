@@ -1,13 +1,378 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+# In[ ]:
+
+
+"""Counters and latency histograms for the commands, and timers for the
+phases inside them. Everything is off until enabled, and then costs one
+attribute check per call."""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets in seconds: 1us, 2us, 4us ... ~17min.
+_BUCKETS = tuple(1e-6 * 2 ** i for i in range(31))
+
+
+class Histogram:
+    """Counts latencies in buckets that double in size, so recording one is
+    cheap and the memory used never grows."""
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, fraction: float) -> float:
+        """The upper bound of the bucket the percentile falls in, so it is
+        at most twice the real value."""
+        if not self.count:
+            return 0.0
+        rank = max(1, round(self.count * fraction))
+        seen = 0
+        for bound, count in zip(_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class _CommandStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}
+        self.latency = Histogram()
+
+
+class _NoTimer:
+    """What phase() hands out while the metrics are off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class _PhaseTimer:
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.record_phase(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class Metrics:
+    """Per command call counts, error counts by error type and latencies,
+    and latencies of the named phases inside commands (sorting, filtering,
+    rendering...).
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._phases = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+            self._phases = {}
+
+    def phase(self, name: str):
+        """A context manager timing the code inside it as phase `name`."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _PhaseTimer(self, name)
+
+    def record_phase(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self._phases.get(name)
+            if histogram is None:
+                histogram = self._phases[name] = Histogram()
+            histogram.observe(seconds)
+
+    def record_command(self, name: str, seconds: float, errors=()):
+        """Counts one call of command `name`. `errors` are the names of the
+        error types it reported, if any."""
+        with self._lock:
+            stats = self._commands.get(name)
+            if stats is None:
+                stats = self._commands[name] = _CommandStats()
+            stats.calls += 1
+            stats.latency.observe(seconds)
+            for error in errors:
+                stats.errors[error] = stats.errors.get(error, 0) + 1
+
+    def time_command(self, name: str, function, *args):
+        """Calls function(*args) and records it as a call of command `name`.
+        The player catches most errors and reports them in the outputs of
+        the CommandResult instead of raising them, so those are counted
+        from there."""
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except Exception as e:
+            self.record_command(name, time.perf_counter() - start, (type(e).__name__,))
+            raise
+        outputs = getattr(result, "outputs", ())
+        self.record_command(name, time.perf_counter() - start,
+                            [output.error for output in outputs if output.error])
+        return result
+
+    def report(self) -> str:
+        """The metrics as a table for people."""
+        with self._lock:
+            commands = sorted(self._commands.items())
+            phases = sorted(self._phases.items())
+        if not commands and not phases:
+            state = "on" if self.enabled else "off, use STATS ON to turn it on"
+            return f"No stats recorded yet (instrumentation is {state})."
+
+        lines = [f"{'COMMAND':<24}{'CALLS':>8}{'ERRORS':>8}"
+                 f"{'AVG ms':>10}{'P50 ms':>10}{'P99 ms':>10}"]
+        for name, stats in commands:
+            lines.append(_row(name, stats.calls, sum(stats.errors.values()),
+                              stats.latency))
+            for error, count in sorted(stats.errors.items()):
+                lines.append(f"  {error}: {count}")
+        if phases:
+            lines.append("")
+            lines.append(f"{'PHASE':<24}{'CALLS':>8}{'':>8}"
+                         f"{'AVG ms':>10}{'P50 ms':>10}{'P99 ms':>10}")
+            for name, histogram in phases:
+                lines.append(_row(name, histogram.count, None, histogram))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Writes the metrics to `path` in the Prometheus text format, so
+        they can be collected or compared between runs."""
+        with self._lock:
+            commands = sorted(self._commands.items())
+            phases = sorted(self._phases.items())
+
+        lines = ["# TYPE videoplayer_command_calls_total counter"]
+        lines.extend(f'videoplayer_command_calls_total{{command="{name}"}} {stats.calls}'
+                     for name, stats in commands)
+        lines.append("# TYPE videoplayer_command_errors_total counter")
+        for name, stats in commands:
+            lines.extend(
+                f'videoplayer_command_errors_total{{command="{name}",error="{error}"}} {count}'
+                for error, count in sorted(stats.errors.items()))
+        lines.append("# TYPE videoplayer_command_seconds histogram")
+        for name, stats in commands:
+            lines.extend(_histogram_lines("videoplayer_command_seconds",
+                                          f'command="{name}"', stats.latency))
+        lines.append("# TYPE videoplayer_phase_seconds histogram")
+        for name, histogram in phases:
+            lines.extend(_histogram_lines("videoplayer_phase_seconds",
+                                          f'phase="{name}"', histogram))
+
+        with open(path, "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+
+
+def _row(name, calls, errors, histogram):
+    average = histogram.total / histogram.count * 1000 if histogram.count else 0.0
+    errors = "" if errors is None else errors
+    return (f"{name:<24}{calls:>8}{errors:>8}{average:>10.3f}"
+            f"{histogram.percentile(0.50) * 1000:>10.3f}"
+            f"{histogram.percentile(0.99) * 1000:>10.3f}")
+
+
+def _histogram_lines(metric, labels, histogram):
+    seen = 0
+    for bound, count in zip(_BUCKETS, histogram.counts):
+        seen += count
+        yield f'{metric}_bucket{{{labels},le="{bound:g}"}} {seen}'
+    yield f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}'
+    yield f"{metric}_sum{{{labels}}} {histogram.total}"
+    yield f"{metric}_count{{{labels}}} {histogram.count}"
+
+
+# The metrics everything records into. Set VIDEOPLAYER_METRICS=1 to have
+# them on from the start.
+METRICS = Metrics(enabled=os.environ.get("VIDEOPLAYER_METRICS", "") not in ("", "0"))
+
+
+# In[ ]:
+
+
+"""On-demand profiling of the commands, and a report of where the memory
+goes."""
+
+import atexit
+import cProfile
+import gc
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+import types
+from pathlib import Path
+
+
+class CommandProfiler:
+    """Profiles the commands while it is on, with one cProfile profile per
+    command name so that a few slow searches are not lost among thousands
+    of fast PLAYs. Stopping writes every profile to
+    <directory>/<COMMAND>.pstats, to be read with pstats or snakeviz.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.directory = None
+        self._profiles = {}
+        self._calls = {}
+        # A thread can only run one profile at a time, and a profile can
+        # only be in one thread, so profiled commands take turns.
+        self._lock = threading.Lock()
+
+    def start(self, directory="profiles"):
+        with self._lock:
+            self.directory = Path(directory)
+            self._profiles = {}
+            self._calls = {}
+            self.active = True
+
+    def profile_command(self, name: str, function, *args):
+        """Calls function(*args) under the profile of command `name`."""
+        with self._lock:
+            if not self.active:
+                return function(*args)
+            profile = self._profiles.get(name)
+            if profile is None:
+                profile = self._profiles[name] = cProfile.Profile()
+            self._calls[name] = self._calls.get(name, 0) + 1
+            profile.enable()
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+
+    def stop(self):
+        """Stops profiling and writes the profiles. Returns a list of
+        (command, calls, seconds, path) for every command that ran."""
+        with self._lock:
+            self.active = False
+            profiles, self._profiles = self._profiles, {}
+            calls, self._calls = self._calls, {}
+        if profiles:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        written = []
+        for name, profile in sorted(profiles.items()):
+            path = self.directory / f"{name}.pstats"
+            profile.dump_stats(path)
+            written.append((name, calls[name], pstats.Stats(profile).total_tt, path))
+        return written
+
+
+# The profiler the command parser uses. Set VIDEOPLAYER_PROFILE to a
+# directory to profile the whole run and write the profiles there on exit.
+PROFILER = CommandProfiler()
+if os.environ.get("VIDEOPLAYER_PROFILE"):
+    PROFILER.start(os.environ["VIDEOPLAYER_PROFILE"])
+    atexit.register(lambda: PROFILER.active and PROFILER.stop())
+
+
+# Objects that belong to the program and not to its data. Following them
+# would end up counting the whole interpreter.
+_NOT_DATA = (type, types.ModuleType, types.FunctionType, types.MethodType,
+             types.BuiltinFunctionType, types.CodeType, types.FrameType)
+
+
+def deep_size(root, seen: set) -> int:
+    """The size of `root` and everything reachable from it, leaving out
+    the objects whose id is in `seen` and adding the others to it."""
+    total = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _NOT_DATA):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+def memory_report(components, top=10) -> str:
+    """Where the memory goes.
+    Args:
+        components: (name, object) pairs. Each one is shown with the size
+            of everything reachable from it; objects shared between them
+            (a video in a playlist) count for the first one only.
+        top: When tracemalloc is tracing, how many of the places that
+            allocated the most memory to list.
+    """
+    lines = ["Memory by component:"]
+    seen = set()
+    for name, component in components:
+        lines.append(f"  {name:<24}{format_size(deep_size(component, seen)):>12}")
+    # Big catalogs make `seen` big too, keep it out of the allocations.
+    del seen
+
+    if not tracemalloc.is_tracing():
+        lines.append("Allocation tracing is off, use MEMORY START to see "
+                     "where memory is allocated.")
+        return "\n".join(lines)
+
+    current, peak = tracemalloc.get_traced_memory()
+    lines.append(f"Traced allocations: {format_size(current)} now, "
+                 f"{format_size(peak)} at peak")
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),))
+    lines.append("Top allocation sites:")
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append(f"  {format_size(stat.size):>12}{stat.count:>10} blocks  "
+                     f"{frame.filename}:{frame.lineno}")
+    return "\n".join(lines)
+
+
 # In[4]:
 
 
 """A command parser class."""
 
-import textwrap
-from typing import Sequence
+import functools
+import sys
+import tracemalloc
+from typing import Callable, Optional, Sequence, Tuple, Union
+from .video_metrics import METRICS
+from .video_profiling import PROFILER, memory_report
 
 
 class CommandException(Exception):
@@ -15,11 +380,239 @@ class CommandException(Exception):
     pass
 
 
+class CommandSpec:
+    """Everything the parser needs to know about one command.
+    Args:
+        name: The command name, in upper case.
+        handler: Either the name of the VideoPlayer method to call with the
+            arguments, or a callable taking (parser, *arguments).
+        arity: (min, max) number of arguments, or None to not check (the
+            commands without arguments just ignore extra ones). Use
+            sys.maxsize as max for any number.
+        usage: What to tell the user when the arguments don't fit.
+        arguments: How the arguments are shown in HELP, e.g. "<video_id>".
+        description: What the command does, shown in HELP.
+        paged: If True, the arguments may end with LIMIT <n>, OFFSET <n>
+            and AFTER <cursor>, which are passed to the handler as the
+            limit, offset and after keyword arguments.
+    """
+
+    def __init__(self, name: str, handler: Union[str, Callable],
+                 arity: Optional[Tuple[int, int]] = None, usage: str = "",
+                 arguments: str = "", description: str = "", paged: bool = False):
+        self.name = name.upper()
+        self.handler = handler
+        self.arity = arity
+        self.usage = usage
+        self.arguments = arguments
+        self.description = description
+        self.paged = paged
+
+    @property
+    def help_line(self):
+        name = f"{self.name} {self.arguments}" if self.arguments else self.name
+        return f"{name} - {self.description}"
+
+
+# The commands every parser starts with, by name. Plugins can add their
+# own with register_command before creating the parser, or with
+# CommandParser.register afterwards.
+_COMMANDS = {}
+
+
+def register_command(spec: CommandSpec):
+    """Adds a command to every parser created from now on."""
+    _COMMANDS[spec.name] = spec
+
+
+# Commands only for whoever runs the process: they write files, or change
+# state every user shares (the metrics, the profiler, the catalog). The
+# server leaves them out of its sessions.
+LOCAL_COMMANDS = frozenset({"STATS", "PROFILE", "MEMORY", "RELOAD"})
+
+
+_PAGE_ARGUMENTS = "[LIMIT <n>] [OFFSET <n>] [AFTER <cursor>]"
+_PAGE_OPTIONS = ("LIMIT", "OFFSET", "AFTER")
+
+
+def _split_paging(spec: CommandSpec, args: Sequence[str]):
+    """Splits the LIMIT, OFFSET and AFTER options off the arguments of a
+    paged command. Returns the other arguments and the options as keyword
+    arguments. The command's own arguments are everything before the first
+    option, and at least as many as it needs, so searching for "limit"
+    still works."""
+    count = spec.arity[0] if spec.arity is not None else 0
+    while count < len(args) and args[count].upper() not in _PAGE_OPTIONS:
+        count += 1
+    options = args[count:]
+    if len(options) % 2:
+        raise CommandException(spec.usage)
+    kwargs = {}
+    for name, value in zip(options[::2], options[1::2]):
+        name = name.upper()
+        if name in ("LIMIT", "OFFSET"):
+            try:
+                number = int(value)
+            except ValueError:
+                raise CommandException(spec.usage)
+            if number < (1 if name == "LIMIT" else 0):
+                raise CommandException(spec.usage)
+            kwargs[name.lower()] = number
+        elif name == "AFTER":
+            kwargs["after"] = value
+        else:
+            raise CommandException(spec.usage)
+    return args[:count], kwargs
+
+
+for _spec in (
+    CommandSpec("NUMBER_OF_VIDEOS", "number_of_videos",
+                description="Shows how many videos are in the library."),
+    CommandSpec("SHOW_ALL_VIDEOS", "show_all_videos", (0, 0),
+                usage="Please enter SHOW_ALL_VIDEOS command, optionally "
+                      "followed by LIMIT, OFFSET or AFTER and a value.",
+                arguments=_PAGE_ARGUMENTS,
+                description="Lists all videos from the library.", paged=True),
+    CommandSpec("PLAY", "play_video", (1, 1),
+                "Please enter PLAY command followed by video_id.",
+                "<video_id>", "Plays specified video."),
+    CommandSpec("PLAY_RANDOM", "play_random_video",
+                description="Plays a random video from the library."),
+    CommandSpec("STOP", "stop_video",
+                description="Stop the current video."),
+    CommandSpec("PAUSE", "pause_video",
+                description="Pause the current video."),
+    CommandSpec("CONTINUE", "continue_video",
+                description="Resume the current paused video."),
+    CommandSpec("SHOW_PLAYING", "show_playing",
+                description="Displays the title, url and paused status of the "
+                            "video that is currently playing (or paused)."),
+    CommandSpec("CREATE_PLAYLIST", "create_playlist", (1, 1),
+                "Please enter CREATE_PLAYLIST command followed by a "
+                "playlist name.",
+                "<playlist_name>",
+                "Creates a new (empty) playlist with the provided name."),
+    CommandSpec("ADD_TO_PLAYLIST", "add_to_playlist", (2, 2),
+                "Please enter ADD_TO_PLAYLIST command followed by a "
+                "playlist name and video_id to add.",
+                "<playlist_name> <video_id>",
+                "Adds the requested video to the playlist."),
+    CommandSpec("ADD_ALL_TO_PLAYLIST", "add_all_to_playlist", (2, 2),
+                "Please enter ADD_ALL_TO_PLAYLIST command followed by a "
+                "playlist name and @ with a file of video_ids, or video_ids "
+                "separated by commas.",
+                "<playlist_name> <@file|video_id,...>",
+                "Adds many videos to the playlist at once."),
+    CommandSpec("REMOVE_FROM_PLAYLIST", "remove_from_playlist", (2, 2),
+                "Please enter REMOVE_FROM_PLAYLIST command followed by a "
+                "playlist name and video_id to remove.",
+                "<playlist_name> <video_id>",
+                "Removes the specified video from the specified playlist"),
+    CommandSpec("CLEAR_PLAYLIST", "clear_playlist", (1, 1),
+                "Please enter CLEAR_PLAYLIST command followed by a "
+                "playlist name.",
+                "<playlist_name>",
+                "Removes all the videos from the playlist."),
+    CommandSpec("DELETE_PLAYLIST", "delete_playlist", (1, 1),
+                "Please enter DELETE_PLAYLIST command followed by a "
+                "playlist name.",
+                "<playlist_name>", "Deletes the playlist."),
+    CommandSpec("SHOW_PLAYLIST", "show_playlist", (1, 1),
+                "Please enter SHOW_PLAYLIST command followed by a "
+                "playlist name.",
+                f"<playlist_name> {_PAGE_ARGUMENTS}",
+                "List all the videos in this playlist.", paged=True),
+    CommandSpec("SHOW_ALL_PLAYLISTS", "show_all_playlists",
+                description="Display all the available playlists."),
+    CommandSpec("SEARCH_VIDEOS", "search_videos", (1, 1),
+                "Please enter SEARCH_VIDEOS command followed by a "
+                "search term.",
+                f"<search_term> {_PAGE_ARGUMENTS}",
+                "Display all the videos whose titles contain the search_term.",
+                paged=True),
+    CommandSpec("SEARCH_VIDEOS_WITH_TAG", "search_videos_tag", (1, sys.maxsize),
+                "Please enter SEARCH_VIDEOS_WITH_TAG command followed by a "
+                "video tag, or tags combined with AND, OR, NOT and brackets.",
+                f"<tag_name> [AND|OR|NOT <tag_name> ...] {_PAGE_ARGUMENTS}",
+                "Display all videos whose tags contains the provided tag, "
+                "or match the tags combined with AND, OR, NOT and brackets.",
+                paged=True),
+    CommandSpec("SEARCH_RANKED", "search_ranked", (1, sys.maxsize),
+                "Please enter SEARCH_RANKED command followed by one or more "
+                "search words.",
+                f"<word> [<word> ...] {_PAGE_ARGUMENTS}",
+                "Display the videos best matching the words (10 unless a "
+                "LIMIT is given), best first.",
+                paged=True),
+    CommandSpec("FLAG_VIDEO", "flag_video", (1, 2),
+                "Please enter FLAG_VIDEO command followed by a "
+                "video_id and an optional flag reason.",
+                "<video_id> <flag_reason>", "Mark a video as flagged."),
+    CommandSpec("ALLOW_VIDEO", "allow_video", (1, 1),
+                "Please enter ALLOW_VIDEO command followed by a "
+                "video_id.",
+                "<video_id>", "Removes a flag from a video."),
+    CommandSpec("FLAG_VIDEOS_FROM", "flag_videos_from", (1, 2),
+                "Please enter FLAG_VIDEOS_FROM command followed by @ with a "
+                "file of video_ids, or video_ids separated by commas, and an "
+                "optional flag reason.",
+                "<@file|video_id,...> <flag_reason>",
+                "Mark many videos as flagged at once."),
+    CommandSpec("ALLOW_VIDEOS_FROM", "allow_videos_from", (1, 1),
+                "Please enter ALLOW_VIDEOS_FROM command followed by @ with a "
+                "file of video_ids, or video_ids separated by commas.",
+                "<@file|video_id,...>",
+                "Removes the flag from many videos at once."),
+    CommandSpec("RELOAD", "reload_videos",
+                description="Reads the video catalog again and applies the "
+                            "changes."),
+    CommandSpec("STATUS", "show_status",
+                description="Shows whether the videos are loaded, or how far "
+                            "loading has got."),
+    CommandSpec("HELP", lambda parser: parser._get_help(),
+                description="Displays help."),
+    CommandSpec("STATS", lambda parser, *args: parser._stats(*args), (0, 2),
+                "Please enter STATS, optionally followed by ON, OFF, RESET "
+                "or DUMP and a file name.",
+                "[ON|OFF|RESET|DUMP <file>]",
+                "Shows how often each command ran, its errors and how long "
+                "it took."),
+    CommandSpec("PROFILE", lambda parser, *args: parser._profile(*args), (1, 2),
+                "Please enter PROFILE START, optionally followed by a "
+                "directory, or PROFILE STOP.",
+                "START [<directory>]|STOP",
+                "Profiles every command until PROFILE STOP, then writes a "
+                "profile per command."),
+    CommandSpec("MEMORY", lambda parser, *args: parser._memory(*args), (0, 1),
+                "Please enter MEMORY, optionally followed by START or STOP.",
+                "[START|STOP]",
+                "Shows how much memory the library, the playlists and the "
+                "playback use. START and STOP trace where it is allocated."),
+):
+    register_command(_spec)
+
+
 class CommandParser:
     """A class used to parse and execute a user Command."""
 
-    def __init__(self, video_player):
+    def __init__(self, video_player, exclude=()):
+        """The parser starts with every registered command.
+        Args:
+            video_player: The VideoPlayer the commands run on.
+            exclude: Names of registered commands this parser leaves out,
+                e.g. LOCAL_COMMANDS.
+        """
         self._player = video_player
+        self._commands = {name: spec for name, spec in _COMMANDS.items()
+                          if name not in exclude}
+
+    @property
+    def player(self):
+        return self._player
+
+    def register(self, spec: CommandSpec):
+        """Adds (or replaces) a command on this parser only."""
+        self._commands[spec.name] = spec
 
     def execute_command(self, command: Sequence[str]):
         """Executes the user command. Expects the command to be upper case.
@@ -30,143 +623,136 @@ class CommandParser:
                 "Please enter a valid command, "
                 "type HELP for a list of available commands.")
 
-        if command[0].upper() == "NUMBER_OF_VIDEOS":
-            self._player.number_of_videos()
-
-        elif command[0].upper() == "SHOW_ALL_VIDEOS":
-            self._player.show_all_videos()
-
-        elif command[0].upper() == "PLAY":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter PLAY command followed by video_id.")
-            self._player.play_video(command[1])
-
-        elif command[0].upper() == "PLAY_RANDOM":
-            self._player.play_random_video()
-
-        elif command[0].upper() == "STOP":
-            self._player.stop_video()
-
-        elif command[0].upper() == "PAUSE":
-            self._player.pause_video()
-
-        elif command[0].upper() == "CONTINUE":
-            self._player.continue_video()
-
-        elif command[0].upper() == "SHOW_PLAYING":
-            self._player.show_playing()
-
-        elif command[0].upper() == "CREATE_PLAYLIST":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter CREATE_PLAYLIST command followed by a "
-                    "playlist name.")
-            self._player.create_playlist(command[1])
-
-        elif command[0].upper() == "ADD_TO_PLAYLIST":
-            if len(command) != 3:
-                raise CommandException(
-                    "Please enter ADD_TO_PLAYLIST command followed by a "
-                    "playlist name and video_id to add.")
-            self._player.add_to_playlist(command[1], command[2])
-
-        elif command[0].upper() == "REMOVE_FROM_PLAYLIST":
-            if len(command) != 3:
-                raise CommandException(
-                    "Please enter REMOVE_FROM_PLAYLIST command followed by a "
-                    "playlist name and video_id to remove.")
-            self._player.remove_from_playlist(command[1], command[2])
-
-        elif command[0].upper() == "CLEAR_PLAYLIST":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter CLEAR_PLAYLIST command followed by a "
-                    "playlist name.")
-            self._player.clear_playlist(command[1])
-
-        elif command[0].upper() == "DELETE_PLAYLIST":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter DELETE_PLAYLIST command followed by a "
-                    "playlist name.")
-            self._player.delete_playlist(command[1])
-
-        elif command[0].upper() == "SHOW_PLAYLIST":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter SHOW_PLAYLIST command followed by a "
-                    "playlist name.")
-            self._player.show_playlist(command[1])
-
-        elif command[0].upper() == "SHOW_ALL_PLAYLISTS":
-            self._player.show_all_playlists()
-
-        elif command[0].upper() == "SEARCH_VIDEOS":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter SEARCH_VIDEOS command followed by a "
-                    "search term.")
-            self._player.search_videos(command[1])
-
-        elif command[0].upper() == "SEARCH_VIDEOS_WITH_TAG":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter SEARCH_VIDEOS_WITH_TAG command followed by a "
-                    "video tag.")
-            self._player.search_videos_tag(command[1])
-
-        elif command[0].upper() == "FLAG_VIDEO":
-            if len(command) == 3:
-                self._player.flag_video(command[1], command[2])
-            elif len(command) == 2:
-                self._player.flag_video(command[1])
-            else:
-                raise CommandException(
-                    "Please enter FLAG_VIDEO command followed by a "
-                    "video_id and an optional flag reason.")
-
-        elif command[0].upper() == "ALLOW_VIDEO":
-            if len(command) != 2:
-                raise CommandException(
-                    "Please enter ALLOW_VIDEO command followed by a "
-                    "video_id.")
-            self._player.allow_video(command[1])
-
-        elif command[0].upper() == "HELP":
-            self._get_help()
-        else:
-            print(
+        spec = self._commands.get(command[0].upper())
+        if spec is None:
+            if METRICS.enabled:
+                METRICS.record_command("UNKNOWN", 0.0, ("CommandException",))
+            self._player.say(
+                "unknown_command",
                 "Please enter a valid command, type HELP for a list of "
-                "available commands.")
+                "available commands.",
+                error="CommandException")
+            return None
+
+        if METRICS.enabled or PROFILER.active:
+            return self._run_instrumented(spec, command[1:])
+        return self._run(spec, command[1:])
+
+    def _run_instrumented(self, spec: CommandSpec, args: Sequence[str]):
+        run = self._run
+        # Profiling PROFILE STOP would mean writing a profile while it runs.
+        if PROFILER.active and spec.name != "PROFILE":
+            run = functools.partial(PROFILER.profile_command, spec.name, run)
+        if METRICS.enabled:
+            return METRICS.time_command(spec.name, run, spec, args)
+        return run(spec, args)
+
+    def _run(self, spec: CommandSpec, args: Sequence[str]):
+        kwargs = {}
+        if spec.paged:
+            args, kwargs = _split_paging(spec, args)
+        if spec.arity is not None:
+            min_args, max_args = spec.arity
+            if not min_args <= len(args) <= max_args:
+                raise CommandException(spec.usage)
+
+        if isinstance(spec.handler, str):
+            return getattr(self._player, spec.handler)(*args, **kwargs)
+        return spec.handler(self, *args, **kwargs)
 
     def _get_help(self):
         """Displays all available commands to the user."""
-        help_text = textwrap.dedent("""
-        Available commands:
-            NUMBER_OF_VIDEOS - Shows how many videos are in the library.
-            SHOW_ALL_VIDEOS - Lists all videos from the library.
-            PLAY <video_id> - Plays specified video.
-            PLAY_RANDOM - Plays a random video from the library.
-            STOP - Stop the current video.
-            PAUSE - Pause the current video.
-            CONTINUE - Resume the current paused video.
-            SHOW_PLAYING - Displays the title, url and paused status of the video that is currently playing (or paused).
-            CREATE_PLAYLIST <playlist_name> - Creates a new (empty) playlist with the provided name.
-            ADD_TO_PLAYLIST <playlist_name> <video_id> - Adds the requested video to the playlist.
-            REMOVE_FROM_PLAYLIST <playlist_name> <video_id> - Removes the specified video from the specified playlist
-            CLEAR_PLAYLIST <playlist_name> - Removes all the videos from the playlist.
-            DELETE_PLAYLIST <playlist_name> - Deletes the playlist.
-            SHOW_PLAYLIST <playlist_name> - List all the videos in this playlist.
-            SHOW_ALL_PLAYLISTS - Display all the available playlists.
-            SEARCH_VIDEOS <search_term> - Display all the videos whose titles contain the search_term.
-            SEARCH_VIDEOS_WITH_TAG <tag_name> -Display all videos whose tags contains the provided tag.
-            FLAG_VIDEO <video_id> <flag_reason> - Mark a video as flagged.
-            ALLOW_VIDEO <video_id> - Removes a flag from a video.
-            HELP - Displays help.
-            EXIT - Terminates the program execution.
-        """)
-        print(help_text)
+        lines = ["", "Available commands:"]
+        lines.extend(f"    {spec.help_line}" for spec in self._commands.values())
+        # EXIT is handled by whoever reads the commands, not by us.
+        lines.append("    EXIT - Terminates the program execution.")
+        lines.append("")
+        self._player.say("help", "{text}", text="\n".join(lines))
+
+    def _stats(self, action="", path=None):
+        """Shows the metrics, or turns them on, off, resets or dumps them."""
+        action = action.upper()
+        if action == "":
+            # Don't wait for the videos: STATS is how you look at a slow load.
+            videos = self._player.loaded_videos
+            if videos is None:
+                self._player.say("stats", "{text}", text=METRICS.report())
+                return
+            cache = videos.cache_stats()
+            self._player.say(
+                "stats", "{text}\n\nQuery cache: {cache[hits]} hits, "
+                "{cache[misses]} misses, {cache[evictions]} evictions, "
+                "{cache[entries]} of {cache[size]} entries used.",
+                text=METRICS.report(), cache=cache)
+        elif action == "ON":
+            METRICS.enable()
+            self._player.say("stats_enabled", "Instrumentation is on.")
+        elif action == "OFF":
+            METRICS.disable()
+            self._player.say("stats_disabled", "Instrumentation is off.")
+        elif action == "RESET":
+            METRICS.reset()
+            self._player.say("stats_reset", "Stats have been reset.")
+        elif action == "DUMP" and path:
+            try:
+                METRICS.dump(path)
+            except OSError as e:
+                self._player.say("stats_error", "Cannot write stats: {reason}",
+                                 error=type(e).__name__, reason=str(e))
+                return
+            self._player.say("stats_dumped", "Stats written to {path}", path=path)
+        else:
+            raise CommandException(self._commands["STATS"].usage)
+
+    def _profile(self, action, directory="profiles"):
+        """Starts or stops profiling the commands."""
+        action = action.upper()
+        if action == "START":
+            PROFILER.start(directory)
+            self._player.say("profile_started",
+                             "Profiling every command, enter PROFILE STOP "
+                             "to write the profiles to {directory}.",
+                             directory=directory)
+        elif action == "STOP":
+            if not PROFILER.active:
+                self._player.say("profile_not_running", "Profiling is not running.")
+                return
+            try:
+                written = PROFILER.stop()
+            except OSError as e:
+                self._player.say("profile_error", "Cannot write profiles: {reason}",
+                                 error=type(e).__name__, reason=str(e))
+                return
+            lines = ["Profiling stopped."]
+            lines.extend(f"  {name}: {calls} calls, {seconds * 1000:.3f} ms, "
+                         f"written to {path}"
+                         for name, calls, seconds, path in written)
+            self._player.say("profile_stopped", "{text}", text="\n".join(lines),
+                             profiles=[str(path) for *_, path in written])
+        else:
+            raise CommandException(self._commands["PROFILE"].usage)
+
+    def _memory(self, action=""):
+        """Shows the memory report, or starts or stops tracemalloc."""
+        action = action.upper()
+        if action == "START":
+            tracemalloc.start()
+            self._player.say("memory_tracing", "Tracing memory allocations.")
+        elif action == "STOP":
+            tracemalloc.stop()
+            self._player.say("memory_not_tracing",
+                             "Stopped tracing memory allocations.")
+        elif action == "":
+            player = self._player
+            components = [("Playback", player.playback)]
+            # Like STATS, don't wait for the videos (or the playlists, which
+            # may be waiting for them).
+            if player.loaded_videos is not None:
+                components[:0] = [("VideoLibrary", player.loaded_videos),
+                                  ("VideoPlaylistLibrary", player.playlists)]
+            player.say("memory", "{text}", text=memory_report(components))
+        else:
+            raise CommandException(self._commands["MEMORY"].usage)
 
 
 # In[22]:
@@ -177,11 +763,153 @@ get_ipython().run_line_magic('pip', 'install VideoPlayer')
 get_ipython().run_line_magic('pip', 'install CommandException')
 get_ipython().run_line_magic('pip', 'install CommandParser')
 
+import argparse
+import asyncio
+import atexit
+import sys
+
+
+def run_batch(lines, out=None, answer=None, block_size=1 << 16, journal=None,
+              load_workers=0, search_workers=0):
+    """Runs every command in `lines` without prompts, e.g. from a script.
+    Output is collected and written to `out` in blocks of about
+    `block_size` characters instead of line by line.
+    Args:
+        lines: The commands, one per line.
+        out: Where the output goes, stdout by default.
+        answer: What to answer when a search asks which video to play. If
+            None, the answer is the next line of the script, just like a
+            user typing it.
+        journal: A Journal for the playlists and flags, see VideoPlayer.
+        load_workers, search_workers: How many processes parse the
+            catalog and run big title searches, see VideoLibrary.
+    """
+    out = out if out is not None else sys.stdout
+    lines = iter(lines)
+
+    def choose(prompt=""):
+        if answer is not None:
+            return answer
+        return next(lines, "").rstrip("\n")
+
+    video_player = VideoPlayer(chooser=choose, sink=BufferedSink(out, block_size),
+                               journal=journal, load_workers=load_workers,
+                               search_workers=search_workers,
+                               flush_before_choice=False)
+    parser = CommandParser(video_player)
+    for command in lines:
+        if command.strip().upper() == "EXIT":
+            break
+        try:
+            parser.execute_command(command.split())
+        except CommandException as e:
+            video_player.say("command_error", "{message}",
+                             error="CommandException", message=str(e))
+    video_player.sink.flush()
+
+
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        "--batch", nargs="?", const="-", metavar="FILE",
+        help="run the commands in FILE (or stdin) without prompts")
+    arg_parser.add_argument(
+        "--serve", metavar="HOST:PORT",
+        help="serve many users over TCP instead of reading from the terminal")
+    arg_parser.add_argument(
+        "--socket", metavar="PATH",
+        help="serve many users over a Unix socket at PATH")
+    arg_parser.add_argument(
+        "--stress-test", action="store_true",
+        help="check the video library under concurrent reads and flags")
+    arg_parser.add_argument(
+        "--benchmark", metavar="SIZES",
+        help="benchmark synthetic catalogs of these sizes, e.g. 1000,100000")
+    arg_parser.add_argument(
+        "--benchmark-output", metavar="FILE", default="bench_output.json",
+        help="where --benchmark writes its JSON results")
+    arg_parser.add_argument(
+        "--watch", metavar="SECONDS", type=float,
+        help="check videos.txt this often and reload it when it changed")
+    arg_parser.add_argument(
+        "--journal", metavar="DIR",
+        help="keep the playlists and flags in a journal in DIR, so they "
+             "are still there next time")
+    arg_parser.add_argument(
+        "--metrics-file", metavar="FILE",
+        help="turn on the command stats and write them to FILE on exit")
+    arg_parser.add_argument(
+        "--load-workers", metavar="N", type=int, default=0,
+        help="parse big catalogs with N processes instead of one")
+    arg_parser.add_argument(
+        "--search-workers", metavar="N", type=int, default=0,
+        help="spread title searches on big catalogs over N processes")
+    arg_parser.add_argument(
+        "--answer", metavar="N",
+        help="in batch mode, answer every 'play any of the above?' with N "
+             "instead of reading the answer from the next line")
+    args = arg_parser.parse_args()
+
+    if args.metrics_file is not None:
+        METRICS.enable()
+        atexit.register(METRICS.dump, args.metrics_file)
+
+    if args.batch is not None:
+        # A batch doesn't wait for each change to be on disk, they are all
+        # there once the journal is closed.
+        journal = (Journal(args.journal, wait_for_commit=False)
+                   if args.journal else None)
+        try:
+            if args.batch == "-":
+                run_batch(sys.stdin, answer=args.answer, journal=journal,
+                          load_workers=args.load_workers,
+                          search_workers=args.search_workers)
+            else:
+                with open(args.batch) as batch_file:
+                    run_batch(batch_file, answer=args.answer, journal=journal,
+                              load_workers=args.load_workers,
+                              search_workers=args.search_workers)
+        finally:
+            if journal is not None:
+                journal.close()
+        sys.exit(0)
+
+    if args.benchmark is not None:
+        report = run_benchmarks(
+            [int(size) for size in args.benchmark.split(",")],
+            output=args.benchmark_output)
+        for result in report["results"]:
+            print(f"{result['rows']:>10} {result['operation']:<24} "
+                  f"p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms")
+        sys.exit(0)
+
+    if args.stress_test:
+        problems = stress_test(VideoLibrary(load_workers=args.load_workers,
+                                            search_workers=args.search_workers))
+        print("\n".join(problems) if problems else "No problems found")
+        sys.exit(1 if problems else 0)
+
+    if args.serve is not None or args.socket is not None:
+        host, _, port = (args.serve or "").rpartition(":")
+        server = VideoServer(load_workers=args.load_workers,
+                             search_workers=args.search_workers)
+        asyncio.run(server.serve_forever(
+            host or "127.0.0.1", int(port or 0), path=args.socket,
+            watch=args.watch))
+        sys.exit(0)
+
     print("""Hello and welcome to YouTube, what would you like to do?
     Enter HELP for list of available commands or EXIT to terminate.""")
-    video_player = VideoPlayer()
+    journal = Journal(args.journal) if args.journal else None
+    # Load the videos while the user types: HELP and the like don't need
+    # them, the commands that do wait.
+    video_player = VideoPlayer(journal=journal, background=True,
+                               load_workers=args.load_workers,
+                               search_workers=args.search_workers)
     parser = CommandParser(video_player)
+    if args.watch is not None:
+        video_player.when_loaded(
+            lambda videos: CatalogWatcher(videos, args.watch).start())
     while True:
         command = input("YT> ")
         if command.upper() == "EXIT":
@@ -190,6 +918,8 @@ if __name__ == "__main__":
             parser.execute_command(command.split())
         except CommandException as e:
             print(e)
+    if journal is not None:
+        journal.close()
     print("YouTube has now terminated its execution. "
           "Thank you and goodbye!")
 
@@ -199,25 +929,91 @@ if __name__ == "__main__":
 
 """A video class."""
 
+import sys
+import threading
 from typing import Sequence
 
 class FlagError(Exception):
     pass
 
+
+class TagTable:
+    """Interns tag lists so that videos sharing the same tags share one
+    copy of them. Every distinct tag gets an integer id and every distinct
+    combination of tags gets an integer id too; a video only keeps the id
+    of its combination.
+    """
+
+    def __init__(self):
+        self._tag_ids = {}
+        self._tag_names = []
+        # tuple of tag ids -> combination id
+        self._combo_ids = {}
+        # combination id -> (tags tuple, tags string)
+        self._combos = []
+        self._lock = threading.Lock()
+
+    def intern(self, tags: Sequence[str]) -> int:
+        """Returns the combination id for these tags, in this order."""
+        tag_ids = []
+        for tag in tags:
+            tag_id = self._tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self._add_tag(tag)
+            tag_ids.append(tag_id)
+        tag_ids = tuple(tag_ids)
+        combo_id = self._combo_ids.get(tag_ids)
+        if combo_id is None:
+            with self._lock:
+                combo_id = self._combo_ids.get(tag_ids)
+                if combo_id is None:
+                    names = tuple(self._tag_names[i] for i in tag_ids)
+                    combo_id = len(self._combos)
+                    self._combos.append((names, ' '.join(names)))
+                    self._combo_ids[tag_ids] = combo_id
+        return combo_id
+
+    def _add_tag(self, tag):
+        with self._lock:
+            tag_id = self._tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self._tag_ids[tag] = len(self._tag_names)
+                self._tag_names.append(sys.intern(tag))
+            return tag_id
+
+    def tags(self, combo_id: int):
+        return self._combos[combo_id][0]
+
+    def tags_string(self, combo_id: int):
+        return self._combos[combo_id][1]
+
+
+# Shared by all videos.
+_TAG_TABLE = TagTable()
+
+
 class Video:
     """A class used to represent a Video."""
 
+    # No per-video __dict__: with millions of videos the saving adds up.
+    __slots__ = ("_title", "_video_id", "_tags_id", "_flag_reason",
+                 "_flag_listener")
+
     def __init__(self, video_title: str, video_id: str, video_tags: Sequence[str]):
         """Video constructor."""
         self._title = video_title
         self._video_id = video_id
 
-        # Turn the tags into a tuple here so it's unmodifiable,
-        # in case the caller changes the 'video_tags' they passed to us
-        self._tags = tuple(video_tags)
+        # Intern the tags here so they're unmodifiable, in case the caller
+        # changes the 'video_tags' they passed to us, and so that videos
+        # with the same tags share them
+        self._tags_id = _TAG_TABLE.intern(video_tags)
         # When the flag reason is None it means the video is not flagged
         # This allows us to not need a self._is_flagged.
         self._flag_reason = None
+        # Called with this video whenever it is flagged or unflagged, so
+        # whoever indexes us (the VideoLibrary) can keep up to date.
+        self._flag_listener = None
 
     @property
     def title(self) -> str:
@@ -232,13 +1028,13 @@ class Video:
     @property
     def tags(self) -> Sequence[str]:
         """Returns the list of tags of a video."""
-        return self._tags
+        return _TAG_TABLE.tags(self._tags_id)
 
     @property
     def tags_string(self) -> str:
         """Returns the tags as a string, like "#cat #animal"
         separated by spaces"""
-        return ' '.join(self.tags)
+        return _TAG_TABLE.tags_string(self._tags_id)
 
     def __str__(self):
         """This function prints the video when you do print(video) like
@@ -249,15 +1045,34 @@ class Video:
             result += f' - FLAGGED {self.formatted_flag_reason}'
         return result
 
-    def flag(self, flag_reason: str):
+    def flag(self, flag_reason: str, notify: bool = True):
+        """Flags the video. With notify=False the listener is not called:
+        whoever flags many videos at once updates its indexes itself."""
         if self.is_flagged:
             raise FlagError("Video is already flagged")
         self._flag_reason = flag_reason
+        if notify and self._flag_listener is not None:
+            self._flag_listener(self)
 
-    def unflag(self):
+    def unflag(self, notify: bool = True):
+        """Removes the flag, see flag."""
         if not self.is_flagged:
             raise FlagError("Video is not flagged")
         self._flag_reason = None
+        if notify and self._flag_listener is not None:
+            self._flag_listener(self)
+
+    def update(self, video_title: str, video_tags: Sequence[str]):
+        """Changes the title and tags, when the catalog changes them. The
+        flag stays. Whoever indexes the video (the VideoLibrary) has to
+        take it out of its indexes first and put it back afterwards."""
+        self._title = video_title
+        self._tags_id = _TAG_TABLE.intern(video_tags)
+
+    def set_flag_listener(self, listener):
+        """Register a callable that gets this video every time it is
+        flagged or unflagged. Only one listener is kept."""
+        self._flag_listener = listener
 
     @property
     def is_flagged(self):
@@ -279,6 +1094,1072 @@ class Video:
             return ''
 
 
+# In[13]:
+
+
+"""Index structures used by the video library."""
+
+import math
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence as SequenceABC
+from itertools import accumulate, chain
+from operator import itemgetter
+
+
+class SequenceView(SequenceABC):
+    """A read-only view over a list owned by someone else. Handing these out
+    lets callers walk the library without us copying it on every call."""
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items):
+        self._items = items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self._items[index])
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __repr__(self):
+        return f"SequenceView({self._items!r})"
+
+
+# A SortedVideoList of n videos is kept in blocks of about sqrt(n), and never
+# fewer than this many.
+_MIN_BLOCK_SIZE = 64
+
+
+def _block_size(length: int) -> int:
+    return max(_MIN_BLOCK_SIZE, math.isqrt(length))
+
+
+def _blocked(keys, videos):
+    """The state of a SortedVideoList holding these sorted keys and videos."""
+    size = _block_size(len(keys))
+    return _with_blocks([keys[i:i + size] for i in range(0, len(keys), size)],
+                        [videos[i:i + size] for i in range(0, len(videos), size)])
+
+
+def _with_blocks(key_blocks, video_blocks):
+    """The state of a SortedVideoList: the blocks, the last key of every
+    block and the position every block starts at, with the length last."""
+    return (key_blocks, video_blocks, [keys[-1] for keys in key_blocks],
+            list(accumulate(map(len, key_blocks), initial=0)))
+
+
+class BlockedSequence(SequenceABC):
+    """A read-only view of a list kept in blocks, indexed as one list."""
+
+    __slots__ = ("_blocks", "_starts")
+
+    def __init__(self, blocks, starts):
+        self._blocks = blocks
+        self._starts = starts
+
+    def __len__(self):
+        return self._starts[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return tuple(self)[index]
+            return self._slice(start, stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("index out of range")
+        block = bisect_right(self._starts, index) - 1
+        return self._blocks[block][index - self._starts[block]]
+
+    def _slice(self, start, stop):
+        items = []
+        if start >= stop:
+            return ()
+        blocks, starts = self._blocks, self._starts
+        block = bisect_right(starts, start) - 1
+        while block < len(blocks) and starts[block] < stop:
+            items += blocks[block][max(0, start - starts[block]):stop - starts[block]]
+            block += 1
+        return tuple(items)
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __repr__(self):
+        return f"BlockedSequence({list(self)!r})"
+
+
+class SortedVideoList:
+    """A list of videos that stays sorted by `key` as videos are added and
+    removed, so nobody has to sort the whole thing again.
+    Keys must be unique per video (the library's keys include the id).
+
+    The videos are kept in blocks of about sqrt(n), so adding or removing
+    one copies a single block and the short lists about the blocks, not
+    the whole list. Nothing is changed in place: an update builds the new
+    lists and swaps them in with a single assignment. A view handed out
+    earlier keeps seeing the old ones, so readers get a consistent
+    snapshot without any locking. Writers have to be serialized by the
+    owner.
+    """
+
+    def __init__(self, key, videos=()):
+        self._key = key
+        pairs = sorted((key(video), video) for video in videos)
+        # (key blocks, video blocks, last keys, starts), always replaced
+        # together, see _with_blocks.
+        self._state = _blocked([k for k, _ in pairs], [video for _, video in pairs])
+
+    @classmethod
+    def presorted(cls, key, keys, videos):
+        """Builds the list from keys and videos that are already sorted,
+        e.g. when they come from a snapshot."""
+        sorted_list = cls(key)
+        sorted_list._state = _blocked(list(keys), list(videos))
+        return sorted_list
+
+    def keys(self) -> BlockedSequence:
+        key_blocks, _, _, starts = self._state
+        return BlockedSequence(key_blocks, starts)
+
+    def items(self):
+        """Yields (key, video) pairs in order."""
+        key_blocks, video_blocks, _, _ = self._state
+        return zip(chain.from_iterable(key_blocks), chain.from_iterable(video_blocks))
+
+    def filter(self, predicate):
+        """Returns a new SortedVideoList of the videos matching predicate,
+        without sorting them again."""
+        pairs = [(k, v) for k, v in self.items() if predicate(v)]
+        return SortedVideoList.presorted(
+            self._key, [k for k, _ in pairs], [v for _, v in pairs])
+
+    def __len__(self):
+        return self._state[3][-1]
+
+    def __contains__(self, video):
+        return self._find(self._state, video) is not None
+
+    def _find(self, state, video):
+        """Returns the (block, position in the block) of the video, or None
+        if it is not here."""
+        key_blocks, video_blocks, last_keys, _ = state
+        key = self._key(video)
+        block = bisect_left(last_keys, key)
+        if block < len(last_keys):
+            i = bisect_left(key_blocks[block], key)
+            if video_blocks[block][i] is video:
+                return block, i
+        return None
+
+    def _replace(self, block, keys, videos):
+        """Swaps in new keys and videos for one block, splitting it if it
+        grew too big and dropping it if it is empty."""
+        key_blocks, video_blocks, _, starts = self._state
+        size = _block_size(starts[-1])
+        if len(keys) > 2 * size:
+            half = len(keys) // 2
+            new_keys, new_videos = [keys[:half], keys[half:]], [videos[:half], videos[half:]]
+        elif keys:
+            new_keys, new_videos = [keys], [videos]
+        else:
+            new_keys, new_videos = [], []
+        self._state = _with_blocks(
+            key_blocks[:block] + new_keys + key_blocks[block + 1:],
+            video_blocks[:block] + new_videos + video_blocks[block + 1:])
+
+    def add(self, video):
+        key_blocks, video_blocks, last_keys, _ = self._state
+        k = self._key(video)
+        if not key_blocks:
+            self._state = _blocked([k], [video])
+            return
+        # Past the last key the video goes at the end of the last block.
+        block = min(bisect_left(last_keys, k), len(last_keys) - 1)
+        keys, videos = key_blocks[block], video_blocks[block]
+        i = bisect_left(keys, k)
+        self._replace(block, keys[:i] + [k] + keys[i:], videos[:i] + [video] + videos[i:])
+
+    def remove(self, video):
+        found = self._find(self._state, video)
+        if found is None:
+            raise ValueError("Video is not in the list")
+        block, i = found
+        keys, videos = self._state[0][block], self._state[1][block]
+        self._replace(block, keys[:i] + keys[i + 1:], videos[:i] + videos[i + 1:])
+
+    def update(self, remove=(), add=()):
+        """Removes and adds many videos with one rebuild of the lists,
+        instead of one per video. Videos to remove that are not here are
+        ignored."""
+        key_blocks, video_blocks, _, _ = self._state
+        keys = list(chain.from_iterable(key_blocks))
+        videos = list(chain.from_iterable(video_blocks))
+        # No (key, video) pair per video: building a few hundred thousand
+        # tuples sets off full garbage collections that cost more than
+        # the rebuild itself.
+        if remove:
+            gone = set(remove)
+            keys = [k for k, v in zip(keys, videos) if v not in gone]
+            videos = [v for v in videos if v not in gone]
+        if add:
+            added = sorted(((self._key(video), video) for video in add),
+                           key=itemgetter(0))
+            new_keys = []
+            new_videos = []
+            start = 0
+            for key, video in added:
+                i = bisect_right(keys, key, start)
+                new_keys += keys[start:i]
+                new_videos += videos[start:i]
+                new_keys.append(key)
+                new_videos.append(video)
+                start = i
+            keys = new_keys + keys[start:]
+            videos = new_videos + videos[start:]
+        self._state = _blocked(keys, videos)
+
+    def view(self) -> BlockedSequence:
+        _, video_blocks, _, starts = self._state
+        return BlockedSequence(video_blocks, starts)
+
+    def index(self, video) -> int:
+        """The position of the video, raises ValueError if it isn't here."""
+        state = self._state
+        found = self._find(state, video)
+        if found is None:
+            raise ValueError("Video is not in the list")
+        block, i = found
+        return state[3][block] + i
+
+    @staticmethod
+    def _position_after(state, key):
+        key_blocks, _, last_keys, starts = state
+        block = bisect_right(last_keys, key)
+        if block == len(last_keys):
+            return starts[-1]
+        return starts[block] + bisect_right(key_blocks[block], key)
+
+    def position_after(self, key) -> int:
+        """The position of the first video whose key comes after `key`."""
+        return self._position_after(self._state, key)
+
+    def page(self, after=None, offset=0, limit=None):
+        """Returns up to `limit` videos (all if None) whose key comes after
+        the key `after`, skipping the first `offset` of them. Only the page
+        is copied."""
+        state = self._state
+        start = offset if after is None else self._position_after(state, after) + offset
+        view = BlockedSequence(state[1], state[3])
+        stop = len(view) if limit is None else min(start + limit, len(view))
+        return view._slice(start, stop)
+
+
+class TagIndex:
+    """An inverted index from a tag to the videos carrying it (a posting
+    list), kept in the library's sorted order. A tag lookup then only costs
+    as much as the videos it returns.
+    """
+
+    def __init__(self, key, videos: SortedVideoList = None):
+        self._key = key
+        by_tag = {}
+        if videos is not None:
+            # Walking the videos in order means every posting list comes
+            # out sorted already.
+            for k, video in videos.items():
+                # A video listing the same tag twice is still only one result.
+                for tag in set(video.tags):
+                    by_tag.setdefault(tag, ([], []))
+                    keys, tagged = by_tag[tag]
+                    keys.append(k)
+                    tagged.append(video)
+        self._postings = {
+            tag: SortedVideoList.presorted(key, keys, tagged)
+            for tag, (keys, tagged) in by_tag.items()
+        }
+
+    def add(self, video):
+        for tag in set(video.tags):
+            posting = self._postings.get(tag)
+            if posting is None:
+                posting = self._postings[tag] = SortedVideoList(self._key)
+            posting.add(video)
+
+    def remove(self, video):
+        for tag in set(video.tags):
+            posting = self._postings[tag]
+            posting.remove(video)
+            if not posting:
+                del self._postings[tag]
+
+    def update(self, remove=(), add=()):
+        """Like SortedVideoList.update: every posting list that changes is
+        rebuilt once. The videos to remove must still have the tags they
+        were added with."""
+        by_tag = {}
+        for video in remove:
+            for tag in set(video.tags):
+                by_tag.setdefault(tag, ([], []))[0].append(video)
+        for video in add:
+            for tag in set(video.tags):
+                by_tag.setdefault(tag, ([], []))[1].append(video)
+        for tag, (gone, added) in by_tag.items():
+            posting = self._postings.get(tag)
+            if posting is None:
+                posting = SortedVideoList(self._key)
+            posting.update(gone, added)
+            if posting:
+                self._postings[tag] = posting
+            else:
+                self._postings.pop(tag, None)
+
+    def get(self, tag: str) -> SequenceView:
+        """Returns the videos with exactly this tag."""
+        posting = self._postings.get(tag)
+        if posting is None:
+            return SequenceView(())
+        return posting.view()
+
+    def page(self, tag: str, after=None, offset=0, limit=None):
+        """Returns one page of the videos with this tag, see
+        SortedVideoList.page."""
+        posting = self._postings.get(tag)
+        if posting is None:
+            return ()
+        return posting.page(after, offset, limit)
+
+
+class TagQueryError(Exception):
+    pass
+
+
+def _bitmap(rows) -> int:
+    """A Python int with the bits of `rows` set. Setting them in a
+    bytearray first keeps this linear; int operations would copy the whole
+    number for every bit."""
+    rows = list(rows)
+    if not rows:
+        return 0
+    data = bytearray(max(rows) // 8 + 1)
+    for row in rows:
+        data[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(data, "little")
+
+
+# The set bits of every byte value, for walking a bitmap a byte at a time.
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1)
+                   for value in range(256))
+
+
+class TagBitmaps:
+    """A bitmap per tag over the library's sorted order, plus one of the
+    allowed videos: bit i is the i-th video of `videos`. Bitmaps are Python
+    ints, so AND, OR and NOT of whole tags take one int operation each,
+    about n/64 machine words, and reading the bits back in order gives
+    the videos in library order. Ints can't change, so a flag swaps in a
+    new allowed bitmap and readers keep the one they started with.
+    """
+
+    def __init__(self, videos):
+        self._videos = videos
+        rows_by_tag = {}
+        for row, video in enumerate(videos):
+            for tag in set(video.tags):
+                rows_by_tag.setdefault(tag, []).append(row)
+        self._tags = {tag: _bitmap(rows) for tag, rows in rows_by_tag.items()}
+        self.all = (1 << len(videos)) - 1
+        self.allowed = _bitmap(row for row, video in enumerate(videos)
+                               if not video.is_flagged)
+
+    def tag(self, tag: str) -> int:
+        return self._tags.get(tag, 0)
+
+    def set_allowed(self, rows, allowed: bool):
+        """Sets or clears the allowed bits of all the rows in one go."""
+        mask = _bitmap(rows)
+        if allowed:
+            self.allowed = self.allowed | mask
+        else:
+            self.allowed = self.allowed & ~mask
+
+    def videos(self, bitmap: int, start: int = 0):
+        """Yields the videos whose bits are set, from row `start` on, in
+        order. Only the bitmap is walked, 8 rows at a time."""
+        videos = self._videos
+        bitmap >>= start
+        data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+        for i, byte in enumerate(data):
+            if byte:
+                base = start + i * 8
+                for bit in _BYTE_BITS[byte]:
+                    yield videos[base + bit]
+
+
+_TAG_QUERY_TOKEN_RE = re.compile(r"\(|\)|[^\s()]+")
+
+
+def parse_tag_query(text: str):
+    """Parses a query like "#cat AND (#funny OR #cute) NOT #dog" into a tree
+    of ("tag", name), ("not", query), ("and", [queries]) and ("or",
+    [queries]). AND, OR and NOT can be in any case; tags next to each
+    other are ANDed. Raises TagQueryError if the query makes no sense.
+    """
+    tokens = _TAG_QUERY_TOKEN_RE.findall(text)
+    position = 0
+
+    def peek():
+        return tokens[position].upper() if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        terms = [parse_and()]
+        while peek() == "OR":
+            take()
+            terms.append(parse_and())
+        return terms[0] if len(terms) == 1 else ("or", terms)
+
+    def parse_and():
+        terms = [parse_not()]
+        while peek() not in (None, "OR", ")"):
+            if peek() == "AND":
+                take()
+            terms.append(parse_not())
+        return terms[0] if len(terms) == 1 else ("and", terms)
+
+    def parse_not():
+        if peek() == "NOT":
+            take()
+            return ("not", parse_not())
+        if peek() == "(":
+            take()
+            query = parse_or()
+            if peek() != ")":
+                raise TagQueryError("Missing )")
+            take()
+            return query
+        if peek() in (None, ")", "AND", "OR"):
+            raise TagQueryError(f"Expected a tag, got {peek() or 'nothing'}")
+        return ("tag", take())
+
+    query = parse_or()
+    if position < len(tokens):
+        raise TagQueryError(f"Unexpected {tokens[position]}")
+    return query
+
+
+def format_tag_query(query) -> str:
+    """Writes a parsed query back as text, the same way for queries that
+    parse the same."""
+    kind, value = query
+    if kind == "tag":
+        return value
+    if kind == "not":
+        return f"NOT {format_tag_query(value)}"
+    return "(" + f" {kind.upper()} ".join(map(format_tag_query, value)) + ")"
+
+
+def evaluate_tag_query(query, bitmaps: TagBitmaps) -> int:
+    """The bitmap of the videos matching a parsed query, flagged or not."""
+    kind, value = query
+    if kind == "tag":
+        return bitmaps.tag(value)
+    if kind == "not":
+        return bitmaps.all & ~evaluate_tag_query(value, bitmaps)
+    results = [evaluate_tag_query(term, bitmaps) for term in value]
+    bitmap = results[0]
+    for result in results[1:]:
+        bitmap = bitmap & result if kind == "and" else bitmap | result
+    return bitmap
+
+
+class RandomSet:
+    """A set of videos we can pick from uniformly at random in O(1). The
+    videos live in a list and we remember where each one is, so removing
+    one means moving the last video into its place.
+    """
+
+    def __init__(self, videos=()):
+        self._videos = list(videos)
+        self._positions = {video: i for i, video in enumerate(self._videos)}
+
+    def __len__(self):
+        return len(self._videos)
+
+    def add(self, video):
+        if video in self._positions:
+            return
+        self._positions[video] = len(self._videos)
+        self._videos.append(video)
+
+    def remove(self, video):
+        # Fill the hole before shrinking the list, so a choice() running
+        # meanwhile may see the last video twice but never the removed one.
+        i = self._positions.pop(video)
+        videos = self._videos
+        last = videos[-1]
+        if last is not video:
+            videos[i] = last
+            self._positions[last] = i
+        videos.pop()
+
+    def choice(self, rng):
+        """Returns a random video using `rng`, or None if the set is
+        empty. Safe to call while another thread adds or removes: if the
+        list shrinks under us we just pick again."""
+        videos = self._videos
+        while videos:
+            try:
+                return videos[rng.randrange(len(videos))]
+            except IndexError:
+                continue
+        return None
+
+
+def _trigrams(text):
+    """Every 3 character slice of the text. Text shorter than that is kept
+    whole so short titles can still be found."""
+    if len(text) < 3:
+        return {text} if text else set()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str):
+    """The lower case words of the text, e.g. "#Cat-Videos!" gives
+    ["cat", "videos"]."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+class TermIndex:
+    """Term statistics for ranking: for every word of the titles and tags,
+    the videos having it and how much weight it has in each of them.
+
+    A video's words are its title words and its tag words. The weight of a
+    word in a video is how often it appears, divided by the square root of
+    the number of words the video has, so a word counts for more in a
+    short title. A query adds up, for every query word, its weight times
+    its idf (rarer words count more). Everything but the idf is worked out
+    here, once.
+    """
+
+    def __init__(self, videos=()):
+        by_term = {}
+        count = 0
+        # Few videos have tags no other video has, so split each set of
+        # tags into words only once.
+        tag_terms = {}
+        for video in videos:
+            count += 1
+            for term, weight in self._weights(video, tag_terms).items():
+                posting = by_term.get(term)
+                if posting is None:
+                    posting = by_term[term] = ([], array("d"))
+                posting[0].append(video)
+                posting[1].append(weight)
+        # Term -> (videos, their weights), or (positions in self._rows,
+        # weights) while still packed the way a snapshot stores it. Like
+        # the other indexes, updates replace a posting instead of changing
+        # it.
+        self._postings = by_term
+        self._rows = ()
+        self._count = count
+
+    @classmethod
+    def from_snapshot(cls, videos, terms):
+        """Builds the index from `to_snapshot` output, see
+        TitleIndex.from_snapshot."""
+        index = cls()
+        index._rows = videos
+        index._postings = dict(terms)
+        index._count = len(videos)
+        return index
+
+    def to_snapshot(self, positions):
+        """Returns the postings with the videos packed as an array of
+        positions, given a dict from each video to its position."""
+        snapshot = {}
+        for term in list(self._postings):
+            tagged, weights = self._posting(term)
+            snapshot[term] = (array("I", [positions[v] for v in tagged]), weights)
+        return snapshot
+
+    def _posting(self, term):
+        posting = self._postings.get(term)
+        if posting is not None and isinstance(posting[0], array):
+            rows = self._rows
+            posting = self._postings[term] = ([rows[i] for i in posting[0]], posting[1])
+        return posting
+
+    @staticmethod
+    def _weights(video, tag_terms=None):
+        tags = video.tags
+        words = tag_terms.get(tags) if tag_terms is not None else None
+        if words is None:
+            words = [word for tag in tags for word in tokenize(tag)]
+            if tag_terms is not None:
+                tag_terms[tags] = words
+        terms = tokenize(video.title) + words
+        if not terms:
+            return {}
+        weight = 1 / math.sqrt(len(terms))
+        counts = dict.fromkeys(terms, weight)
+        if len(counts) < len(terms):
+            counts = dict.fromkeys(terms, 0.0)
+            for term in terms:
+                counts[term] += weight
+        return counts
+
+    def __len__(self):
+        return self._count
+
+    def add(self, video):
+        self.update(add=[video])
+
+    def remove(self, video):
+        self.update(remove=[video])
+
+    def update(self, remove=(), add=()):
+        """Removes and adds many videos, rebuilding every posting that
+        changes once, however many of the videos share the term. Videos
+        to remove must still have the title and tags they were added with.
+        """
+        tag_terms = {}
+        gone = {}
+        for video in remove:
+            for term in self._weights(video, tag_terms):
+                gone.setdefault(term, set()).add(video)
+        added = {}
+        for video in add:
+            for term, weight in self._weights(video, tag_terms).items():
+                new_videos, new_weights = added.setdefault(term, ([], array("d")))
+                new_videos.append(video)
+                new_weights.append(weight)
+        for term in gone.keys() | added.keys():
+            tagged, weights = self._posting(term) or ((), array("d"))
+            drop = gone.get(term)
+            if drop:
+                kept = [i for i, video in enumerate(tagged) if video not in drop]
+                tagged = [tagged[i] for i in kept]
+                weights = array("d", [weights[i] for i in kept])
+            else:
+                tagged, weights = list(tagged), array("d", weights)
+            if term in added:
+                tagged += added[term][0]
+                weights += added[term][1]
+            if tagged:
+                self._postings[term] = (tagged, weights)
+            else:
+                self._postings.pop(term, None)
+        self._count += len(add) - len(remove)
+
+    def idf(self, term: str) -> float:
+        posting = self._postings.get(term)
+        if posting is None:
+            return 0.0
+        return math.log(1 + self._count / len(posting[1]))
+
+    def scores(self, terms):
+        """Returns a dict from every video having any of the terms to its
+        score."""
+        scores = {}
+        for term in set(terms):
+            posting = self._posting(term)
+            if posting is None:
+                continue
+            idf = self.idf(term)
+            get = scores.get
+            for video, weight in zip(*posting):
+                scores[video] = get(video, 0.0) + weight * idf
+        return scores
+
+
+class TitleIndex:
+    """A trigram index over the lower case titles. A search only looks at
+    the videos sharing every trigram of the search term and then checks
+    those candidates with a plain substring test, so the results are exactly
+    what `term in title.lower()` would give.
+    """
+
+    def __init__(self, videos=()):
+        self._lower_titles = {}
+        # A trigram maps to a set of videos, or to an array of positions in
+        # self._rows while it is still packed the way a snapshot stores it.
+        self._grams = {}
+        self._rows = ()
+        grams = self._grams
+        for video in videos:
+            lower_title = self._lower_titles[video] = video.title.lower()
+            for gram in _trigrams(lower_title):
+                posting = grams.get(gram)
+                if posting is None:
+                    grams[gram] = {video}
+                else:
+                    posting.add(video)
+
+    @classmethod
+    def from_snapshot(cls, videos, grams):
+        """Builds the index from `to_snapshot` output. The trigrams are only
+        unpacked into sets once a search or update needs them."""
+        index = cls()
+        index._rows = videos
+        index._lower_titles = {video: video.title.lower() for video in videos}
+        index._grams = dict(grams)
+        return index
+
+    def to_snapshot(self, positions):
+        """Returns the trigrams packed as arrays of video positions, given
+        a dict from each video to its position."""
+        return {
+            gram: array("I", sorted(positions[v] for v in self._posting(gram)))
+            for gram in list(self._grams)
+        }
+
+    def _posting(self, gram):
+        videos = self._grams.get(gram)
+        if videos is None:
+            return set()
+        if not isinstance(videos, set):
+            rows = self._rows
+            videos = self._grams[gram] = {rows[i] for i in videos}
+        return videos
+
+    # Like SortedVideoList, updates replace the sets instead of changing
+    # them, so a search running at the same time is not disturbed.
+
+    def add(self, video):
+        self.update(add=[video])
+
+    def remove(self, video):
+        self.update(remove=[video])
+
+    def update(self, remove=(), add=()):
+        """Removes and adds many videos, rebuilding every trigram set that
+        changes once, however many of the videos share the trigram.
+        Videos are removed by the title they were added with."""
+        gone = {}
+        for video in remove:
+            for gram in _trigrams(self._lower_titles[video]):
+                gone.setdefault(gram, []).append(video)
+        lower_titles = {video: video.title.lower() for video in add}
+        added = {}
+        for video, lower_title in lower_titles.items():
+            for gram in _trigrams(lower_title):
+                added.setdefault(gram, []).append(video)
+        for gram in gone.keys() | added.keys():
+            videos = self._posting(gram).difference(gone.get(gram, ()))
+            videos.update(added.get(gram, ()))
+            if videos:
+                self._grams[gram] = videos
+            else:
+                self._grams.pop(gram, None)
+        for video in remove:
+            del self._lower_titles[video]
+        self._lower_titles.update(lower_titles)
+
+    def estimate(self, term: str) -> int:
+        """About how many candidates a search for the lower case term has to
+        check. Terms shorter than a trigram count as the whole catalog."""
+        if len(term) < 3:
+            return len(self._lower_titles)
+        return min(len(self._posting(gram)) for gram in _trigrams(term))
+
+    def search(self, term: str):
+        """Returns the (unordered) videos whose lower case title contains the
+        lower case term."""
+        if not term:
+            return list(self._lower_titles.copy())
+
+        if len(term) >= 3:
+            postings = sorted(
+                (self._posting(gram) for gram in _trigrams(term)), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        else:
+            # Shorter than a trigram: any trigram (or short title) holding
+            # the term may match. There are far fewer of these than videos.
+            candidates = set().union(
+                *(self._posting(gram) for gram in list(self._grams) if term in gram))
+
+        lower_titles = self._lower_titles
+        return [v for v in candidates if term in lower_titles.get(v, "")]
+
+
+# In[ ]:
+
+
+"""A binary snapshot of the parsed video catalog, so that starting up does
+not have to parse videos.txt again."""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+from array import array
+from pathlib import Path
+
+_SNAPSHOT_MAGIC = b"YTVS"
+_SNAPSHOT_VERSION = 3
+# magic, format version, source mtime (ns), source size, source sha256
+_SNAPSHOT_HEADER = struct.Struct("<4sHqq32s")
+# The length of the JSON part that follows the header.
+_SNAPSHOT_LENGTH = struct.Struct("<Q")
+
+
+def snapshot_path(source: Path) -> Path:
+    """The snapshot lives next to the file it was made from."""
+    return source.with_name(source.name + ".snapshot")
+
+
+def source_fingerprint(source: Path):
+    """Returns (mtime, size, sha256) of the source file."""
+    stat = os.stat(source)
+    digest = hashlib.sha256()
+    with open(source, "rb") as source_file:
+        for block in iter(lambda: source_file.read(1 << 20), b""):
+            digest.update(block)
+    return stat.st_mtime_ns, stat.st_size, digest.digest()
+
+
+def load_snapshot(source: Path):
+    """Returns the catalog saved for `source`, or None if there is no
+    snapshot or it no longer matches the source file. The cheap mtime and
+    size checks come first; the file is only hashed if those match.
+    """
+    try:
+        stat = os.stat(source)
+        with open(snapshot_path(source), "rb") as snapshot_file, \
+                mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) < _SNAPSHOT_HEADER.size:
+                return None
+            magic, version, mtime, size, digest = _SNAPSHOT_HEADER.unpack_from(data)
+            if (magic, version, mtime, size) != (
+                    _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, stat.st_mtime_ns, stat.st_size):
+                return None
+            if digest != source_fingerprint(source)[2]:
+                return None
+            view = memoryview(data)[_SNAPSHOT_HEADER.size:]
+            try:
+                return _unpack_catalog(view)
+            finally:
+                view.release()
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        # No snapshot, an empty one or a damaged one: parse from scratch.
+        return None
+
+
+def write_snapshot(source: Path, fingerprint, catalog):
+    """Saves the catalog next to `source`. The fingerprint must be taken
+    before the source was parsed, so an edit made while parsing makes the
+    snapshot stale instead of wrong. Failing to write is not an error, the
+    next start simply parses again.
+    """
+    path = snapshot_path(source)
+    temp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    try:
+        with open(temp_path, "wb") as snapshot_file:
+            snapshot_file.write(_SNAPSHOT_HEADER.pack(
+                _SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, *fingerprint))
+            snapshot_file.writelines(_pack_catalog(catalog))
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def _pack_catalog(catalog):
+    """Yields the catalog as bytes: the rows, sort keys and posting names
+    as JSON, then every posting's arrays as they are in memory. Only data
+    is stored, so reading a snapshot can't run any code (pickle could).
+    """
+    grams, terms = catalog["grams"], catalog["terms"]
+    header = json.dumps({
+        "rows": catalog["rows"],
+        "keys": catalog["keys"],
+        "grams": [[gram, len(rows)] for gram, rows in grams.items()],
+        "terms": [[term, len(rows)] for term, (rows, _) in terms.items()],
+    }, separators=(",", ":")).encode()
+    yield _SNAPSHOT_LENGTH.pack(len(header))
+    yield header
+    for rows in grams.values():
+        yield rows.tobytes()
+    for rows, weights in terms.values():
+        yield rows.tobytes()
+        yield weights.tobytes()
+
+
+def _unpack_catalog(data):
+    """The reverse of _pack_catalog, reading from a memoryview. Raises
+    ValueError, KeyError, TypeError or struct.error if the data is not
+    what _pack_catalog wrote."""
+    (length,) = _SNAPSHOT_LENGTH.unpack_from(data)
+    start = _SNAPSHOT_LENGTH.size
+    header = json.loads(data[start:start + length].tobytes())
+    position = start + length
+
+    def take(typecode, count):
+        nonlocal position
+        values = array(typecode)
+        end = position + count * values.itemsize
+        if count < 0 or end > len(data):
+            raise ValueError("Snapshot is truncated")
+        values.frombytes(data[position:end])
+        position = end
+        return values
+
+    grams = {gram: take("I", count) for gram, count in header["grams"]}
+    terms = {term: (take("I", count), take("d", count))
+             for term, count in header["terms"]}
+    if position != len(data):
+        raise ValueError("Snapshot has data left over")
+    rows, keys = header["rows"], header["keys"]
+    if len(keys) != len(rows):
+        raise ValueError("Snapshot keys don't match its rows")
+    # Rows are (title, video id, [tags]) and the keys strings, like
+    # _catalog saves them; anything else has to be parsed again.
+    if not (all(type(title) is str and type(video_id) is str and type(tags) is list
+                for title, video_id, tags in rows)
+            and all(type(tag) is str for _, _, tags in rows for tag in tags)
+            and all(type(key) is str for key in keys)):
+        raise TypeError("Snapshot rows are not what the catalog saves")
+    if len({video_id for _, video_id, _ in rows}) != len(rows):
+        raise ValueError("Snapshot has a video id twice")
+    # The positions are only looked up once a search needs them, too late
+    # to fall back to parsing, so check them now.
+    postings = [*grams.values(), *(positions for positions, _ in terms.values())]
+    if max(map(max, filter(None, postings)), default=-1) >= len(rows):
+        raise ValueError("Snapshot has a position past its rows")
+    return {"rows": rows, "keys": keys, "grams": grams, "terms": terms}
+
+
+# In[ ]:
+
+
+"""Title search spread over several processes, for very large catalogs."""
+
+import re
+import weakref
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+from multiprocessing import shared_memory
+
+# Catalogs smaller than this are searched in this process only: starting
+# processes and merging their results costs more than it saves.
+SHARDED_SEARCH_THRESHOLD = 1_000_000
+
+# Shared memory segments the worker processes have attached to, by name.
+_attached_segments = {}
+
+
+def _attach(name):
+    segment = _attached_segments.get(name)
+    if segment is None:
+        # Workers share the parent's resource tracker, which unlinks the
+        # segment once, when the parent is done with it.
+        segment = _attached_segments[name] = shared_memory.SharedMemory(name=name)
+    return segment
+
+
+def _search_shard(blob_name, offsets_name, needle, first_row, end_row):
+    """Runs in a worker process. Finds the rows from first_row up to end_row
+    whose text contains needle, straight from shared memory, and returns
+    their numbers in order."""
+    blob = _attach(blob_name).buf
+    offsets = _attach(offsets_name).buf.cast("q")
+    pattern = re.compile(re.escape(needle))
+    rows = array("q")
+    position, end = offsets[first_row], offsets[end_row]
+    # An empty needle matches at `end` too, so stop there rather than on
+    # the first miss.
+    while position < end:
+        match = pattern.search(blob, position, end)
+        if match is None:
+            break
+        row = bisect_right(offsets, match.start(), first_row, end_row) - 1
+        rows.append(row)
+        # One match per row is enough, carry on from the next row.
+        position = offsets[row + 1]
+    return rows
+
+
+def _release(pool, segments):
+    pool.shutdown(wait=False, cancel_futures=True)
+    for segment in segments:
+        segment.close()
+        segment.unlink()
+
+
+class ShardedSearch:
+    """Searches the lower case titles of a catalog with a pool of processes.
+    The titles are copied once into shared memory, one per line, and each
+    worker scans its own range of rows, so nothing but the search term and
+    the matching row numbers is sent between processes. Rows are in the
+    order of the videos given, so putting the shards' results one after
+    the other keeps that order.
+    """
+
+    def __init__(self, videos, workers):
+        self._videos = list(videos)
+        titles = [video.title.lower().encode() + b"\n" for video in self._videos]
+        offsets = array("q", accumulate((len(title) for title in titles), initial=0))
+
+        self._blob = self._share(b"".join(titles))
+        self._offsets = self._share(offsets.tobytes())
+        row_count = len(self._videos)
+        self._shards = [
+            (row_count * i // workers, row_count * (i + 1) // workers)
+            for i in range(workers)
+        ]
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._finalizer = weakref.finalize(
+            self, _release, self._pool, (self._blob, self._offsets))
+
+    @staticmethod
+    def _share(data):
+        # A segment can't be empty.
+        segment = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        segment.buf[:len(data)] = data
+        return segment
+
+    def search(self, term: str):
+        """Returns the videos whose lower case title contains the lower
+        case term, in order."""
+        if "\n" in term:
+            return []
+        if not term:
+            return list(self._videos)
+        futures = [
+            self._pool.submit(_search_shard, self._blob.name, self._offsets.name,
+                              term.encode(), first_row, end_row)
+            for first_row, end_row in self._shards if first_row < end_row
+        ]
+        videos = self._videos
+        return [videos[row] for future in futures for row in future.result()]
+
+    def close(self):
+        """Stops the workers and frees the shared memory."""
+        self._finalizer()
+
+
 # In[14]:
 
 
@@ -287,8 +2168,22 @@ class Video:
 from typing import Sequence, Optional
 
 import csv
+import gc
+import heapq
+import io
+import mmap
+import os
 import random
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from operator import itemgetter
 from pathlib import Path
+from .video_metrics import METRICS
 
 get_ipython().run_line_magic('pip', 'install Video')
 
@@ -299,34 +2194,519 @@ def _csv_reader_with_strip(reader):
     yield from ((item.strip() for item in line) for line in reader)
 
 
+def _parse_rows(lines):
+    """Yields (title, video_id, tags) for every row of videos.txt. A row
+    without three fields raises ValueError."""
+    reader = _csv_reader_with_strip(csv.reader(lines, delimiter="|"))
+    for video_info in reader:
+        title, url, tags = video_info
+        yield title, url, [tag.strip() for tag in tags.split(",")] if tags else []
+
+
+def _read_catalog(path, workers=0):
+    """Yields (title, video_id, tags) for every row of videos.txt, parsed
+    by `workers` processes if not 0 (see _read_catalog_parallel)."""
+    if workers:
+        yield from _read_catalog_parallel(path, workers)
+        return
+    with open(path) as video_file:
+        yield from _parse_rows(video_file)
+
+
+# Catalog files smaller than this are parsed in this process only:
+# starting the processes and sending the rows back costs more than it saves.
+PARALLEL_LOAD_THRESHOLD = 64 << 20
+# Each worker gets a few chunks, so one slow chunk doesn't hold the rest up.
+_CHUNKS_PER_WORKER = 4
+
+
+def _chunk_bounds(data, chunks):
+    """Splits data into about `chunks` byte ranges that each end with a
+    line."""
+    size = len(data)
+    bounds = [0]
+    for i in range(1, chunks):
+        end = data.find(b"\n", max(size * i // chunks, bounds[-1]))
+        if end == -1:
+            break
+        bounds.append(end + 1)
+    if bounds[-1] < size:
+        bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def _parse_chunk(path, start, end):
+    """Runs in a worker process. Parses the rows between two byte offsets
+    of the file, mapped rather than read, and returns them as a list.
+    Equal tags are made the same string, so they are pickled once."""
+    with open(path, "rb") as video_file, \
+            mmap.mmap(video_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # Decoded and split into lines exactly like open(path) would.
+        lines = io.TextIOWrapper(io.BytesIO(data[start:end]))
+    tags_seen = {}
+    return [(title, url, [tags_seen.setdefault(tag, tag) for tag in tags])
+            for title, url, tags in _parse_rows(lines)]
+
+
+def _read_catalog_parallel(path, workers):
+    """Like _read_catalog, with the file split into chunks on line
+    boundaries and the chunks parsed by a pool of `workers` processes.
+    Rows come back in file order, and a malformed row raises the same
+    ValueError, the one of the first malformed row in the file.
+    Only the offsets go to the workers, each maps the file itself.
+    A quoted field spanning lines is not supported here.
+    """
+    with open(path, "rb") as video_file:
+        if os.fstat(video_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(video_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunks = _chunk_bounds(data, workers * _CHUNKS_PER_WORKER)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_parse_chunk, path, start, end) for start, end in chunks]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
 class VideoLibraryError(Exception):
     pass
 
 
+class LoadProgress:
+    """How far loading a VideoLibrary has got, for the STATUS command. The
+    loading thread writes it, anyone may read it."""
+
+    def __init__(self):
+        self.stage = "starting"
+        # Videos read so far, updated every few thousand rows.
+        self.videos = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        self.error = None
+
+    def finish(self, videos: int, error: Exception = None):
+        self.videos = videos
+        self.error = error
+        self.stage = "failed" if error is not None else "ready"
+        self.finished = time.perf_counter()
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds spent loading so far, or in total once done."""
+        return (self.finished or time.perf_counter()) - self.started
+
+
+@contextmanager
+def _gc_paused():
+    """Loading creates millions of objects that all stay alive, so letting
+    the garbage collector scan them over and over only slows the load down.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def _sort_key(video):
+    """The order videos are listed in. This is how an unflagged video
+    prints, so flagging a video never moves it around."""
+    return f'{video.title} ({video.video_id}) [{video.tags_string}]'
+
+
+class QueryCache:
+    """Remembers the results of the last `size` queries, dropping the least
+    recently used one when full. Every result is stored with the library
+    generation it was computed at, and a result from an older generation
+    is never returned, so a flag or a reload invalidates the whole cache
+    without touching it. Results are tuples, so whoever gets one can't
+    change it for the next caller.
+    """
+
+    def __init__(self, size=1024):
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        """Returns the cached result, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, result):
+        if self._size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (generation, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "entries": len(self),
+                "size": self._size}
+
+
 class VideoLibrary:
     """A class used to represent a Video Library."""
 
-    def __init__(self):
-        """The VideoLibrary class is initialized."""
+    def __init__(self, seed=None, path=None, use_snapshot=True,
+                 search_workers=0, shard_threshold=SHARDED_SEARCH_THRESHOLD,
+                 cache_size=1024, progress=None, load_workers=0,
+                 parallel_load_threshold=PARALLEL_LOAD_THRESHOLD):
+        """The VideoLibrary class is initialized.
+        Args:
+            seed: Optional seed for PLAY_RANDOM, so runs can be repeated.
+            path: The catalog file, videos.txt next to this file by default.
+            use_snapshot: Load from (and save) a parsed snapshot of the
+                catalog next to the file, instead of parsing every time.
+            search_workers: If not 0, title searches on catalogs of at least
+                shard_threshold videos are spread over this many processes.
+            shard_threshold: See search_workers.
+            cache_size: How many search and tag results to remember, 0
+                to not remember any.
+            progress: A LoadProgress to keep up to date while loading.
+            load_workers: If not 0, catalog files of at least
+                parallel_load_threshold bytes are parsed by this many
+                processes, when loading and reloading.
+            parallel_load_threshold: See load_workers.
+        """
+        self._path = Path(path) if path is not None else Path(__file__).parent / "videos.txt"
+        self._rng = random.Random(seed)
+        # Readers never take this lock: every index swaps in new data
+        # instead of changing what a reader may be looking at. Only
+        # changes (flags) are serialized by it.
+        self._write_lock = threading.RLock()
+        # Bumped on every change, so callers can tell their results are old.
+        self._generation = 0
+        self._search_workers = search_workers
+        self._shard_threshold = shard_threshold
+        self._load_workers = load_workers
+        self._parallel_load_threshold = parallel_load_threshold
+        self._sharded_search = None
+        self._cache = QueryCache(cache_size)
+        # Built on the first tag query that needs it, see _get_bitmaps.
+        self._bitmaps = None
+        # Weak references to the callables told about videos a reload
+        # took out, so a player that is gone isn't kept alive by us.
+        self._removal_listeners = []
+
+        progress = progress if progress is not None else LoadProgress()
+        with _gc_paused(), METRICS.phase("library.load"):
+            progress.stage = "reading snapshot"
+            catalog = load_snapshot(self._path) if use_snapshot else None
+            if catalog is not None:
+                self._load_catalog(catalog)
+            else:
+                progress.stage = "parsing"
+                fingerprint = source_fingerprint(self._path) if use_snapshot else None
+                self._parse(self._path, progress)
+                if use_snapshot:
+                    progress.stage = "writing snapshot"
+                    write_snapshot(self._path, fingerprint, self._catalog())
+            progress.stage = "indexing"
+            progress.videos = len(self._videos)
+
+            self._allowed = self._all.filter(lambda v: not v.is_flagged)
+            # Only allowed videos are indexed by tag, flagged ones never show
+            # up in a tag search.
+            self._tags = TagIndex(self._key_of, self._allowed)
+            self._random_pool = RandomSet(self._allowed.view())
+            # One bound method for all the videos, not one each.
+            self._flag_listener = self._on_flag_changed
+            for video in self._videos.values():
+                video.set_flag_listener(self._flag_listener)
+
+    def _parse(self, path, progress):
+        """Reads the catalog from videos.txt and builds the sorted list and
+        title index."""
         self._videos = {}
-        with open(Path(__file__).parent / "videos.txt") as video_file:
-            reader = _csv_reader_with_strip(
-                csv.reader(video_file, delimiter="|"))
-            for video_info in reader:
-                title, url, tags = video_info
-                self._videos[url] = Video(
-                    title,
-                    url,
-                    [tag.strip() for tag in tags.split(",")] if tags else [],
-                )
-
-    def get_all_videos(self) -> Sequence[Video]:
-        """Returns all available video information from the video library."""
-        return list(sorted(self._videos.values(), key=str))
+        for title, url, tags in self._catalog_rows(path):
+            self._videos[url] = Video(title, url, tags)
+            if not len(self._videos) & 0xfff:
+                progress.videos = len(self._videos)
+
+        # Work out every sort key once and keep the sorted lists up to
+        # date from here on, instead of sorting on every request.
+        self._sort_keys = {
+            video_id: _sort_key(video)
+            for video_id, video in self._videos.items()
+        }
+        self._all = SortedVideoList(self._key_of, self._videos.values())
+        # Titles are indexed whether or not they are flagged, since the
+        # title never changes; flags are checked when searching.
+        self._titles = TitleIndex(self._videos.values())
+        self._terms = TermIndex(self._videos.values())
+
+    def _catalog_rows(self, path):
+        workers = self._load_workers
+        if workers and os.path.getsize(path) < self._parallel_load_threshold:
+            workers = 0
+        return _read_catalog(path, workers)
+
+    def _catalog(self):
+        """The parsed catalog in the form write_snapshot saves it."""
+        videos = self._all.view()
+        positions = {video: i for i, video in enumerate(videos)}
+        return {
+            "rows": [(v.title, v.video_id, tuple(v.tags)) for v in videos],
+            "keys": list(self._all.keys()),
+            "grams": self._titles.to_snapshot(positions),
+            "terms": self._terms.to_snapshot(positions),
+        }
+
+    def _load_catalog(self, catalog):
+        """The reverse of _catalog: nothing needs to be parsed or sorted."""
+        videos = [Video(title, url, tags) for title, url, tags in catalog["rows"]]
+        self._videos = {video.video_id: video for video in videos}
+        self._sort_keys = dict(zip(self._videos, catalog["keys"]))
+        self._all = SortedVideoList.presorted(self._key_of, catalog["keys"], videos)
+        self._titles = TitleIndex.from_snapshot(videos, catalog["grams"])
+        self._terms = TermIndex.from_snapshot(videos, catalog["terms"])
+
+    def _key_of(self, video):
+        return self._sort_keys[video.video_id]
+
+    def sort_key(self, video: Video) -> str:
+        """The key the library sorts the video by. Pass it as `after` to get
+        the page of videos that follows it."""
+        return self._key_of(video)
+
+    def _on_flag_changed(self, video):
+        """Keeps the allowed indexes in step when a video is (un)flagged."""
+        with self._write_lock:
+            if video.is_flagged:
+                self._allowed.remove(video)
+                self._tags.remove(video)
+                self._random_pool.remove(video)
+            else:
+                self._allowed.add(video)
+                self._tags.add(video)
+                self._random_pool.add(video)
+            if self._bitmaps is not None:
+                self._bitmaps.set_allowed([self._all.index(video)], not video.is_flagged)
+            self._generation += 1
+
+    def add_removal_listener(self, listener):
+        """Registers a method to be called with the list of videos every
+        time a reload takes videos out of the library. Only a weak
+        reference is kept. Listeners that are gone are dropped here, so a
+        server opening many sessions doesn't keep a reference for each."""
+        with self._write_lock:
+            self._removal_listeners = [
+                reference for reference in self._removal_listeners
+                if reference() is not None]
+            self._removal_listeners.append(weakref.WeakMethod(listener))
+
+    def reload(self):
+        """Reads the catalog file again and applies only what changed:
+        new rows are added, missing ones removed and rows whose title or
+        tags differ are updated in place, keeping their flag. The indexes
+        are updated for those videos only.
+        Returns the (added, removed, changed) lists of videos.
+        Raises OSError or ValueError if the file can't be read, and then
+        nothing changes.
+        """
+        with _gc_paused():
+            rows = {url: (title, tags) for title, url, tags in self._catalog_rows(self._path)}
+        # Comparing every row makes a tuple or two per video, and a pause
+        # keeps those from setting off collections over the whole library.
+        with self._write_lock, _gc_paused(), METRICS.phase("library.reload"):
+            videos = self._videos
+            removed = [video for video_id, video in videos.items()
+                       if video_id not in rows]
+            added = []
+            changed = []
+            for video_id, (title, tags) in rows.items():
+                video = videos.get(video_id)
+                if video is None:
+                    added.append(Video(title, video_id, tags))
+                elif video.title != title or tuple(video.tags) != tuple(tags):
+                    changed.append(video)
+            if not (added or removed or changed):
+                return added, removed, changed
+
+            # Everything leaving an index leaves while it still has its old
+            # title, tags and sort key.
+            leaving = removed + changed
+            allowed_leaving = [v for v in leaving if not v.is_flagged]
+            self._tags.update(remove=allowed_leaving)
+            for video in allowed_leaving:
+                self._random_pool.remove(video)
+            self._titles.update(remove=leaving)
+            self._terms.update(remove=leaving)
+
+            for video in removed:
+                video.set_flag_listener(None)
+                del videos[video.video_id]
+                del self._sort_keys[video.video_id]
+            for video in changed:
+                video.update(*rows[video.video_id])
+            for video in added:
+                videos[video.video_id] = video
+                video.set_flag_listener(self._flag_listener)
+            arriving = changed + added
+            for video in arriving:
+                self._sort_keys[video.video_id] = _sort_key(video)
+            self._titles.update(add=arriving)
+            self._terms.update(add=arriving)
+
+            allowed_arriving = [v for v in arriving if not v.is_flagged]
+            self._all.update(leaving, arriving)
+            self._allowed.update(allowed_leaving, allowed_arriving)
+            self._tags.update(add=allowed_arriving)
+            for video in allowed_arriving:
+                self._random_pool.add(video)
+            # The worker processes have the old catalog. Searches still
+            # running keep the old one until they are done.
+            self._sharded_search = None
+            # The rows of the bitmaps are positions in the old order.
+            self._bitmaps = None
+            self._generation += 1
+
+        if removed:
+            for reference in self._removal_listeners:
+                listener = reference()
+                if listener is not None:
+                    listener(removed)
+        return added, removed, changed
+
+    @property
+    def generation(self):
+        """A number that changes whenever the library changes."""
+        return self._generation
+
+    @property
+    def path(self) -> Path:
+        """The catalog file."""
+        return self._path
+
+    def flag_video(self, video_id: str, flag_reason: str) -> Video:
+        """Flags a video. Safe to call from several threads at once, unlike
+        calling Video.flag directly, where two threads could both see the
+        video as not flagged yet.
+        Raises VideoLibraryError or FlagError.
+        """
+        with self._write_lock:
+            video = self[video_id]
+            video.flag(flag_reason)
+            return video
+
+    def allow_video(self, video_id: str) -> Video:
+        """Removes the flag from a video, see flag_video.
+        Raises VideoLibraryError or FlagError.
+        """
+        with self._write_lock:
+            video = self[video_id]
+            video.unflag()
+            return video
+
+    def find_videos(self, video_ids):
+        """Looks up many video ids in one pass. Ids given more than once
+        count once. Returns the list of videos found and the list of ids
+        that are not in the library, both in the order given."""
+        videos = self._videos
+        found = []
+        missing = []
+        for video_id in dict.fromkeys(video_ids):
+            video = videos.get(video_id)
+            if video is None:
+                missing.append(video_id)
+            else:
+                found.append(video)
+        return found, missing
+
+    def flag_videos(self, video_ids, flag_reason: str):
+        """Flags many videos with one update of the indexes, instead of one
+        per video like flag_video.
+        Returns the videos flagged, the ids not in the library and the
+        videos that were flagged already.
+        """
+        with self._write_lock:
+            found, missing = self.find_videos(video_ids)
+            flagged = [video for video in found if not video.is_flagged]
+            skipped = [video for video in found if video.is_flagged]
+            for video in flagged:
+                video.flag(flag_reason, notify=False)
+            self._set_allowed(flagged, False)
+            return flagged, missing, skipped
+
+    def allow_videos(self, video_ids):
+        """Removes the flag from many videos, see flag_videos.
+        Returns the videos allowed, the ids not in the library and the
+        videos that were not flagged.
+        """
+        with self._write_lock:
+            found, missing = self.find_videos(video_ids)
+            allowed = [video for video in found if video.is_flagged]
+            skipped = [video for video in found if not video.is_flagged]
+            for video in allowed:
+                video.unflag(notify=False)
+            self._set_allowed(allowed, True)
+            return allowed, missing, skipped
+
+    def _set_allowed(self, videos, allowed: bool):
+        """Adds videos to the allowed indexes or takes them out, rebuilding
+        each index once. Call with the write lock held."""
+        if not videos:
+            return
+        if allowed:
+            self._allowed.update(add=videos)
+            self._tags.update(add=videos)
+            for video in videos:
+                self._random_pool.add(video)
+        else:
+            self._allowed.update(remove=videos)
+            self._tags.update(remove=videos)
+            for video in videos:
+                self._random_pool.remove(video)
+        if self._bitmaps is not None:
+            self._bitmaps.set_allowed([self._all.index(video) for video in videos], allowed)
+        self._generation += 1
+
+    def __len__(self):
+        return len(self._videos)
+
+    def get_all_videos(self, after=None, offset=0, limit=None) -> Sequence[Video]:
+        """Returns all available video information from the video library,
+        as a read-only view in sorted order. With any of the arguments,
+        returns just that page of it.
+        Args:
+            after: A sort key (see sort_key), to start after that video.
+            offset: How many videos to skip.
+            limit: How many videos to return, all if None.
+        """
+        if after is None and not offset and limit is None:
+            return self._all.view()
+        return self._all.page(after, offset, limit)
 
     def get_allowed_videos(self) -> Sequence[Video]:
-        """Returns all allowed videos in the library."""
-        return [v for v in self.get_all_videos() if not v.is_flagged]
+        """Returns all allowed videos in the library, as a read-only view in
+        sorted order."""
+        return self._allowed.view()
 
     def __getitem__(self, video_id):
         """This is a way to make the Video library behave like a python
@@ -354,21 +2734,216 @@ class VideoLibrary:
         If there are no videos available (e.g. all of them are flagged or
         something else happened) we return None.
         """
+        video = self._random_pool.choice(self._rng)
+        return video.video_id if video is not None else None
+
+    def search_videos(self, search_term: str, after=None, offset=0, limit=None):
+        """Search through all the titles (in lower case) and return the allowed
+        videos whose title contains the search term, in sorted order, as
+        a tuple. The other arguments ask for one page of the results, like
+        in get_all_videos; only the videos up to the end of the page are
+        sorted. Results are cached until the library changes."""
+        search_term = search_term.lower()
+        key = ("search", search_term, after, offset, limit)
+        generation = self._generation
+        results = self._cache.get(key, generation)
+        if results is None:
+            results = tuple(self._search(search_term, after, offset, limit))
+            self._cache.put(key, generation, results)
+        return results
+
+    def search_ranked(self, query: str, k: int = 10):
+        """Returns the k allowed videos that best match the words of the
+        query, best first, as a tuple. Videos match on whole words of their
+        title and tags, and the score favours rare words and short titles
+        (see TermIndex). Only the best k are ever sorted. Results are
+        cached like searches."""
+        terms = tuple(sorted(set(tokenize(query))))
+        key = ("ranked", terms, k)
+        generation = self._generation
+        results = self._cache.get(key, generation)
+        if results is None:
+            with METRICS.phase("ranked.score"):
+                scores = self._terms.scores(terms)
+            key_of = self._key_of
+            with METRICS.phase("ranked.top_k"):
+                allowed = [(score, v) for v, score in scores.items()
+                           if not v.is_flagged]
+                top = heapq.nlargest(k, allowed, key=itemgetter(0))
+                # Ties go in library order, so the results don't change
+                # from one run to the next. Only the videos scoring at
+                # least as much as the k-th need their sort keys.
+                cutoff = top[-1][0] if top else 0.0
+                results = tuple(heapq.nsmallest(
+                    k, (v for score, v in allowed if score >= cutoff),
+                    key=lambda v: (-scores[v], key_of(v))))
+            self._cache.put(key, generation, results)
+        return results
+
+    def _search(self, search_term, after, offset, limit):
+        key_of = self._key_of
+        sharded_search = self._get_sharded_search(search_term)
+        if sharded_search is not None:
+            results = [v for v in sharded_search.search(search_term)
+                       if not v.is_flagged and (after is None or key_of(v) > after)]
+            return results[offset:] if limit is None else results[offset:offset + limit]
+        with METRICS.phase("search.index"):
+            matches = self._titles.search(search_term)
+        with METRICS.phase("search.filter"):
+            results = [v for v in matches
+                       if not v.is_flagged and (after is None or key_of(v) > after)]
+        with METRICS.phase("search.sort"):
+            if limit is None:
+                results.sort(key=key_of)
+                return results[offset:] if offset else results
+            return heapq.nsmallest(offset + limit, results, key=key_of)[offset:]
+
+    def _get_sharded_search(self, search_term):
+        """Returns the ShardedSearch to use for this term, or None to use the
+        title index. The index wins unless the catalog is big and the term
+        is so common (or short) that a good part of the catalog would have
+        to be checked anyway."""
+        if not self._search_workers or len(self._videos) < self._shard_threshold:
+            return None
+        # Every video matches an empty term, the index has them all at hand.
+        if not search_term:
+            return None
+        if self._titles.estimate(search_term) * self._search_workers < len(self._videos):
+            return None
+        if self._sharded_search is None:
+            with self._write_lock:
+                if self._sharded_search is None:
+                    self._sharded_search = ShardedSearch(
+                        self._all.view(), self._search_workers)
+        return self._sharded_search
+
+    def close(self):
+        """Frees the processes and shared memory used by sharded search, if
+        any. The library can still be used afterwards."""
+        with self._write_lock:
+            if self._sharded_search is not None:
+                self._sharded_search.close()
+                self._sharded_search = None
+
+    def get_videos_with_tag(self, tag: str, after=None, offset=0, limit=None):
+        """Return all allowed videos whose tags contain the search tag, from
+        the tag index. Tags were stripped when loaded so we strip the search
+        tag the same way. The other arguments ask for one page of the
+        videos, like in get_all_videos. Results are cached like searches."""
+        tag = tag.strip()
+        key = ("tag", tag, after, offset, limit)
+        generation = self._generation
+        results = self._cache.get(key, generation)
+        if results is None:
+            with METRICS.phase("tag.lookup"):
+                if after is None and not offset and limit is None:
+                    results = self._tags.get(tag)
+                else:
+                    results = self._tags.page(tag, after, offset, limit)
+            self._cache.put(key, generation, results)
+        return results
+
+    def query_tags(self, query: str, after=None, offset=0, limit=None):
+        """Returns the allowed videos matching a tag query such as
+        "#cat AND #funny NOT #dog" (see parse_tag_query), in sorted order,
+        as a tuple. The other arguments ask for one page, like in
+        get_all_videos. Raises TagQueryError if the query is not valid.
+        Results are cached like searches."""
+        parsed = parse_tag_query(query)
+        key = ("tags", format_tag_query(parsed), after, offset, limit)
+        generation = self._generation
+        results = self._cache.get(key, generation)
+        if results is None:
+            with METRICS.phase("tag.bitmaps"):
+                bitmaps = self._get_bitmaps()
+                bitmap = evaluate_tag_query(parsed, bitmaps) & bitmaps.allowed
+            start = 0 if after is None else self._all.position_after(after)
+            stop = None if limit is None else offset + limit
+            results = tuple(islice(bitmaps.videos(bitmap, start), offset, stop))
+            self._cache.put(key, generation, results)
+        return results
+
+    def _get_bitmaps(self):
+        bitmaps = self._bitmaps
+        if bitmaps is None:
+            with self._write_lock:
+                if self._bitmaps is None:
+                    self._bitmaps = TagBitmaps(self._all.view())
+                bitmaps = self._bitmaps
+        return bitmaps
+
+    def cache_stats(self):
+        """The hits, misses and evictions of the query cache, and how many
+        results it holds out of how many it can."""
+        return self._cache.stats()
+
+
+# In[ ]:
+
+
+"""Reloads a video library when its catalog file changes."""
+
+import os
+import threading
+
+
+class CatalogWatcher:
+    """Watches the catalog file of a VideoLibrary and reloads the library
+    when the file's size or modification time changes. Either call check()
+    from a loop of your own, or start() a thread that calls it every
+    `interval` seconds.
+    Args:
+        videos: The VideoLibrary.
+        interval: Seconds between checks, for start().
+        on_reload: Called with (added, removed, changed) after a reload
+            that changed something.
+    """
+
+    def __init__(self, videos, interval=1.0, on_reload=None):
+        self._videos = videos
+        self._interval = interval
+        self._on_reload = on_reload
+        self._stamp = self._file_stamp()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _file_stamp(self):
+        try:
+            status = os.stat(self._videos.path)
+        except OSError:
+            return None
+        return status.st_mtime_ns, status.st_size
+
+    def check(self):
+        """Reloads the library if the file changed since the last check.
+        A file that can't be read (e.g. because it is half written) is
+        skipped until it changes again. Returns what reload returned, or
+        None if nothing was reloaded."""
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return None
+        self._stamp = stamp
         try:
-            return random.choice([video.video_id for video in self.get_allowed_videos()])
-        except IndexError:
+            result = self._videos.reload()
+        except (OSError, ValueError):
             return None
+        if self._on_reload is not None and any(result):
+            self._on_reload(*result)
+        return result
 
-    def search_videos(self, search_term: str):
-        """Search through all the titles (in lower case) and return if the title
-        contains the search term."""
-        search_term = search_term.lower()
-        return [v for v in self.get_allowed_videos() if search_term in v.title.lower()]
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name="catalog-watcher",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
 
-    def get_videos_with_tag(self, tag: str):
-        """Search through all the tags and return all videos whose tags
-        contain the search tag."""
-        return [v for v in self.get_allowed_videos() if tag in v.tags]
+    def _watch(self):
+        while not self._stopped.wait(self._interval):
+            self.check()
 
 
 # In[15]:
@@ -431,66 +3006,591 @@ class VideoPlayback:
             raise VideoPlaybackError("No video is currently playing")
 
 
+# In[ ]:
+
+
+"""Output produced by the video player, and the sinks it can be sent to."""
+
+import json
+import sys
+
+
+class Output:
+    """One message produced by a command. The text is only formatted when a
+    sink asks for it, so sinks that don't need text skip the formatting.
+    Args:
+        event: A short machine readable name, e.g. "playing".
+        template: The text shown to a user, formatted with the fields, or
+            None if there is no text apart from the videos.
+        videos: Videos listed after the text, if any.
+        item_template: How each listed video is shown, using {number}
+            and {video}.
+        start: The number of the first listed video, more than 1 when the
+            videos are a later page of a longer list.
+        error: The name of the error, if this message reports one.
+        fields: The values the template refers to.
+    """
+
+    __slots__ = ("event", "template", "videos", "item_template", "start",
+                 "error", "fields")
+
+    def __init__(self, event, template=None, videos=None,
+                 item_template="{video}", start=1, error=None, **fields):
+        self.event = event
+        self.template = template
+        self.videos = videos
+        self.item_template = item_template
+        self.start = start
+        self.error = error
+        self.fields = fields
+
+    def lines(self):
+        """Yields the text lines of this message."""
+        if self.template is not None:
+            yield self.template.format(**self.fields)
+        if self.videos is not None:
+            for number, video in enumerate(self.videos, start=self.start):
+                yield self.item_template.format(number=number, video=video)
+
+    def to_dict(self):
+        """The message as plain data, for serializing."""
+        data = {"event": self.event}
+        for name, value in self.fields.items():
+            data[name] = _video_to_dict(value) if isinstance(value, Video) else value
+        if self.videos is not None:
+            data["videos"] = [_video_to_dict(video) for video in self.videos]
+            if self.start != 1:
+                data["start"] = self.start
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+def _video_to_dict(video):
+    return {
+        "video_id": video.video_id,
+        "title": video.title,
+        "tags": list(video.tags),
+        "flagged": video.is_flagged,
+    }
+
+
+class CommandResult:
+    """What a single command did: every message it produced and the value
+    it came up with (the video played, the search results, ...)."""
+
+    __slots__ = ("command", "outputs", "value")
+
+    def __init__(self, command):
+        self.command = command
+        self.outputs = []
+        self.value = None
+
+    @property
+    def ok(self):
+        """False if the command reported an error."""
+        return all(output.error is None for output in self.outputs)
+
+    def to_dict(self):
+        return {
+            "command": self.command,
+            "ok": self.ok,
+            "outputs": [output.to_dict() for output in self.outputs],
+        }
+
+
+class OutputSink:
+    """Receives the output of a VideoPlayer."""
+
+    def write(self, output: Output):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class StdoutSink(OutputSink):
+    """Prints every message straight away. This is the default."""
+
+    def write(self, output):
+        for line in output.lines():
+            print(line)
+
+
+class BufferedSink(OutputSink):
+    """Collects the text and writes it to `stream` in blocks of about
+    `block_size` characters."""
+
+    def __init__(self, stream=None, block_size=1 << 16):
+        self._stream = stream if stream is not None else sys.stdout
+        self._block_size = block_size
+        self._pending = []
+        self._size = 0
+
+    def write(self, output):
+        for line in output.lines():
+            self._pending.append(line)
+            self._pending.append("\n")
+            self._size += len(line) + 1
+        if self._size >= self._block_size:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._stream.write("".join(self._pending))
+            self._pending.clear()
+            self._size = 0
+        self._stream.flush()
+
+
+class CollectorSink(OutputSink):
+    """Keeps the messages in memory, e.g. to look at them in code."""
+
+    def __init__(self):
+        self.outputs = []
+
+    def write(self, output):
+        self.outputs.append(output)
+
+    def text(self):
+        """All collected messages as the text a user would have seen."""
+        return "".join(
+            line + "\n" for output in self.outputs for line in output.lines())
+
+    def clear(self):
+        self.outputs.clear()
+
+
+class JsonLinesSink(OutputSink):
+    """Writes every message as one line of JSON, without formatting any
+    text."""
+
+    def __init__(self, stream=None):
+        self._stream = stream if stream is not None else sys.stdout
+
+    def write(self, output):
+        self._stream.write(json.dumps(output.to_dict()) + "\n")
+
+    def flush(self):
+        self._stream.flush()
+
+
 # In[19]:
 
 
 """A video player class."""
 
+import base64
+import collections
+import functools
+import json
 import random
-from .video_library import VideoLibrary, VideoLibraryError
+import threading
+from concurrent.futures import Future
+from .video_index import TagQueryError
+from .video_library import LoadProgress, VideoLibrary, VideoLibraryError
+from .video_metrics import METRICS
 from . import video_playlist_library
 from .video import FlagError
+from .video_output import CommandResult, Output, StdoutSink
 from .video_playlist import VideoPlaylistError
 from .video_playlist_library import VideoPlaylistLibraryError
 from .video_playback import VideoPlayback, VideoPlaybackError, PlaybackState
+from .video_journal import JournalError
 
 
 class VideoPlayerError(Exception):
     pass
 
 
-def _print_video_choice_list(videos):
-    for i, video in enumerate(videos, start=1):
-        print(f"  {i}) {video})")
+class VideosNotLoadedError(Exception):
+    """A command needs the videos, but loading them failed. The error it
+    failed with is the __cause__."""
+    pass
+
 
-    print("Would you like to play any of the above? If yes, specify the number of the video.")
-    print("If your answer is not a valid number, we will assume it's a no.")
+# How many videos SEARCH_RANKED shows without a LIMIT.
+RANKED_RESULTS = 10
 
-    user_input = input("")
 
-    try:
-        num = int(user_input)
-    except ValueError:
-        num = 0
+def _encode_cursor(position, number):
+    """Makes the cursor a page ends with: where the next page starts and
+    the number of its first video, opaque to the user."""
+    data = json.dumps([position, number], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
 
-    if 1 <= num <= len(videos):
-        return videos[num - 1]
-    else:
-        return None
+
+def _decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position, number = json.loads(data)
+    except (ValueError, TypeError):
+        raise VideoPlayerError("Invalid cursor")
+    if not isinstance(number, int) or number < 1:
+        raise VideoPlayerError("Invalid cursor")
+    return position, number
+
+
+def _read_video_ids(source, read_files=True):
+    """The video ids for a bulk command: `source` is either "@" and the
+    name of a file with the ids one per line, or the ids themselves
+    separated by commas. Ids may be separated by commas or whitespace in
+    the file too.
+    Raises OSError if the file can't be read, or PermissionError if it is
+    a file and read_files is False."""
+    if source.startswith("@"):
+        if not read_files:
+            raise PermissionError("Reading video ids from a file is not allowed")
+        with open(source[1:]) as file:
+            source = file.read()
+    return source.replace(",", " ").split()
+
+
+def _command(method):
+    """Makes a VideoPlayer method return a CommandResult with everything
+    it said. When one command runs another (PLAY stopping the current
+    video), the outer result gets the inner messages too. A command that
+    needs the videos when they failed to load says so, like STATUS."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = CommandResult(method.__name__)
+        self._results.append(result)
+        try:
+            if len(self._results) == 1:
+                self._apply_removals()
+            result.value = method(self, *args, **kwargs)
+        except VideosNotLoadedError as e:
+            if len(self._results) > 1:
+                raise
+            self._say_load_failed(e.__cause__)
+        finally:
+            self._results.pop()
+        return result
+    return wrapper
 
 
 class VideoPlayer:
     """A class used to represent a Video Player."""
 
-    def __init__(self):
-        """The VideoPlayer class is initialized."""
-        self._videos = VideoLibrary()
-        self._playlists = video_playlist_library.VideoPlaylistLibrary()
+    def __init__(self, chooser=input, sink=None, videos=None, journal=None,
+                 background=False, read_files=True, load_workers=0,
+                 search_workers=0, flush_before_choice=True):
+        """The VideoPlayer class is initialized.
+        Args:
+            chooser: Called like input("") to get the user's pick after a
+                search lists its results. If None, the search returns
+                straight away and the pick has to be given later with
+                answer_choice.
+            sink: Where the output goes, a StdoutSink by default.
+            videos: A VideoLibrary to share with other players, instead of
+                loading our own.
+            journal: A Journal to save the playlists and flags in. They are
+                restored from it straight away.
+            background: Load our own VideoLibrary (and replay the journal)
+                in a background thread and return straight away. Commands
+                that need the videos wait for them, the others don't.
+            read_files: Whether the bulk commands may read video ids from
+                a file named with "@file". A server's users may not.
+            load_workers: How many processes parse the catalog when we
+                load our own VideoLibrary, see VideoLibrary.
+            search_workers: How many processes big title searches use in
+                the VideoLibrary we load, see VideoLibrary.
+            flush_before_choice: Flush the sink before calling the chooser,
+                so someone answering sees the question. A script answering
+                doesn't need to, and buffering works better without.
+        """
+        self._playlist_library = video_playlist_library.VideoPlaylistLibrary()
         self._playback = VideoPlayback()
+        self._chooser = chooser
+        self._flush_before_choice = flush_before_choice
+        self._read_files = read_files
+        self._load_workers = load_workers
+        self._search_workers = search_workers
+        self._sink = sink if sink is not None else StdoutSink()
+        # The results of the commands currently running, innermost last.
+        self._results = []
+        # Videos a reload took out of the library, waiting for the next
+        # command to stop them and take them out of the playlists. The
+        # reload may run in another thread (a CatalogWatcher).
+        self._removed = collections.deque()
+        # The videos the user was asked to pick from, when the pick is
+        # given later (no chooser).
+        self._pending_choice = None
+        self._journal = journal
+        # The VideoLibrary once it is loaded and the journal replayed, and
+        # a future to wait for that.
+        self._library = None
+        self._loaded = Future()
+        self._progress = LoadProgress()
+        if videos is not None:
+            self._finish_loading(videos)
+        elif background:
+            threading.Thread(target=self._load, name="video-library-loader",
+                             daemon=True).start()
+        else:
+            self._load()
+            # Fail here, like before there was background loading.
+            self._loaded.result()
 
+    def _load(self):
+        try:
+            videos = VideoLibrary(progress=self._progress,
+                                  load_workers=self._load_workers,
+                                  search_workers=self._search_workers)
+            self._finish_loading(videos)
+        except Exception as e:
+            self._progress.finish(0, e)
+            self._loaded.set_exception(e)
+
+    def _finish_loading(self, videos):
+        if self._journal is not None:
+            self._progress.stage = "replaying journal"
+            self._journal.replay(videos, self._playlist_library)
+        videos.add_removal_listener(self._on_videos_removed)
+        self._progress.finish(len(videos))
+        self._library = videos
+        self._loaded.set_result(videos)
+
+    def _wait_loaded(self):
+        """Waits for the VideoLibrary and returns it. Raises
+        VideosNotLoadedError if loading it failed."""
+        try:
+            return self._loaded.result()
+        except Exception as e:
+            raise VideosNotLoadedError(str(e)) from e
 
-    def number_of_videos(self):
-        num_videos = len(self._videos.get_all_videos())
-        print(f"{num_videos} videos in the library")
+    @property
+    def _videos(self):
+        """The VideoLibrary, waiting for it if it is still loading."""
+        videos = self._library
+        if videos is None:
+            videos = self._wait_loaded()
+        return videos
+
+    @property
+    def _playlists(self):
+        """The playlists. With a journal they are only complete once the
+        journal is replayed, which needs the videos, so we wait for those."""
+        if self._journal is not None and self._library is None:
+            self._wait_loaded()
+        return self._playlist_library
+
+    def _say_load_failed(self, error):
+        self.say("load_failed", "Videos could not be loaded: {reason}",
+                 error=type(error).__name__, reason=str(error))
+
+    def when_loaded(self, callback):
+        """Calls callback(videos) once the VideoLibrary is loaded, straight
+        away if it is. Not called if loading fails."""
+        def done(future):
+            if future.exception() is None:
+                callback(future.result())
+        self._loaded.add_done_callback(done)
+
+    @property
+    def sink(self):
+        return self._sink
 
+    @property
+    def videos(self):
+        return self._videos
+
+    @property
+    def loaded_videos(self):
+        """The VideoLibrary, or None if it is still loading (or failed to).
+        Never waits."""
+        return self._library
+
+    @property
+    def playlists(self):
+        return self._playlists
+
+    @property
+    def playback(self):
+        return self._playback
+
+    def say(self, event, template=None, **fields):
+        """Sends a message to the sink, and adds it to the results of the
+        running commands."""
+        output = Output(event, template, **fields)
+        for result in self._results:
+            result.outputs.append(output)
+        if METRICS.enabled:
+            with METRICS.phase("render"):
+                self._sink.write(output)
+        else:
+            # say is called for every line, so skip even the timer call.
+            self._sink.write(output)
+
+    def _record(self, *change):
+        """Saves a change to the playlists or flags in the journal, if we
+        have one."""
+        if self._journal is None:
+            return
+        try:
+            self._journal.append(*change)
+        except JournalError as e:
+            self.say("journal_error", "Change not saved: {reason}",
+                     error=type(e).__name__, reason=str(e))
+
+    def _record_many(self, changes):
+        """Saves many changes, waiting for the journal once."""
+        if self._journal is None:
+            return
+        try:
+            self._journal.append_many(changes)
+        except JournalError as e:
+            self.say("journal_error", "Changes not saved: {reason}",
+                     error=type(e).__name__, reason=str(e))
+
+    def _on_videos_removed(self, videos):
+        """Called, from whichever thread reloaded the library, when the
+        reload took `videos` out of it. They are only queued here; the
+        player's own thread applies them before its next command."""
+        self._removed.append(videos)
+
+    def _apply_removals(self):
+        """Stops the playing video if a reload removed it, and takes the
+        removed videos out of every playlist."""
+        removed = set()
+        while self._removed:
+            removed.update(self._removed.popleft())
+        if not removed:
+            return
+        if (self._playback.state != PlaybackState.STOPPED
+                and self._playback.get_video() in removed):
+            self.stop_video()
+        for playlist in self._playlists.get_all():
+            for video in [v for v in playlist.videos if v in removed]:
+                playlist.remove_video(video)
+                self._record("REMOVE_FROM_PLAYLIST", playlist.name, video.video_id)
+
+    def _page(self, get_videos, next_position, limit, offset, after,
+              position_type=str):
+        """Gets one page of a list of videos.
+        Args:
+            get_videos: Called with (position, offset, limit), returns the
+                videos after `position` (None for the start of the list).
+            next_position: Called with (position, page) to get the
+                position the next page starts after.
+            limit, offset, after: See show_all_videos.
+            position_type: The type of the positions, so a cursor from
+                another kind of list is refused.
+        Returns:
+            The videos, the number of the first one in the whole list and
+            the cursor for the next page (None on the last page).
+        Raises VideoPlayerError if the cursor is not one we made.
+        """
+        position, start = _decode_cursor(after) if after is not None else (None, 1)
+        if position is not None and type(position) is not position_type:
+            raise VideoPlayerError("Invalid cursor")
+        # Positions in a list are counts, we never make a negative one.
+        if type(position) is int and position < 0:
+            raise VideoPlayerError("Invalid cursor")
+        start += offset
+        if limit is None:
+            return get_videos(position, offset, None), start, None
+        # Ask for one video more, to know if there is a next page.
+        videos = get_videos(position, offset, limit + 1)
+        if len(videos) <= limit:
+            return videos, start, None
+        videos = videos[:limit]
+        return videos, start, _encode_cursor(next_position(position, videos),
+                                             start + limit)
+
+    def _key_cursor(self, position, videos):
+        """Lists in library order continue after the sort key of their last
+        video, so adding or removing videos doesn't shift later pages."""
+        return self._videos.sort_key(videos[-1])
+
+    def _say_next_page(self, cursor):
+        if cursor is not None:
+            self.say("next_page", "There are more, add AFTER {cursor} to see them.",
+                     cursor=cursor)
+
+    def _choose_video(self, videos, query, start=1, cursor=None):
+        """Lists the videos and asks which one to play. Returns the chosen
+        video or None. `start` is the number of the first video, when the
+        videos are a page of the results."""
+        self.say("search_results", "Here are the results for {query}:",
+                 videos=videos, item_template="  {number}) {video})",
+                 start=start, query=query)
+        self._say_next_page(cursor)
+        self.say("choose_video",
+                 "Would you like to play any of the above? If yes, specify "
+                 "the number of the video.\n"
+                 "If your answer is not a valid number, we will assume it's a no.")
+
+        if self._chooser is None:
+            self._pending_choice = (videos, start)
+            return None
+        if self._flush_before_choice:
+            self._sink.flush()
+        return self._pick(videos, self._chooser(""), start)
+
+    @staticmethod
+    def _pick(videos, user_input, start=1):
+        try:
+            num = int(user_input)
+        except ValueError:
+            num = 0
+
+        if start <= num < start + len(videos):
+            return videos[num - start]
+        else:
+            return None
+
+    @property
+    def awaiting_choice(self):
+        """True if a search is waiting for answer_choice."""
+        return self._pending_choice is not None
+
+    @_command
+    def answer_choice(self, user_input):
+        """Answers the question asked by the last search, when the player
+        has no chooser. Plays the picked video, if any.
+        Args:
+            user_input: What the user answered, a number or anything else
+                for no.
+        """
+        pending, self._pending_choice = self._pending_choice, None
+        if pending is None:
+            return None
+        videos, start = pending
+        chosen_video = self._pick(videos, user_input, start)
+        if chosen_video is not None:
+            self.play_video(chosen_video.video_id)
+        return chosen_video
 
-    def show_all_videos(self):
-        """Returns all videos."""
+    @_command
+    def number_of_videos(self):
+        num_videos = len(self._videos)
+        self.say("number_of_videos", "{count} videos in the library",
+                 count=num_videos)
+        return num_videos
+
+    @_command
+    def show_all_videos(self, limit=None, offset=0, after=None):
+        """Returns all videos, or one page of them.
+        Args:
+            limit: How many videos to show, all of them if None.
+            offset: How many videos to skip.
+            after: The cursor the previous page ended with.
+        """
 
-        print("Here's a list of all available videos:")
-        for v in self._videos.get_all_videos():
-            print(v)
+        try:
+            videos, start, cursor = self._page(
+                self._videos.get_all_videos, self._key_cursor, limit, offset, after)
+        except VideoPlayerError as e:
+            self.say("page_error", "Cannot show videos: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
+        self.say("all_videos", "Here's a list of all available videos:",
+                 videos=videos, start=start)
+        self._say_next_page(cursor)
+        return videos
 
+    @_command
     def play_video(self, video_id):
         """Plays the respective video.
         Args:
@@ -501,70 +3601,92 @@ class VideoPlayer:
             video = self._videos[video_id]
             video.check_allowed()
         except (VideoLibraryError, FlagError) as e:
-            print(f"Cannot play video: {e}")
-            return
+            self.say("play_error", "Cannot play video: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
 
         if self._playback.state != PlaybackState.STOPPED:
             self.stop_video()
         self._playback.play(video)
-        print(f"Playing video: {video.title}")
+        self.say("playing", "Playing video: {video.title}", video=video)
+        return video
 
+    @_command
     def stop_video(self):
         """Stops the current video."""
 
         try:
             video = self._playback.get_video()
-            print(f"Stopping video: {video.title}")
+            self.say("stopping", "Stopping video: {video.title}", video=video)
             self._playback.stop()
+            return video
         except VideoPlaybackError as e:
-            print(f"Cannot stop video: {e}")
+            self.say("stop_error", "Cannot stop video: {reason}",
+                     error=type(e).__name__, reason=str(e))
 
+    @_command
     def play_random_video(self):
         """Plays a random video from the video library."""
 
         random_video_id = self._videos.get_random_video_id()
 
         if random_video_id is None:
-            print("No videos available")
-        else:
-            self.play_video(random_video_id)
+            self.say("no_videos", "No videos available")
+            return None
+        return self.play_video(random_video_id).value
 
+    @_command
     def pause_video(self):
         """Pauses the current video."""
 
         try:
             video = self._playback.get_video()
         except VideoPlaybackError as e:
-            print(f"Cannot pause video: {e}")
-            return
+            self.say("pause_error", "Cannot pause video: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
 
         if self._playback.state == PlaybackState.PAUSED:
-            print(f"Video already paused: {video.title}")
-            return
+            self.say("already_paused", "Video already paused: {video.title}",
+                     video=video)
+            return video
 
-        print(f"Pausing video: {video.title}")
+        self.say("pausing", "Pausing video: {video.title}", video=video)
         self._playback.pause()
+        return video
 
+    @_command
     def continue_video(self):
         """Resumes playing the current video."""
 
         try:
             video = self._playback.get_video()
             self._playback.resume()
-            print(f"Continuing video: {video.title}")
+            self.say("continuing", "Continuing video: {video.title}",
+                     video=video)
+            return video
         except VideoPlaybackError as e:
-            print(f"Cannot continue video: {e}")
+            self.say("continue_error", "Cannot continue video: {reason}",
+                     error=type(e).__name__, reason=str(e))
 
+    @_command
     def show_playing(self):
         """Displays video currently playing."""
 
         if self._playback.state == PlaybackState.PLAYING:
-            print(f"Currently playing: {self._playback.get_video()}")
+            video = self._playback.get_video()
+            self.say("now_playing", "Currently playing: {video}", video=video,
+                     paused=False)
+            return video
         elif self._playback.state == PlaybackState.PAUSED:
-            print(f"Currently playing: {self._playback.get_video()} - PAUSED")
+            video = self._playback.get_video()
+            self.say("now_playing", "Currently playing: {video} - PAUSED",
+                     video=video, paused=True)
+            return video
         else:
-            print("No video is currently playing")
+            self.say("nothing_playing", "No video is currently playing")
 
+    @_command
     def create_playlist(self, playlist_name):
         """Creates a playlist with a given name.
         Args:
@@ -573,10 +3695,15 @@ class VideoPlayer:
 
         try:
             self._playlists.create(playlist_name)
-            print(f"Successfully created new playlist: {playlist_name}")
+            self._record("CREATE_PLAYLIST", playlist_name)
+            self.say("playlist_created",
+                     "Successfully created new playlist: {playlist}",
+                     playlist=playlist_name)
         except VideoPlaylistLibraryError as e:
-            print(f"Cannot create playlist: {e}")            
+            self.say("create_playlist_error", "Cannot create playlist: {reason}",
+                     error=type(e).__name__, reason=str(e))
 
+    @_command
     def add_to_playlist(self, playlist_name, video_id):
         """Adds a video to a playlist with a given name.
         Args:
@@ -589,44 +3716,102 @@ class VideoPlayer:
             video = self._videos[video_id]
             video.check_allowed()
             playlist.add_video(video)
-            print(f"Added video to {playlist_name}: {video.title}")
+            self._record("ADD_TO_PLAYLIST", playlist_name, video_id)
+            self.say("added_to_playlist", "Added video to {playlist}: {video.title}",
+                     playlist=playlist_name, video=video)
+            return video
         except (VideoPlaylistLibraryError, VideoPlaylistError, VideoLibraryError, FlagError) as e:
-            print(f"Cannot add video to {playlist_name}: {e}")
+            self.say("add_to_playlist_error",
+                     "Cannot add video to {playlist}: {reason}",
+                     error=type(e).__name__, playlist=playlist_name, reason=str(e))
+
+    @_command
+    def add_all_to_playlist(self, playlist_name, source):
+        """Adds many videos to a playlist at once. Videos that don't exist,
+        are flagged or are in the playlist already are skipped and counted.
+        Args:
+            playlist_name: The playlist name.
+            source: "@" and a file of video ids, or video ids separated by
+                commas.
+        """
+
+        try:
+            playlist = self._playlists[playlist_name]
+            found, missing = self._videos.find_videos(_read_video_ids(source, self._read_files))
+        except (VideoPlaylistLibraryError, OSError) as e:
+            self.say("add_to_playlist_error",
+                     "Cannot add videos to {playlist}: {reason}",
+                     error=type(e).__name__, playlist=playlist_name, reason=str(e))
+            return None
 
+        allowed = [video for video in found if not video.is_flagged]
+        added = playlist.add_videos(allowed)
+        self._record_many([("ADD_TO_PLAYLIST", playlist_name, video.video_id)
+                           for video in added])
+        self.say("added_all_to_playlist",
+                 "Added {count} videos to {playlist} ({missing} not found, "
+                 "{flagged} flagged, {skipped} already added)",
+                 playlist=playlist_name, count=len(added), missing=len(missing),
+                 flagged=len(found) - len(allowed),
+                 skipped=len(allowed) - len(added))
+        return added
+
+    @_command
     def show_all_playlists(self):
         """Display all playlists."""
 
         playlists = list(self._playlists.get_all())
 
         if not playlists:
-            print("No playlists exist yet")
-            return
+            self.say("no_playlists", "No playlists exist yet")
+            return playlists
 
-        print("Showing all playlists:")
+        self.say("all_playlists", "Showing all playlists:")
         for playlist in playlists:
-            print(f"  {playlist}")
+            self.say("playlist_name", "  {playlist}", playlist=playlist.name)
+        return playlists
 
-    def show_playlist(self, playlist_name):
-        """Display all videos in a playlist with a given name.
+    @_command
+    def show_playlist(self, playlist_name, limit=None, offset=0, after=None):
+        """Display all videos in a playlist with a given name, or one page
+        of them.
         Args:
             playlist_name: The playlist name.
+            limit, offset, after: See show_all_videos.
         """
 
-        try:        
+        def get_videos(position, offset, limit):
+            # A copy, not the live playlist.videos: the output and the
+            # result must not change when the playlist does.
+            start = (position or 0) + offset
+            return playlist.get_videos(start, None if limit is None else start + limit)
+
+        def position_cursor(position, videos):
+            # Playlists keep the order videos were added in, not a sort
+            # order, so their cursors hold the position of the next video.
+            return (position or 0) + offset + len(videos)
+
+        try:
             playlist = self._playlists[playlist_name]
-        except VideoPlaylistLibraryError as e:
-            print(f"Cannot show playlist {playlist_name}: {e}")
-            return
+            videos, start, cursor = self._page(
+                get_videos, position_cursor, limit, offset, after, int)
+        except (VideoPlaylistLibraryError, VideoPlayerError) as e:
+            self.say("show_playlist_error", "Cannot show playlist {playlist}: {reason}",
+                     error=type(e).__name__, playlist=playlist_name, reason=str(e))
+            return None
 
-        print(f"Showing playlist: {playlist_name}")
+        self.say("playlist", "Showing playlist: {playlist}", playlist=playlist_name)
 
-        if not playlist.videos:
-            print("No videos here yet")
-            return
+        if not videos:
+            self.say("empty_playlist", "No videos here yet")
+            return videos
 
-        for video in playlist.videos:
-            print(f"  {video}")
+        self.say("playlist_videos", videos=videos, item_template="  {video}",
+                 start=start)
+        self._say_next_page(cursor)
+        return videos
 
+    @_command
     def remove_from_playlist(self, playlist_name, video_id):
         """Removes a video to a playlist with a given name.
         Args:
@@ -638,72 +3823,154 @@ class VideoPlayer:
             playlist = self._playlists[playlist_name]
             video = self._videos[video_id]
             playlist.remove_video(video)
-            print(f"Removed video from {playlist_name}: {video.title}")
+            self._record("REMOVE_FROM_PLAYLIST", playlist_name, video_id)
+            self.say("removed_from_playlist",
+                     "Removed video from {playlist}: {video.title}",
+                     playlist=playlist_name, video=video)
+            return video
         except (VideoPlaylistError, VideoLibraryError, VideoPlaylistLibraryError) as e:
-            print(f"Cannot remove video from {playlist_name}: {e}")
+            self.say("remove_from_playlist_error",
+                     "Cannot remove video from {playlist}: {reason}",
+                     error=type(e).__name__, playlist=playlist_name, reason=str(e))
 
+    @_command
     def clear_playlist(self, playlist_name):
         """Removes all videos from a playlist with a given name.
         Args:
             playlist_name: The playlist name.
         """
 
-        try:        
+        try:
             playlist = self._playlists[playlist_name]
             playlist.clear()
-            print(f"Successfully removed all videos from {playlist_name}")
+            self._record("CLEAR_PLAYLIST", playlist_name)
+            self.say("playlist_cleared",
+                     "Successfully removed all videos from {playlist}",
+                     playlist=playlist_name)
         except (VideoPlaylistError, VideoPlaylistLibraryError) as e:
-            print(f"Cannot clear playlist {playlist_name}: {e}")
+            self.say("clear_playlist_error", "Cannot clear playlist {playlist}: {reason}",
+                     error=type(e).__name__, playlist=playlist_name, reason=str(e))
 
+    @_command
     def delete_playlist(self, playlist_name):
         """Deletes a playlist with a given name.
         Args:
             playlist_name: The playlist name.
         """
 
-        try:        
+        try:
             playlist = self._playlists[playlist_name]
             del self._playlists[playlist_name]
-            print(f"Deleted playlist: {playlist_name}")
+            self._record("DELETE_PLAYLIST", playlist_name)
+            self.say("playlist_deleted", "Deleted playlist: {playlist}",
+                     playlist=playlist_name)
         except VideoPlaylistLibraryError as e:
-            print(f"Cannot delete playlist {playlist_name}: {e}")
+            self.say("delete_playlist_error", "Cannot delete playlist {playlist}: {reason}",
+                     error=type(e).__name__, playlist=playlist_name, reason=str(e))
 
-    def search_videos(self, search_term):
-        """Display all the videos whose titles contain the search_term.
+    @_command
+    def search_videos(self, search_term, limit=None, offset=0, after=None):
+        """Display all the videos whose titles contain the search_term, or
+        one page of them.
         Args:
             search_term: The query to be used in search.
+            limit, offset, after: See show_all_videos.
+        """
+
+        try:
+            results, start, cursor = self._page(
+                functools.partial(self._videos.search_videos, search_term),
+                self._key_cursor, limit, offset, after)
+        except VideoPlayerError as e:
+            self.say("page_error", "Cannot search videos: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
+
+        if not results:
+            self.say("no_search_results", "No search results for {query}",
+                     query=search_term)
+            return results
+
+        chosen_video = self._choose_video(results, search_term, start, cursor)
+
+        if chosen_video is not None:
+            self.play_video(chosen_video.video_id)
+        return results
+
+    @_command
+    def search_videos_tag(self, *words, limit=None, offset=0, after=None):
+        """Display all videos whose tags contains the provided tag, or one
+        page of them. Several words are read as a tag query, such as
+        "#cat AND #funny NOT #dog" or "(#cat OR #dog) #funny".
+        Args:
+            words: The video tag to be used in search, or the query.
+            limit, offset, after: See show_all_videos.
         """
-        
-        results = self._videos.search_videos(search_term)
+
+        video_tag = " ".join(words)
+        if len(words) == 1 and not any(c in video_tag for c in "()"):
+            get_videos = functools.partial(self._videos.get_videos_with_tag, video_tag)
+        else:
+            get_videos = functools.partial(self._videos.query_tags, video_tag)
+
+        try:
+            results, start, cursor = self._page(
+                get_videos, self._key_cursor, limit, offset, after)
+        except (VideoPlayerError, TagQueryError) as e:
+            self.say("page_error", "Cannot search videos: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
 
         if not results:
-            print(f"No search results for {search_term}")
-            return
+            self.say("no_search_results", "No search results for {query}",
+                     query=video_tag)
+            return results
 
-        print(f"Here are the results for {search_term}:")
-        chosen_video = _print_video_choice_list(results)
+        chosen_video = self._choose_video(results, video_tag, start, cursor)
 
         if chosen_video is not None:
             self.play_video(chosen_video.video_id)
+        return results
 
-    def search_videos_tag(self, video_tag):
-        """Display all videos whose tags contains the provided tag.
+    @_command
+    def search_ranked(self, *words, limit=None, offset=0, after=None):
+        """Display the videos that best match the words, best first.
         Args:
-            video_tag: The video tag to be used in search.
+            words: The words to search for.
+            limit: How many videos to show, 10 if None.
+            offset, after: See show_all_videos.
         """
 
-        results = self._videos.get_videos_with_tag(video_tag)
+        query = " ".join(words)
+
+        def get_videos(position, offset, limit):
+            start = (position or 0) + offset
+            return self._videos.search_ranked(query, start + limit)[start:]
+
+        def rank_cursor(position, videos):
+            # A ranking has no order to continue from but the rank itself.
+            return (position or 0) + offset + len(videos)
+
+        try:
+            results, start, cursor = self._page(
+                get_videos, rank_cursor, limit or RANKED_RESULTS, offset, after, int)
+        except VideoPlayerError as e:
+            self.say("page_error", "Cannot search videos: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
 
         if not results:
-            print(f"No search results for {video_tag}")
-            return
+            self.say("no_search_results", "No search results for {query}",
+                     query=query)
+            return results
 
-        print(f"Here are the results for {video_tag}:")
-        chosen_video = _print_video_choice_list(results)
+        chosen_video = self._choose_video(results, query, start, cursor)
 
         if chosen_video is not None:
             self.play_video(chosen_video.video_id)
+        return results
 
+    @_command
     def flag_video(self, video_id, flag_reason=""):
         """Mark a video as flagged.
         Args:
@@ -720,11 +3987,17 @@ class VideoPlayer:
             if self._playback.state != PlaybackState.STOPPED and self._playback.get_video() == video:
                 self.stop_video()
 
-            video.flag(flag_reason)
-            print(f"Successfully flagged video: {video.title} {video.formatted_flag_reason}")
+            self._videos.flag_video(video_id, flag_reason)
+            self._record("FLAG_VIDEO", video_id, flag_reason)
+            self.say("flagged",
+                     "Successfully flagged video: {video.title} {video.formatted_flag_reason}",
+                     video=video, reason=flag_reason)
+            return video
         except (VideoPlayerError, FlagError, VideoLibraryError) as e:
-            print(f"Cannot flag video: {e}")
+            self.say("flag_error", "Cannot flag video: {reason}",
+                     error=type(e).__name__, reason=str(e))
 
+    @_command
     def allow_video(self, video_id):
         """Removes a flag from a video.
         Args:
@@ -732,11 +4005,648 @@ class VideoPlayer:
         """
 
         try:
-            video = self._videos[video_id]
-            video.unflag()
-            print(f"Successfully removed flag from video: {video.title}")
+            video = self._videos.allow_video(video_id)
+            self._record("ALLOW_VIDEO", video_id)
+            self.say("allowed", "Successfully removed flag from video: {video.title}",
+                     video=video)
+            return video
         except (VideoPlayerError, FlagError, VideoLibraryError) as e:
-            print(f"Cannot remove flag from video: {e}")
+            self.say("allow_error", "Cannot remove flag from video: {reason}",
+                     error=type(e).__name__, reason=str(e))
+
+    @_command
+    def flag_videos_from(self, source, flag_reason=""):
+        """Flags many videos at once, updating the library's indexes once
+        rather than once per video. If one of them is playing it is
+        stopped first.
+        Args:
+            source: "@" and a file of video ids, or video ids separated by
+                commas.
+            flag_reason: Reason for flagging the videos.
+        """
+
+        if not flag_reason:
+            flag_reason = "Not supplied"
+
+        try:
+            video_ids = _read_video_ids(source, self._read_files)
+        except OSError as e:
+            self.say("flag_error", "Cannot flag videos: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
+
+        if self._playback.state != PlaybackState.STOPPED:
+            playing = self._playback.get_video()
+            if not playing.is_flagged and playing.video_id in set(video_ids):
+                self.stop_video()
+
+        flagged, missing, skipped = self._videos.flag_videos(video_ids, flag_reason)
+        self._record_many([("FLAG_VIDEO", video.video_id, flag_reason)
+                           for video in flagged])
+        self.say("videos_flagged",
+                 "Successfully flagged {count} videos (reason: {reason}) "
+                 "({missing} not found, {skipped} already flagged)",
+                 count=len(flagged), reason=flag_reason, missing=len(missing),
+                 skipped=len(skipped))
+        return flagged
+
+    @_command
+    def allow_videos_from(self, source):
+        """Removes the flag from many videos at once, see flag_videos_from.
+        Args:
+            source: "@" and a file of video ids, or video ids separated by
+                commas.
+        """
+
+        try:
+            video_ids = _read_video_ids(source, self._read_files)
+        except OSError as e:
+            self.say("allow_error", "Cannot remove flag from videos: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
+
+        allowed, missing, skipped = self._videos.allow_videos(video_ids)
+        self._record_many([("ALLOW_VIDEO", video.video_id) for video in allowed])
+        self.say("videos_allowed",
+                 "Successfully removed flag from {count} videos "
+                 "({missing} not found, {skipped} not flagged)",
+                 count=len(allowed), missing=len(missing), skipped=len(skipped))
+        return allowed
+
+    @_command
+    def reload_videos(self):
+        """Reads the catalog file again and applies what changed. Videos
+        that are gone are stopped if playing and taken out of the
+        playlists. Other players sharing the library do that before their
+        next command."""
+
+        try:
+            added, removed, changed = self._videos.reload()
+        except (OSError, ValueError) as e:
+            self.say("reload_error", "Cannot reload videos: {reason}",
+                     error=type(e).__name__, reason=str(e))
+            return None
+        self._apply_removals()
+        self.say("reloaded",
+                 "Reloaded videos: {added} added, {removed} removed, "
+                 "{changed} changed",
+                 added=len(added), removed=len(removed), changed=len(changed))
+        return added, removed, changed
+
+    @_command
+    def show_status(self):
+        """Shows whether the videos are loaded, or how far loading is.
+        Never waits for them."""
+
+        progress = self._progress
+        if progress.error is not None:
+            self._say_load_failed(progress.error)
+        elif progress.done:
+            self.say("loaded", "Videos loaded: {count} videos in {seconds:.2f}s",
+                     count=progress.videos, seconds=progress.elapsed)
+        else:
+            self.say("loading",
+                     "Loading videos: {stage}, {count} videos so far, {seconds:.2f}s",
+                     stage=progress.stage, count=progress.videos,
+                     seconds=progress.elapsed)
+        return progress
+
+
+# In[ ]:
+
+
+"""A server that lets many users share one video library."""
+
+import asyncio
+from .command_parser import CommandException, CommandParser, LOCAL_COMMANDS
+from .video_output import CollectorSink
+from .video_player import VideoPlayer
+from .video_watcher import CatalogWatcher
+
+_GREETING = ("Hello and welcome to YouTube, what would you like to do?\n"
+             "    Enter HELP for list of available commands or EXIT to terminate.\n")
+_GOODBYE = "YouTube has now terminated its execution. Thank you and goodbye!\n"
+_PROMPT = "YT> "
+# The longest line a client may send, in bytes. Server sessions can't read
+# video ids from files, so a bulk command lists them all on one line; this
+# leaves room for a few hundred thousand ids.
+LINE_LIMIT = 1 << 22
+
+
+async def _read_line(reader):
+    """Reads one line from a client. Returns None if the line is longer
+    than the reader's limit, after skipping the whole of it, and b"" once
+    the client has closed the connection."""
+    too_long = False
+    while True:
+        try:
+            line = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return b"" if too_long else e.partial
+        except asyncio.LimitOverrunError as e:
+            # Throw away what is buffered and keep looking for the end.
+            too_long = True
+            await reader.read(max(1, e.consumed))
+            continue
+        return None if too_long else line
+
+
+class VideoSession:
+    """One user of the server. Each session has its own playback and
+    playlists, the video library is shared by everyone. The LOCAL_COMMANDS
+    are left out and the bulk commands can't read files, users can't
+    touch the server's files or metrics."""
+
+    def __init__(self, videos):
+        self._sink = CollectorSink()
+        self._player = VideoPlayer(chooser=None, sink=self._sink, videos=videos,
+                                   read_files=False)
+        self._parser = CommandParser(self._player, exclude=LOCAL_COMMANDS)
+
+    @property
+    def player(self):
+        return self._player
+
+    def handle_line(self, line: str):
+        """Runs one line the user sent and returns the text to send back,
+        or None if the user wants to leave. A line sent after a search is
+        the answer to its question, like input("") would have read it."""
+        line = line.rstrip("\r\n")
+        if self._player.awaiting_choice:
+            self._player.answer_choice(line)
+        elif line.strip().upper() == "EXIT":
+            return None
+        else:
+            try:
+                self._parser.execute_command(line.split())
+            except CommandException as e:
+                return self.refuse(str(e))
+        return self._reply()
+
+    def refuse(self, message: str):
+        """Tells the user a line could not be run, e.g. because it was too
+        long, and returns the text to send back."""
+        self._player.say("command_error", "{message}",
+                         error="CommandException", message=message)
+        return self._reply()
+
+    def _reply(self):
+        text = self._sink.text()
+        self._sink.clear()
+        if not self._player.awaiting_choice:
+            text += _PROMPT
+        return text
+
+
+class VideoServer:
+    """Serves a line based version of the terminal simulator over TCP or a
+    Unix socket. Every connection gets its own VideoSession. Commands run
+    in the event loop's default executor, so a slow command (a big search
+    or a reload) doesn't hold up the other connections. A session runs
+    one command at a time, and the library is safe to use from many
+    threads.
+    """
+
+    def __init__(self, videos=None, load_workers=0, search_workers=0):
+        """The VideoServer class is initialized.
+        Args:
+            videos: The VideoLibrary to serve, loaded from videos.txt by
+                default.
+            load_workers: How many processes parse the catalog when we
+                load it, see VideoLibrary.
+            search_workers: How many processes big title searches use, when
+                we load the library, see VideoLibrary.
+        """
+        self._videos = (videos if videos is not None
+                        else VideoLibrary(load_workers=load_workers,
+                                          search_workers=search_workers))
+        self._server = None
+        self._limit = LINE_LIMIT
+
+    @property
+    def videos(self):
+        return self._videos
+
+    def session(self) -> VideoSession:
+        return VideoSession(self._videos)
+
+    async def start(self, host="127.0.0.1", port=0, path=None, backlog=4096,
+                    limit=LINE_LIMIT):
+        """Starts listening, on a Unix socket if `path` is given and on TCP
+        otherwise. Returns the asyncio server. The backlog is large so that
+        thousands of users connecting at once are not turned away. Lines
+        longer than `limit` bytes are refused with an error, the
+        connection stays open."""
+        if path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._handle_connection, path=path, backlog=backlog, limit=limit)
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_connection, host, port, backlog=backlog, limit=limit)
+        self._limit = limit
+        return self._server
+
+    async def serve_forever(self, host="127.0.0.1", port=0, path=None, watch=None):
+        """Serves until cancelled. If `watch` is a number of seconds, the
+        catalog file is checked that often and reloaded when it changed."""
+        server = await self.start(host, port, path)
+        if watch is not None:
+            asyncio.get_running_loop().create_task(self.watch_catalog(watch))
+        async with server:
+            await server.serve_forever()
+
+    async def watch_catalog(self, interval=1.0):
+        """Reloads the library whenever its file changes. The reload runs in
+        the executor like the commands; each session takes the removed
+        videos out of its playlists before its next command."""
+        watcher = CatalogWatcher(self._videos)
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, watcher.check)
+
+    async def _handle_connection(self, reader, writer):
+        session = self.session()
+        loop = asyncio.get_running_loop()
+        try:
+            writer.write((_GREETING + _PROMPT).encode())
+            await writer.drain()
+            while True:
+                line = await _read_line(reader)
+                if line is None:
+                    writer.write(session.refuse(
+                        f"Please send a shorter command, lines are limited "
+                        f"to {self._limit} bytes.").encode())
+                    await writer.drain()
+                    continue
+                if not line:
+                    break
+                text = await loop.run_in_executor(
+                    None, session.handle_line, line.decode(errors="replace"))
+                if text is None:
+                    writer.write(_GOODBYE.encode())
+                    await writer.drain()
+                    break
+                writer.write(text.encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class LocalClient:
+    """Talks to a session of the server in the same process, without any
+    socket. Handy for tests and for embedding."""
+
+    def __init__(self, server: VideoServer):
+        self._session = server.session()
+        self.closed = False
+
+    async def send(self, line: str) -> str:
+        """Sends one line and returns what the server answers."""
+        if self.closed:
+            raise ConnectionError("Client is closed")
+        # Run it in the executor like the server does, so other sessions
+        # get a turn meanwhile.
+        text = await asyncio.get_running_loop().run_in_executor(
+            None, self._session.handle_line, line)
+        if text is None:
+            self.closed = True
+            return _GOODBYE
+        return text
+
+
+# In[ ]:
+
+
+"""A stress check for using one video library from many threads."""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .video import FlagError
+
+
+def stress_test(videos, threads=8, seconds=2.0, seed=0):
+    """Runs title searches, tag searches, random picks and flag changes on
+    the VideoLibrary `videos` from many threads at once. Returns a list of
+    the inconsistencies found, so an empty list means all went well.
+
+    While the threads run, every result must be in library order without
+    repeats and must match its query. Once they have stopped, the flags
+    must add up and every index must agree with the flags.
+    """
+    all_videos = list(videos.get_all_videos())
+    if not all_videos:
+        return []
+    rank = {video: i for i, video in enumerate(all_videos)}
+    tags = sorted({tag for video in all_videos for tag in video.tags})
+    problems = []
+    flagged_before = sum(video.is_flagged for video in all_videos)
+    net_flags = []
+    deadline = time.monotonic() + seconds
+
+    def check_order(what, results):
+        ranks = [rank[video] for video in results]
+        if any(a >= b for a, b in zip(ranks, ranks[1:])):
+            problems.append(f"{what}: results out of order or repeated")
+
+    def worker(worker_seed):
+        rng = random.Random(worker_seed)
+        flags = 0
+        while time.monotonic() < deadline:
+            action = rng.random()
+            video = rng.choice(all_videos)
+            if action < 0.3:
+                start = rng.randrange(max(1, len(video.title) - 2))
+                term = video.title[start:start + 3]
+                results = videos.search_videos(term)
+                check_order(f"search {term!r}", results)
+                if any(term.lower() not in v.title.lower() for v in results):
+                    problems.append(f"search {term!r}: result without the term")
+            elif action < 0.5 and tags:
+                tag = rng.choice(tags)
+                results = videos.get_videos_with_tag(tag)
+                check_order(f"tag {tag!r}", results)
+                if any(tag not in v.tags for v in results):
+                    problems.append(f"tag {tag!r}: result without the tag")
+            elif action < 0.65:
+                video_id = videos.get_random_video_id()
+                if video_id is not None and videos.get_video(video_id) is None:
+                    problems.append(f"random: unknown video {video_id!r}")
+            elif action < 0.75:
+                check_order("allowed videos", videos.get_allowed_videos())
+            elif action < 0.9:
+                try:
+                    videos.flag_video(video.video_id, "stress test")
+                    flags += 1
+                except FlagError:
+                    pass
+            else:
+                try:
+                    videos.allow_video(video.video_id)
+                    flags -= 1
+                except FlagError:
+                    pass
+        net_flags.append(flags)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for future in [pool.submit(worker, seed + i) for i in range(threads)]:
+            error = future.exception()
+            if error is not None:
+                problems.append(f"worker failed: {type(error).__name__}: {error}")
+
+    # Everything has stopped: the indexes must now agree with the flags.
+    flagged = [video for video in all_videos if video.is_flagged]
+    if len(flagged) != flagged_before + sum(net_flags):
+        problems.append(
+            f"flags: {len(flagged)} flagged, expected "
+            f"{flagged_before + sum(net_flags)}")
+    allowed = [video for video in all_videos if not video.is_flagged]
+    if list(videos.get_allowed_videos()) != allowed:
+        problems.append("allowed videos do not match the flags")
+    for tag in tags:
+        if list(videos.get_videos_with_tag(tag)) != [v for v in allowed if tag in v.tags]:
+            problems.append(f"tag {tag!r} does not match the flags")
+    for _ in range(min(1000, 10 * len(all_videos))):
+        video_id = videos.get_random_video_id()
+        if (video_id is None) != (not allowed) or (
+                video_id is not None and videos[video_id].is_flagged):
+            problems.append(f"random: picked {video_id!r} which is not allowed")
+            break
+    return problems
+
+
+# In[ ]:
+
+
+"""A benchmark suite for the video player, with a generator for synthetic
+catalogs."""
+
+import json
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from itertools import accumulate
+from pathlib import Path
+from .command_parser import CommandParser
+from .video_library import VideoLibrary
+from .video_output import OutputSink
+from .video_player import VideoPlayer
+from .video_snapshot import snapshot_path
+
+_SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "ta", "vi", "zo", "be", "cu",
+              "da", "fe", "go", "hu", "ji", "pa", "qi", "se", "to", "wu")
+
+
+def _vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generate_catalog(path, rows, tag_count=1000, max_tags=4,
+                     distribution="zipf", seed=0):
+    """Writes a synthetic videos.txt in the `title | id | tags` format.
+    Args:
+        path: Where to write the file.
+        rows: How many videos.
+        tag_count: How many different tags there are.
+        max_tags: Each video gets 0 to max_tags tags.
+        distribution: "zipf" makes a few tags (and title words) very common
+            and most of them rare, like real catalogs; "uniform" makes them
+            all equally common.
+        seed: The same seed always writes the same file.
+    """
+    rng = random.Random(seed)
+    words = _vocabulary(5000, rng)
+    tags = [f"#{word}" for word in _vocabulary(tag_count, rng)]
+    if distribution == "zipf":
+        word_weights = list(accumulate(1 / rank for rank in range(1, len(words) + 1)))
+        tag_weights = list(accumulate(1 / rank for rank in range(1, len(tags) + 1)))
+    elif distribution == "uniform":
+        word_weights = tag_weights = None
+    else:
+        raise ValueError(f"Unknown distribution: {distribution}")
+
+    with open(path, "w") as catalog:
+        for row in range(rows):
+            title = " ".join(rng.choices(words, cum_weights=word_weights,
+                                         k=rng.randint(1, 6))).capitalize()
+            video_tags = set(rng.choices(tags, cum_weights=tag_weights,
+                                         k=rng.randint(0, max_tags)))
+            catalog.write(f"{title} | video_{row} | {' , '.join(sorted(video_tags))}\n")
+    return Path(path)
+
+
+class _RenderSink(OutputSink):
+    """Formats every message like a terminal would, but throws the text
+    away, so the benchmark measures the work and not the terminal."""
+
+    def write(self, output):
+        for _ in output.lines():
+            pass
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def _summary(operation, rows, latencies):
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        "rows": rows,
+        "operation": operation,
+        "calls": len(latencies),
+        "total_s": total,
+        "ops_per_s": len(latencies) / total if total else None,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    }
+
+
+def _time_calls(function, arguments):
+    latencies = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def benchmark_catalog(path, calls=200, seed=0):
+    """Times loading the catalog at `path` and running every command on it.
+    Returns a list of result dicts (see run_benchmarks)."""
+    rng = random.Random(seed)
+    results = []
+
+    # Loading: once from scratch, once parsing with a process per CPU,
+    # once more under tracemalloc for the peak memory it needs
+    # (tracemalloc slows it down too much to time it), once writing the
+    # snapshot and once reading it back.
+    start = time.perf_counter()
+    VideoLibrary(path=path, use_snapshot=False)
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    VideoLibrary(path=path, use_snapshot=False, load_workers=os.cpu_count() or 1,
+                 parallel_load_threshold=0)
+    parallel_load_time = time.perf_counter() - start
+    tracemalloc.start()
+    library = VideoLibrary(path=path, use_snapshot=False)
+    resident, peak = tracemalloc.get_traced_memory()
+    del library
+    tracemalloc.stop()
+    snapshot_path(Path(path)).unlink(missing_ok=True)
+    VideoLibrary(path=path)
+    start = time.perf_counter()
+    videos = VideoLibrary(path=path, seed=seed)
+    snapshot_load_time = time.perf_counter() - start
+    rows = len(videos)
+    # What the whole library keeps per video once loaded: the videos, their
+    # sort keys and every index.
+    results.append(dict(_summary("load", rows, [load_time]), peak_memory_bytes=peak,
+                        bytes_per_video=resident / max(rows, 1)))
+    results.append(_summary("load_parallel", rows, [parallel_load_time]))
+    results.append(_summary("load_snapshot", rows, [snapshot_load_time]))
+
+    all_videos = videos.get_all_videos()
+    title_words = [word for video in all_videos[:1000] for word in video.title.split()]
+    tags = sorted({tag for video in all_videos[:1000] for tag in video.tags}) or ["#none"]
+
+    def ids(n):
+        return [(rng.choice(all_videos).video_id,) for _ in range(n)]
+
+    player = VideoPlayer(chooser=lambda prompt: "", sink=_RenderSink(), videos=videos)
+    parser = CommandParser(player)
+
+    def command(name, arguments, label=None):
+        latencies = _time_calls(
+            lambda *args: parser.execute_command([name, *args]), arguments)
+        results.append(_summary(label or name, rows, latencies))
+
+    none = [()] * calls
+    # Listing the whole catalog is O(rows) per call, so do it less often.
+    command("SHOW_ALL_VIDEOS", [()] * max(1, min(calls, 1_000_000 // max(rows, 1))))
+    command("NUMBER_OF_VIDEOS", none)
+    command("PLAY", ids(calls))
+    command("PLAY_RANDOM", none)
+    command("SHOW_PLAYING", none)
+    command("PAUSE", none)
+    command("CONTINUE", none)
+    command("STOP", none)
+    command("SEARCH_VIDEOS", [(rng.choice(title_words),) for _ in range(calls)])
+    command("SEARCH_VIDEOS_WITH_TAG", [(rng.choice(tags),) for _ in range(calls)])
+    command("SEARCH_VIDEOS_WITH_TAG",
+            [(*rng.choices(tags, k=2), "OR", "(", rng.choice(tags), "NOT", rng.choice(tags), ")")
+             for _ in range(calls)],
+            label="SEARCH_VIDEOS_WITH_TAG compound")
+    command("SEARCH_RANKED", [tuple(rng.choices(title_words, k=2)) for _ in range(calls)])
+    flagged = ids(calls)
+    command("FLAG_VIDEO", flagged)
+    command("ALLOW_VIDEO", flagged)
+    bulk = ",".join(video.video_id for video in
+                    rng.sample(list(all_videos), min(rows, calls * 50)))
+    command("FLAG_VIDEOS_FROM", [(bulk,)])
+    command("ALLOW_VIDEOS_FROM", [(bulk,)])
+
+    # Playlists: one big playlist built a video at a time.
+    playlist_size = min(rows, calls * 50)
+    members = [(video.video_id,) for video in rng.sample(list(all_videos), playlist_size)]
+    command("CREATE_PLAYLIST", [(f"bench_{i}",) for i in range(calls)])
+    command("ADD_TO_PLAYLIST", [("bench_0", *member) for member in members])
+    command("ADD_ALL_TO_PLAYLIST", [("bench_1", bulk)])
+    command("SHOW_PLAYLIST", [("bench_0",)] * max(1, calls // 10))
+    command("SHOW_ALL_PLAYLISTS", none)
+    command("REMOVE_FROM_PLAYLIST", [("bench_0", *member) for member in members])
+    command("CLEAR_PLAYLIST", [(f"bench_{i}",) for i in range(calls)])
+    command("DELETE_PLAYLIST", [(f"bench_{i}",) for i in range(calls)])
+    command("HELP", none)
+
+    videos.close()
+    return results
+
+
+def run_benchmarks(sizes=(1_000, 100_000), output="bench_output.json",
+                   calls=200, distribution="zipf", seed=0, workdir=None):
+    """Generates a catalog of every size, benchmarks it and writes all the
+    results as JSON to `output`, so runs can be compared. Returns the
+    report that was written.
+
+    Every result has the catalog size, the operation, the number of calls,
+    the throughput and the p50/p99 latency; loading also has the peak
+    memory it took. The peak RSS of the whole run is in the report too.
+    """
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "distribution": distribution,
+        "seed": seed,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory(dir=workdir) as directory:
+        for size in sizes:
+            path = generate_catalog(Path(directory) / f"videos_{size}.txt", size,
+                                    distribution=distribution, seed=seed)
+            report["results"].extend(benchmark_catalog(path, calls, seed))
+    # ru_maxrss is in kilobytes on Linux.
+    report["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    with open(output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
 
 
 # In[20]:
@@ -744,6 +4654,9 @@ class VideoPlayer:
 
 """A video playlist class."""
 
+from itertools import islice
+
+
 class VideoPlaylistError(Exception):
     pass
 
@@ -753,8 +4666,9 @@ class VideoPlaylist:
 
     def __init__(self, name:str):
         self._name = name
-        # Keep the videos as a list
-        self._videos = []
+        # Keep the videos as the keys of a dict: it remembers the order they
+        # were added in and gives us O(1) add, lookup and remove.
+        self._videos = {}
 
     @property
     def name(self):
@@ -762,7 +4676,17 @@ class VideoPlaylist:
 
     @property
     def videos(self):
-        return tuple(self._videos)
+        """A read-only, live view of the videos in the order they were
+        added. Nothing is copied."""
+        return self._videos.keys()
+
+    def get_videos(self, start=0, stop=None):
+        """Returns the videos from position `start` up to `stop` without
+        copying the rest of the playlist."""
+        return tuple(islice(self._videos, start, stop))
+
+    def __len__(self):
+        return len(self._videos)
 
     def __contains__(self, video):
         """Overloading this method will allow us to use the python "in"
@@ -772,12 +4696,19 @@ class VideoPlaylist:
     def add_video(self, video):
         if video in self:
             raise VideoPlaylistError("Video already added")
-        self._videos.append(video)
+        self._videos[video] = None
+
+    def add_videos(self, videos):
+        """Adds the videos that are not in the playlist yet, in order.
+        Returns the ones added."""
+        added = [video for video in dict.fromkeys(videos) if video not in self._videos]
+        self._videos.update(dict.fromkeys(added))
+        return added
 
     def remove_video(self, video):
         if video not in self:
             raise VideoPlaylistError("Video is not in playlist")
-        self._videos.remove(video)
+        del self._videos[video]
 
     def clear(self):
         self._videos.clear()
@@ -846,3 +4777,292 @@ class VideoPlaylistLibrary:
         caring about the case. """
         del self._playlists[playlist_name.lower()]
 
+
+
+# In[ ]:
+
+
+"""An append-only journal of the changes to the playlists and the flags,
+so that they survive a restart."""
+
+import json
+import os
+import threading
+from pathlib import Path
+
+_SNAPSHOT_NAME = "snapshot.json"
+
+
+class JournalError(Exception):
+    pass
+
+
+def _segment_path(directory: Path, number: int) -> Path:
+    return directory / f"{number:08d}.log"
+
+
+def _segment_numbers(directory: Path):
+    return sorted(int(path.stem) for path in directory.glob("*.log")
+                  if path.stem.isdigit())
+
+
+def _read_segment(path: Path):
+    """Yields the changes in a segment. A crash can leave the last line
+    half written, that change never happened."""
+    with open(path, "rb") as segment:
+        for line in segment:
+            if not line.endswith(b"\n"):
+                break
+            yield json.loads(line)
+
+
+class JournalState:
+    """The playlists and flags a journal adds up to, as plain names and
+    video ids. Replaying a change is a dict operation or two."""
+
+    def __init__(self, playlists=(), flags=None, segment=1):
+        # Lower case name -> (name, dict of video ids in the order added).
+        self.playlists = {name.lower(): (name, dict.fromkeys(video_ids))
+                          for name, video_ids in playlists}
+        # Video id -> flag reason, or None if the flag was removed.
+        self.flags = dict(flags or {})
+        # The first segment the state does not include yet.
+        self.segment = segment
+
+    def apply(self, change):
+        command, *args = change
+        if command == "CREATE_PLAYLIST":
+            self.playlists.setdefault(args[0].lower(), (args[0], {}))
+        elif command == "DELETE_PLAYLIST":
+            self.playlists.pop(args[0].lower(), None)
+        elif command == "FLAG_VIDEO":
+            self.flags[args[0]] = args[1]
+        elif command == "ALLOW_VIDEO":
+            self.flags[args[0]] = None
+        else:
+            playlist = self.playlists.get(args[0].lower())
+            if playlist is None:
+                return
+            if command == "ADD_TO_PLAYLIST":
+                playlist[1][args[1]] = None
+            elif command == "REMOVE_FROM_PLAYLIST":
+                playlist[1].pop(args[1], None)
+            elif command == "CLEAR_PLAYLIST":
+                playlist[1].clear()
+
+    def to_json(self):
+        return {
+            "segment": self.segment,
+            "playlists": [[name, list(video_ids)]
+                          for name, video_ids in self.playlists.values()],
+            "flags": self.flags,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["playlists"], data["flags"], data["segment"])
+
+
+def load_state(directory) -> JournalState:
+    """Reads the snapshot and replays the segments written after it."""
+    directory = Path(directory)
+    try:
+        with open(directory / _SNAPSHOT_NAME) as snapshot:
+            state = JournalState.from_json(json.load(snapshot))
+    except FileNotFoundError:
+        state = JournalState()
+    for number in _segment_numbers(directory):
+        if number >= state.segment:
+            for change in _read_segment(_segment_path(directory, number)):
+                state.apply(change)
+    return state
+
+
+def _write_state(directory: Path, state: JournalState):
+    temp_path = directory / (_SNAPSHOT_NAME + ".tmp")
+    with open(temp_path, "w") as snapshot:
+        json.dump(state.to_json(), snapshot, separators=(",", ":"))
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temp_path, directory / _SNAPSHOT_NAME)
+
+
+class Journal:
+    """Writes every change to the playlists and flags to the end of a log,
+    so a change costs one short write no matter how many playlists there
+    are.
+
+    The log lives in `directory` as numbered segments. A background thread
+    writes and fsyncs the changes: everything that arrived while it was
+    busy with the last fsync goes out with a single fsync (group commit).
+    Once compact_after changes have been written, the writer moves on to a
+    new segment and another thread folds the old ones into snapshot.json
+    and deletes them. Every step leaves files that replay correctly, even
+    if the program dies half way.
+
+    Args:
+        directory: Where the journal is kept, created if needed.
+        wait_for_commit: If True, append returns only once the change is
+            on disk. If False it returns straight away and the change is
+            on disk a moment later, or by close() at the latest.
+        compact_after: How many changes to write before compacting.
+    """
+
+    def __init__(self, directory, wait_for_commit=True, compact_after=10_000):
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._wait_for_commit = wait_for_commit
+        self._compact_after = compact_after
+        self._condition = threading.Condition()
+        self._pending = []
+        self._appended = 0
+        self._committed = 0
+        self._error = None
+        self._closing = False
+        self._compaction = None
+
+        # Start a new segment, so nothing is ever written after a half
+        # written line, unless the last one is still empty.
+        self._segment = max(_segment_numbers(self._directory), default=0)
+        if (not self._segment or
+                _segment_path(self._directory, self._segment).stat().st_size):
+            self._segment += 1
+        self._uncompacted = 0
+        self._file = open(_segment_path(self._directory, self._segment), "ab")
+        self._writer = threading.Thread(target=self._write_changes,
+                                        name="journal-writer", daemon=True)
+        self._writer.start()
+
+    def replay(self, videos, playlists):
+        """Brings the VideoLibrary `videos` and the VideoPlaylistLibrary
+        `playlists` back to where the journal left them. Videos that are no
+        longer in the catalog are skipped."""
+        state = load_state(self._directory)
+        # Flag the videos a reason at a time, so the library updates its
+        # indexes once per reason and not once per video.
+        ids_by_reason = {}
+        for video_id, reason in state.flags.items():
+            ids_by_reason.setdefault(reason, []).append(video_id)
+        for reason, video_ids in ids_by_reason.items():
+            if reason is None:
+                videos.allow_videos(video_ids)
+            else:
+                videos.flag_videos(video_ids, reason)
+        for name, video_ids in state.playlists.values():
+            if name not in playlists:
+                playlists.create(name)
+            playlists[name].add_videos(videos.find_videos(video_ids)[0])
+        return state
+
+    def append(self, *change: str):
+        """Adds a change, e.g. append("ADD_TO_PLAYLIST", name, video_id).
+        Raises JournalError if the journal cannot be written."""
+        self.append_many([change])
+
+    def append_many(self, changes):
+        """Adds several changes, waiting (if we wait at all) for one commit
+        of all of them instead of one per change."""
+        lines = [(json.dumps(change, separators=(",", ":")) + "\n").encode()
+                 for change in changes]
+        if not lines:
+            return
+        with self._condition:
+            if self._closing:
+                raise JournalError("The journal is closed")
+            self._check()
+            self._pending.extend(lines)
+            self._appended += len(lines)
+            number = self._appended
+            self._condition.notify_all()
+            if self._wait_for_commit:
+                while self._committed < number and self._error is None:
+                    self._condition.wait()
+                self._check()
+
+    def flush(self):
+        """Waits until every change appended so far is on disk."""
+        with self._condition:
+            number = self._appended
+            while self._committed < number and self._error is None:
+                self._condition.wait()
+            self._check()
+
+    def close(self):
+        """Writes the remaining changes and stops the background threads."""
+        with self._condition:
+            if self._closing:
+                return
+            self._closing = True
+            self._condition.notify_all()
+        self._writer.join()
+        if self._compaction is not None:
+            self._compaction.join()
+        self._file.close()
+        with self._condition:
+            self._check()
+
+    def _check(self):
+        if self._error is not None:
+            raise JournalError(f"Cannot write the journal: {self._error}")
+
+    def _write_changes(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closing:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                lines, self._pending = self._pending, []
+                number = self._appended
+            try:
+                self._file.write(b"".join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._uncompacted += len(lines)
+                if self._uncompacted >= self._compact_after:
+                    self._start_compaction()
+            except OSError as e:
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._committed = number
+                self._condition.notify_all()
+
+    def _start_compaction(self):
+        if self._compaction is not None and self._compaction.is_alive():
+            return
+        self._file.close()
+        self._segment += 1
+        self._file = open(_segment_path(self._directory, self._segment), "ab")
+        self._uncompacted = 0
+        self._compaction = threading.Thread(
+            target=self._compact, args=(self._segment,),
+            name="journal-compaction", daemon=True)
+        self._compaction.start()
+
+    def _compact(self, segment):
+        """Folds every segment before `segment` into the snapshot. If this
+        fails the segments are kept, and the next compaction tries again."""
+        state = JournalState()
+        try:
+            with open(self._directory / _SNAPSHOT_NAME) as snapshot:
+                state = JournalState.from_json(json.load(snapshot))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            return
+        finished = [number for number in _segment_numbers(self._directory)
+                    if state.segment <= number < segment]
+        try:
+            for number in finished:
+                for change in _read_segment(_segment_path(self._directory, number)):
+                    state.apply(change)
+            state.segment = segment
+            _write_state(self._directory, state)
+        except (OSError, ValueError):
+            return
+        for number in _segment_numbers(self._directory):
+            if number < segment:
+                _segment_path(self._directory, number).unlink(missing_ok=True)
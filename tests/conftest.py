@@ -0,0 +1,54 @@
+"""Loads the notebook export as one module for the tests."""
+
+import pathlib
+import random
+import re
+import sys
+import types
+
+import pytest
+
+SOURCE = pathlib.Path(__file__).resolve().parent.parent / "Google Sample Work.py"
+
+
+def _load():
+    text = SOURCE.read_text()
+    # The cells share one namespace here, so the notebook magics and the
+    # imports from one cell of another are left out.
+    text = re.sub(r"^get_ipython\(\).*$", "", text, flags=re.M)
+    text = re.sub(r"^from \.[\w.]* import .*$", "", text, flags=re.M)
+    text = re.sub(r"^from \. import .*$", "", text, flags=re.M)
+    module = types.ModuleType("google_sample_work")
+    module.__file__ = str(SOURCE)
+    module.video_playlist_library = module
+    # Worker processes find their functions through sys.modules.
+    sys.modules[module.__name__] = module
+    exec(compile(text, str(SOURCE), "exec"), module.__dict__)
+    return module
+
+
+@pytest.fixture(scope="session")
+def app():
+    return _load()
+
+
+def random_catalog(rng, rows, words=("cat", "dog", "Car", "ca", "a", "tac", "go"),
+                   tags=("#a", "#b", "#c", "#d", "#e")):
+    """Text of a videos.txt with `rows` random rows. Few words and tags, so
+    titles share trigrams and videos share tags."""
+    lines = []
+    for i in range(rows):
+        title = " ".join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+        video_tags = " , ".join(rng.sample(tags, rng.randint(0, 3)))
+        lines.append(f"{title} {i} | video_{i} | {video_tags}")
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    """Writes a random catalog and returns its path."""
+    def write(rows=500, seed=0, text=None):
+        path = tmp_path / "videos.txt"
+        path.write_text(text if text is not None else random_catalog(random.Random(seed), rows))
+        return path
+    return write
@@ -0,0 +1,27 @@
+"""Batch mode writes its output in blocks, searches included."""
+
+import io
+
+
+class CountingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+def test_searches_do_not_flush_each_time(app, catalog, monkeypatch):
+    path = catalog(rows=50)
+    library = app.VideoLibrary
+    monkeypatch.setattr(app, "VideoLibrary",
+                        lambda **kwargs: library(path=path, use_snapshot=False, **kwargs))
+    out = CountingStream()
+    app.run_batch(["SEARCH_VIDEOS cat", "0", "SEARCH_VIDEOS dog", "1",
+                   "SEARCH_VIDEOS_WITH_TAG #a", "no", "SHOW_PLAYING"], out=out)
+    text = out.getvalue()
+    assert out.writes == 1
+    assert text.count("Would you like to play any of the above?") == 3
+    assert "Playing video: " in text
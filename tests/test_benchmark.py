@@ -0,0 +1,11 @@
+"""The benchmark runs on any catalog size, however few words it has."""
+
+import pytest
+
+
+@pytest.mark.parametrize("seed", [1, 2, 4])
+def test_tiny_catalog(app, tmp_path, seed):
+    report = app.run_benchmarks([1], calls=3, seed=seed, output=tmp_path / "bench.json",
+                                workdir=tmp_path)
+    operations = {result["operation"] for result in report["results"]}
+    assert {"SEARCH_RANKED", "SEARCH_VIDEOS_WITH_TAG compound"} <= operations
@@ -0,0 +1,40 @@
+"""Cursors the player didn't make are refused, not followed."""
+
+import base64
+import json
+
+import pytest
+
+
+def _cursor(position, number):
+    return base64.urlsafe_b64encode(json.dumps([position, number]).encode()).decode().rstrip("=")
+
+
+@pytest.fixture
+def run(app, catalog):
+    library = app.VideoLibrary(path=catalog(rows=30), use_snapshot=False)
+    player = app.VideoPlayer(chooser=lambda prompt: "", sink=app.CollectorSink(),
+                             videos=library)
+    parser = app.CommandParser(player)
+
+    def run(line):
+        player.sink.clear()
+        parser.execute_command(line.split())
+        return player.sink.text()
+
+    run("CREATE_PLAYLIST my")
+    for i in range(10):
+        run(f"ADD_TO_PLAYLIST my video_{i}")
+    return run
+
+
+def test_playlist_pages(run):
+    first = run("SHOW_PLAYLIST my LIMIT 4")
+    cursor = first.split("AFTER ")[1].split()[0]
+    assert "video_4" in run(f"SHOW_PLAYLIST my LIMIT 4 AFTER {cursor}")
+
+
+@pytest.mark.parametrize("cursor", ["Wy01LDFd", _cursor(-1, 1), _cursor("x", 1),
+                                    _cursor(2, 0), "@@@@"])
+def test_bad_playlist_cursors(run, cursor):
+    assert "Invalid cursor" in run(f"SHOW_PLAYLIST my AFTER {cursor}")
@@ -0,0 +1,101 @@
+"""The journal brings the playlists and flags back after a restart."""
+
+import json
+
+import pytest
+
+
+@pytest.fixture
+def restore(app, catalog):
+    path = catalog(rows=30)
+
+    def restore(directory):
+        """A fresh library and playlists, replayed from the journal."""
+        library = app.VideoLibrary(path=path, use_snapshot=False)
+        playlists = app.VideoPlaylistLibrary()
+        journal = app.Journal(directory)
+        try:
+            journal.replay(library, playlists)
+        finally:
+            journal.close()
+        return library, playlists
+    return restore
+
+
+def _ids(videos):
+    return [video.video_id for video in videos]
+
+
+def test_replay_after_close(app, restore, tmp_path):
+    journal = app.Journal(tmp_path / "journal")
+    journal.append("CREATE_PLAYLIST", "Mine")
+    journal.append_many([("ADD_TO_PLAYLIST", "Mine", f"video_{i}") for i in (3, 1, 2)])
+    journal.append("REMOVE_FROM_PLAYLIST", "mine", "video_1")
+    journal.append("FLAG_VIDEO", "video_5", "spam")
+    journal.append("CREATE_PLAYLIST", "gone")
+    journal.append("DELETE_PLAYLIST", "GONE")
+    journal.close()
+    with pytest.raises(app.JournalError):
+        journal.append("CREATE_PLAYLIST", "late")
+
+    library, playlists = restore(tmp_path / "journal")
+    assert "gone" not in playlists
+    assert _ids(playlists["mine"].videos) == ["video_3", "video_2"]
+    assert str(library["video_5"]).endswith("FLAGGED (reason: spam)")
+    assert "video_5" not in _ids(library.get_allowed_videos())
+
+
+def test_compaction_keeps_every_change(app, restore, tmp_path):
+    directory = tmp_path / "journal"
+    journal = app.Journal(directory, compact_after=3)
+    journal.append("CREATE_PLAYLIST", "mine")
+    for i in range(10):
+        journal.append("ADD_TO_PLAYLIST", "mine", f"video_{i}")
+    journal.append("CLEAR_PLAYLIST", "mine")
+    for i in range(10, 14):
+        journal.append("ADD_TO_PLAYLIST", "mine", f"video_{i}")
+    journal.close()
+
+    snapshot = json.loads((directory / "snapshot.json").read_text())
+    segments = sorted(path.name for path in directory.glob("*.log"))
+    assert segments and all(int(name[:-4]) >= snapshot["segment"] for name in segments)
+    expected = [f"video_{i}" for i in range(10, 14)]
+    assert list(app.load_state(directory).playlists["mine"][1]) == expected
+    _, playlists = restore(directory)
+    assert _ids(playlists["mine"].videos) == expected
+
+
+def test_half_written_last_line_is_ignored(app, restore, tmp_path):
+    directory = tmp_path / "journal"
+    journal = app.Journal(directory)
+    journal.append("CREATE_PLAYLIST", "mine")
+    journal.append("ADD_TO_PLAYLIST", "mine", "video_1")
+    journal.close()
+    segment = sorted(directory.glob("*.log"))[-1]
+    with open(segment, "ab") as log:
+        log.write(b'["ADD_TO_PLAYLIST","mine","vid')
+
+    assert list(app.load_state(directory).playlists["mine"][1]) == ["video_1"]
+    # Reopening starts a new segment, so later changes are not lost
+    # behind the half written line.
+    journal = app.Journal(directory)
+    journal.append("ADD_TO_PLAYLIST", "mine", "video_2")
+    journal.close()
+    _, playlists = restore(directory)
+    assert _ids(playlists["mine"].videos) == ["video_1", "video_2"]
+
+
+def test_flag_changes_collapse_to_the_last(app, restore, tmp_path):
+    directory = tmp_path / "journal"
+    journal = app.Journal(directory)
+    journal.append("FLAG_VIDEO", "video_1", "spam")
+    journal.append("ALLOW_VIDEO", "video_1")
+    journal.append("FLAG_VIDEO", "video_1", "dull")
+    journal.append("FLAG_VIDEO", "video_2", "spam")
+    journal.append("ALLOW_VIDEO", "video_2")
+    journal.close()
+
+    assert app.load_state(directory).flags == {"video_1": "dull", "video_2": None}
+    library, _ = restore(directory)
+    assert str(library["video_1"]).endswith("FLAGGED (reason: dull)")
+    assert not library["video_2"].is_flagged
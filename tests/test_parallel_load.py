@@ -0,0 +1,68 @@
+"""Parsing videos.txt with worker processes must give the same rows, and
+the same error, as parsing it in this process."""
+
+import random
+
+import pytest
+
+from conftest import random_catalog
+
+
+def read(app, path, workers):
+    try:
+        return list(app._read_catalog(path, workers))
+    except ValueError as e:
+        return type(e), str(e)
+
+
+CASES = {
+    "rows": random_catalog(random.Random(0), 1000),
+    "no final newline": "".join(f"t {i} | v{i} | #a\n" for i in range(100)) + "last | vl | #x",
+    "crlf": "".join(f"t {i} | v{i} | #a , #b\r\n" for i in range(300)),
+    "empty": "",
+    "one row": "title | id | #tag",
+    "non-ascii": "".join(f"Tïtlé ☃ {i} | v{i} | #ü\n" for i in range(300)),
+    "malformed early": "ok | 1 | #a\nbroken\n" + "".join(f"t {i} | v{i} |\n" for i in range(500)),
+    "malformed late": "".join(f"t {i} | v{i} |\n" for i in range(500)) + "a | b | c | d\n",
+    "blank line": "".join(f"t {i} | v{i} |\n" for i in range(300)) + "\nt | v | #a\n",
+}
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_parallel_matches_serial(app, tmp_path, name):
+    path = tmp_path / "videos.txt"
+    path.write_text(CASES[name])
+    assert read(app, path, 3) == read(app, path, 0)
+
+
+def test_malformed_row_raises_value_error(app, tmp_path):
+    path = tmp_path / "videos.txt"
+    path.write_text(CASES["malformed early"])
+    with pytest.raises(ValueError, match="not enough values to unpack"):
+        list(app._read_catalog(path, 3))
+
+
+def test_library_loads_the_same(app, catalog):
+    path = catalog(rows=3000)
+    serial = app.VideoLibrary(path=path, use_snapshot=False)
+    parallel = app.VideoLibrary(path=path, use_snapshot=False, load_workers=2,
+                                parallel_load_threshold=0)
+    assert list(map(str, parallel.get_all_videos())) == list(map(str, serial.get_all_videos()))
+    assert parallel.reload() == ([], [], [])
+
+
+def test_player_passes_worker_options(app, catalog, monkeypatch):
+    path = catalog(rows=200)
+    library = app.VideoLibrary
+    options = []
+
+    def recording_library(**kwargs):
+        options.append((kwargs["load_workers"], kwargs["search_workers"]))
+        return library(path=path, use_snapshot=False, parallel_load_threshold=0, **kwargs)
+
+    monkeypatch.setattr(app, "VideoLibrary", recording_library)
+    player = app.VideoPlayer(chooser=lambda prompt: "", sink=app.CollectorSink(),
+                             load_workers=2, search_workers=4)
+    server = app.VideoServer(load_workers=3, search_workers=5)
+    assert options == [(2, 4), (3, 5)]
+    assert len(player.videos) == len(server.videos) == 200
@@ -0,0 +1,18 @@
+"""What a playlist command said stays as it was said."""
+
+
+def test_show_playlist_result_does_not_follow_the_playlist(app, catalog):
+    library = app.VideoLibrary(path=catalog(rows=10), use_snapshot=False)
+    sink = app.CollectorSink()
+    player = app.VideoPlayer(chooser=lambda prompt: "", sink=sink, videos=library)
+    player.create_playlist("mine")
+    player.add_to_playlist("mine", "video_1")
+    shown = player.show_playlist("mine")
+    text = sink.text()
+    player.add_to_playlist("mine", "video_2")
+
+    assert [video.video_id for video in shown.value] == ["video_1"]
+    outputs = [output for output in shown.outputs if output.videos is not None]
+    assert [video.video_id for video in outputs[0].videos] == ["video_1"]
+    assert sink.text().startswith(text)
+    assert "video_2" not in str(shown.to_dict())
@@ -0,0 +1,43 @@
+"""Videos a reload removes are applied by the player's own commands."""
+
+import gc
+import threading
+
+
+def _player(app, library):
+    player = app.VideoPlayer(chooser=lambda prompt: "", sink=app.CollectorSink(),
+                             videos=library)
+    parser = app.CommandParser(player)
+    return player, parser
+
+
+def test_removals_wait_for_the_next_command(app, catalog):
+    path = catalog(rows=50)
+    library = app.VideoLibrary(path=path, use_snapshot=False)
+    player, parser = _player(app, library)
+    parser.execute_command(["CREATE_PLAYLIST", "mine"])
+    for video_id in ("video_3", "video_4"):
+        parser.execute_command(["ADD_TO_PLAYLIST", "mine", video_id])
+    parser.execute_command(["PLAY", "video_3"])
+    lines = path.read_text().splitlines()
+    path.write_text("\n".join(line for line in lines if "| video_3 |" not in line) + "\n")
+
+    reloader = threading.Thread(target=library.reload)
+    reloader.start()
+    reloader.join()
+    assert player.playback.get_video().video_id == "video_3"
+    assert [v.video_id for v in player.playlists["mine"].videos] == ["video_3", "video_4"]
+
+    parser.execute_command(["NUMBER_OF_VIDEOS"])
+    assert player.playback.state == app.PlaybackState.STOPPED
+    assert [v.video_id for v in player.playlists["mine"].videos] == ["video_4"]
+    assert "Stopping video" in player.sink.text()
+
+
+def test_dead_listeners_are_dropped(app, catalog):
+    library = app.VideoLibrary(path=catalog(rows=20), use_snapshot=False)
+    for _ in range(50):
+        _player(app, library)
+    gc.collect()
+    player, _ = _player(app, library)
+    assert len(library._removal_listeners) == 1
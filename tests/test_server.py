@@ -0,0 +1,115 @@
+"""The server runs each session's commands off the event loop."""
+
+import asyncio
+import threading
+
+
+def test_slow_command_does_not_block_other_connections(app, catalog):
+    server = app.VideoServer(app.VideoLibrary(path=catalog(rows=50), use_snapshot=False))
+    release = threading.Event()
+    sessions = []
+
+    def session():
+        created = app.VideoSession(server.videos)
+        sessions.append(created)
+        if len(sessions) == 1:
+            handle_line = created.handle_line
+            created.handle_line = lambda line: release.wait(10) and handle_line(line)
+        return created
+
+    server.session = session
+
+    async def main():
+        listening = await server.start(port=0)
+        port = listening.sockets[0].getsockname()[1]
+        slow_reader, slow_writer = await asyncio.open_connection("127.0.0.1", port)
+        await slow_reader.readuntil(b"YT> ")
+        slow_writer.write(b"NUMBER_OF_VIDEOS\n")
+        await slow_writer.drain()
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"YT> ")
+        writer.write(b"NUMBER_OF_VIDEOS\n")
+        await writer.drain()
+        answer = await asyncio.wait_for(reader.readuntil(b"YT> "), 5)
+        assert answer.startswith(b"50 videos")
+        assert not release.is_set()
+
+        release.set()
+        answer = await asyncio.wait_for(slow_reader.readuntil(b"YT> "), 5)
+        assert answer.startswith(b"50 videos")
+        for stream in (writer, slow_writer):
+            stream.close()
+        listening.close()
+        await listening.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_sessions_leave_out_local_commands(app, catalog, tmp_path):
+    session = app.VideoSession(app.VideoLibrary(path=catalog(rows=10), use_snapshot=False))
+    for line in (f"STATS DUMP {tmp_path / 'stats.json'}", f"PROFILE START {tmp_path}",
+                 "MEMORY", "RELOAD"):
+        assert session.handle_line(line).startswith("Please enter a valid command")
+    assert list(tmp_path.iterdir()) == [tmp_path / "videos.txt"]
+    text = session.handle_line("HELP")
+    assert "SHOW_ALL_VIDEOS" in text
+    assert not any(f"    {name}" in text for name in app.LOCAL_COMMANDS)
+
+
+def test_sessions_cannot_read_files(app, catalog, tmp_path):
+    ids = tmp_path / "ids.txt"
+    ids.write_text("video_1\nvideo_2\n")
+    library = app.VideoLibrary(path=catalog(rows=10), use_snapshot=False)
+    session = app.VideoSession(library)
+    assert "not allowed" in session.handle_line(f"FLAG_VIDEOS_FROM @{ids}")
+    # Without the @ it is an id, however much it looks like a file.
+    assert "1 not found" in session.handle_line(f"FLAG_VIDEOS_FROM {ids}")
+    assert not any(video.is_flagged for video in library.get_all_videos())
+
+    player = app.VideoPlayer(chooser=lambda prompt: "", sink=app.CollectorSink(),
+                             videos=library)
+    app.CommandParser(player).execute_command(["FLAG_VIDEOS_FROM", f"@{ids}"])
+    assert sorted(v.video_id for v in library.get_all_videos() if v.is_flagged) == [
+        "video_1", "video_2"]
+
+
+def test_long_lines_are_refused_not_dropped(app, catalog):
+    library = app.VideoLibrary(path=catalog(rows=50), use_snapshot=False)
+    server = app.VideoServer(library)
+    ids = ",".join(f"video_{i % 50}" for i in range(8000)).encode()
+
+    async def main():
+        listening = await server.start(port=0, limit=4096)
+        port = listening.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"YT> ")
+        writer.write(b"CREATE_PLAYLIST mine\n")
+        await reader.readuntil(b"YT> ")
+        writer.write(b"FLAG_VIDEOS_FROM " + ids + b"\nSHOW_ALL_PLAYLISTS\n")
+        await writer.drain()
+        refused = await asyncio.wait_for(reader.readuntil(b"YT> "), 5)
+        assert b"limited to 4096 bytes" in refused
+        answer = await asyncio.wait_for(reader.readuntil(b"YT> "), 5)
+        assert b"mine" in answer
+        writer.close()
+        listening.close()
+        await listening.wait_closed()
+
+    asyncio.run(main())
+    assert not any(video.is_flagged for video in library.get_all_videos())
+
+    async def default_limit():
+        listening = await server.start(port=0)
+        port = listening.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"YT> ")
+        writer.write(b"FLAG_VIDEOS_FROM " + ids + b"\n")
+        await writer.drain()
+        answer = await asyncio.wait_for(reader.readuntil(b"YT> "), 5)
+        assert b"Successfully flagged 50 videos" in answer
+        writer.close()
+        listening.close()
+        await listening.wait_closed()
+
+    asyncio.run(default_limit())
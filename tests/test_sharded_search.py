@@ -0,0 +1,48 @@
+"""Sharded title search finds what the trigram index finds."""
+
+import random
+
+import pytest
+
+from conftest import random_catalog
+
+WORDS = ("cat", "dog", "Car", "ca", "a", "tac", "go", "Café", "ÜBER", "naïve")
+TERMS = ["", "a", "c", "ca", "cat", "é", "caf", "café", "über", "ï", "at d", "zzz"]
+
+
+@pytest.fixture
+def libraries(app, catalog):
+    path = catalog(text=random_catalog(random.Random(7), 400, words=WORDS))
+    sharded = app.VideoLibrary(path=path, use_snapshot=False, search_workers=2,
+                               shard_threshold=0)
+    plain = app.VideoLibrary(path=path, use_snapshot=False)
+    yield sharded, plain
+    sharded.close()
+
+
+def _ids(videos):
+    return [video.video_id for video in videos]
+
+
+def test_shards_match_the_index(app, libraries):
+    library, _ = libraries
+    videos = library.get_all_videos()
+    rows = {video: row for row, video in enumerate(videos)}
+    search = app.ShardedSearch(videos, 3)
+    try:
+        for term in TERMS:
+            expected = sorted(library._titles.search(term), key=rows.__getitem__)
+            assert _ids(search.search(term)) == _ids(expected), term
+    finally:
+        search.close()
+
+
+def test_library_search_with_workers(libraries):
+    sharded, plain = libraries
+    for video_id in _ids(plain.get_all_videos())[::7]:
+        sharded.flag_video(video_id, "spam")
+        plain.flag_video(video_id, "spam")
+    for term in TERMS:
+        assert _ids(sharded.search_videos(term)) == _ids(plain.search_videos(term)), term
+        assert (_ids(sharded.search_videos(term, offset=2, limit=5))
+                == _ids(plain.search_videos(term, offset=2, limit=5))), term
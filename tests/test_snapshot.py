@@ -0,0 +1,72 @@
+"""The snapshot gives back the catalog it saved, and is only ever read as
+data: a damaged one is ignored and the catalog parsed again."""
+
+import json
+
+import pytest
+
+
+def _texts(videos):
+    return [str(video) for video in videos]
+
+
+def test_round_trip(app, catalog):
+    path = catalog(rows=800)
+    parsed = app.VideoLibrary(path=path)
+    assert app.snapshot_path(path).exists()
+    loaded = app.VideoLibrary(path=path)
+    assert _texts(loaded.get_all_videos()) == _texts(parsed.get_all_videos())
+    for term in ("cat", "ca", "dog car", "a", "missing"):
+        assert _texts(loaded.search_videos(term)) == _texts(parsed.search_videos(term))
+        assert _texts(loaded.search_ranked(term, 20)) == _texts(parsed.search_ranked(term, 20))
+    assert loaded.reload() == ([], [], [])
+
+
+@pytest.mark.parametrize("damage", [
+    lambda data, header: data[:-3],
+    lambda data, header: data + b"\0" * 8,
+    lambda data, header: data[:header],
+    # A pickle where the catalog should be.
+    lambda data, header: data[:header] + b"\x80\x04\x95" + data[header + 3:],
+    # Lengths that point past the end of the file.
+    lambda data, header: data[:header] + b"\xff" * 8 + data[header + 8:],
+])
+def test_damaged_snapshot_is_parsed_again(app, catalog, damage):
+    path = catalog(rows=300)
+    parsed = app.VideoLibrary(path=path)
+    snapshot = app.snapshot_path(path)
+    snapshot.write_bytes(damage(snapshot.read_bytes(), app._SNAPSHOT_HEADER.size))
+    assert app.load_snapshot(path) is None
+    assert _texts(app.VideoLibrary(path=path).get_all_videos()) == _texts(parsed.get_all_videos())
+
+
+def _rewrite_header(app, snapshot, change):
+    """Rewrites the JSON part of a snapshot with change(header) applied."""
+    data = snapshot.read_bytes()
+    start = app._SNAPSHOT_HEADER.size
+    (length,) = app._SNAPSHOT_LENGTH.unpack_from(data, start)
+    body = start + app._SNAPSHOT_LENGTH.size
+    header = json.loads(data[body:body + length])
+    change(header)
+    encoded = json.dumps(header).encode()
+    snapshot.write_bytes(data[:start] + app._SNAPSHOT_LENGTH.pack(len(encoded))
+                         + encoded + data[body + length:])
+
+
+@pytest.mark.parametrize("change", [
+    lambda header: header["rows"][0].pop(),
+    lambda header: header["rows"][0].append("extra"),
+    lambda header: header["rows"].__setitem__(0, "abc"),
+    lambda header: header["rows"][0].__setitem__(2, "#a"),
+    lambda header: header["rows"][0][2].append(7),
+    lambda header: header["rows"][0].__setitem__(0, None),
+    lambda header: header["keys"].__setitem__(0, 1),
+    lambda header: header["rows"][1].__setitem__(1, header["rows"][0][1]),
+])
+def test_malformed_rows_are_parsed_again(app, catalog, change):
+    path = catalog(rows=300)
+    parsed = app.VideoLibrary(path=path)
+    snapshot = app.snapshot_path(path)
+    _rewrite_header(app, snapshot, change)
+    assert app.load_snapshot(path) is None
+    assert _texts(app.VideoLibrary(path=path).get_all_videos()) == _texts(parsed.get_all_videos())
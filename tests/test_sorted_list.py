@@ -0,0 +1,106 @@
+"""SortedVideoList must behave like a plain sorted list, whatever blocks
+it keeps the videos in."""
+
+import random
+
+
+def make_videos(app, count):
+    return [app.Video(f"title {i:05d}", f"id_{i}", []) for i in range(count)]
+
+
+def check(sorted_list, expected):
+    assert len(sorted_list) == len(expected)
+    assert list(sorted_list.view()) == expected
+    assert list(sorted_list.keys()) == [video.title for video in expected]
+    view = sorted_list.view()
+    for i in range(0, len(expected), 37):
+        assert view[i] is expected[i]
+        assert sorted_list.index(expected[i]) == i
+    if expected:
+        assert view[-1] is expected[-1]
+
+
+def test_random_changes(app):
+    rng = random.Random(3)
+    videos = make_videos(app, 3000)
+    key = lambda video: video.title
+    sorted_list = app.SortedVideoList(key, videos[:1000])
+    expected = sorted(videos[:1000], key=key)
+    outside = videos[1000:]
+    for step in range(3000):
+        if outside and rng.random() < 0.6:
+            video = outside.pop(rng.randrange(len(outside)))
+            sorted_list.add(video)
+            expected.append(video)
+            expected.sort(key=key)
+        elif expected:
+            video = expected.pop(rng.randrange(len(expected)))
+            sorted_list.remove(video)
+            outside.append(video)
+        if step % 300 == 0:
+            check(sorted_list, expected)
+    check(sorted_list, expected)
+
+    removed = rng.sample(expected, 500)
+    added = outside[:400]
+    sorted_list.update(removed, added)
+    expected = sorted(set(expected) - set(removed) | set(added), key=key)
+    check(sorted_list, expected)
+
+
+def test_paging(app):
+    videos = make_videos(app, 1000)
+    sorted_list = app.SortedVideoList(lambda video: video.title, videos)
+    assert sorted_list.page(offset=995, limit=10) == tuple(videos[995:])
+    assert sorted_list.page(after=videos[499].title, offset=2, limit=3) == tuple(videos[502:505])
+    assert sorted_list.page(after="title 99999") == ()
+    assert sorted_list.position_after(videos[10].title) == 11
+    assert sorted_list.view()[100:250] == tuple(videos[100:250])
+    assert sorted_list.view()[::-100] == tuple(videos[::-100])
+
+
+def test_views_keep_their_snapshot(app):
+    videos = make_videos(app, 500)
+    sorted_list = app.SortedVideoList(lambda video: video.title, videos[:400])
+    before = sorted_list.view()
+    for video in videos[400:]:
+        sorted_list.add(video)
+    sorted_list.remove(videos[0])
+    assert list(before) == videos[:400]
+    assert list(sorted_list.view()) == videos[1:]
+
+
+def test_empty(app):
+    video = make_videos(app, 1)[0]
+    sorted_list = app.SortedVideoList(lambda video: video.title)
+    assert len(sorted_list) == 0 and list(sorted_list.view()) == []
+    assert video not in sorted_list
+    sorted_list.add(video)
+    sorted_list.remove(video)
+    assert len(sorted_list) == 0 and sorted_list.page() == ()
+
+
+def test_random_set_never_shows_a_removed_video(app):
+    videos = [app.Video(f"title {i}", f"video_{i}", []) for i in range(50)]
+    pool = app.RandomSet(videos)
+    removed = set()
+
+    class Watched(list):
+        """Checks, whenever the list is written, that a reader could only
+        find videos still in the set."""
+        def __setitem__(self, index, value):
+            super().__setitem__(index, value)
+            assert not removed.intersection(self)
+
+        def pop(self):
+            assert not removed.intersection(self[:-1])
+            return super().pop()
+
+    pool._videos = Watched(pool._videos)
+    rng = random.Random(3)
+    for video in rng.sample(videos, 49):
+        removed.add(video)
+        pool.remove(video)
+        assert not removed.intersection(pool._videos)
+    assert len(pool) == 1
+    assert pool.choice(rng) not in removed
@@ -0,0 +1,50 @@
+"""STATS answers while the videos are still loading."""
+
+import threading
+
+
+def test_stats_does_not_wait_for_loading(app, catalog, monkeypatch):
+    path = catalog(rows=20)
+    release = threading.Event()
+    library = app.VideoLibrary
+
+    def slow_library(**kwargs):
+        release.wait(10)
+        return library(path=path, use_snapshot=False, **kwargs)
+
+    monkeypatch.setattr(app, "VideoLibrary", slow_library)
+    player = app.VideoPlayer(chooser=lambda prompt: "", sink=app.CollectorSink(),
+                             background=True)
+    parser = app.CommandParser(player)
+    parser.execute_command(["STATS"])
+    assert not release.is_set()
+    assert "Query cache" not in player.sink.text()
+
+    release.set()
+    parser.execute_command(["NUMBER_OF_VIDEOS"])
+    player.sink.clear()
+    parser.execute_command(["STATS"])
+    assert "Query cache: 0 hits" in player.sink.text()
+
+
+def test_commands_report_a_failed_load(app, tmp_path, monkeypatch):
+    library = app.VideoLibrary
+    monkeypatch.setattr(app, "VideoLibrary",
+                        lambda **kwargs: library(path=tmp_path / "missing.txt", **kwargs))
+    player = app.VideoPlayer(chooser=lambda prompt: "", sink=app.CollectorSink(),
+                             background=True)
+    parser = app.CommandParser(player)
+    parser.execute_command(["CREATE_PLAYLIST", "mine"])
+    for command in (["SHOW_ALL_VIDEOS"], ["PLAY", "video_1"], ["ADD_TO_PLAYLIST", "mine", "x"],
+                    ["SEARCH_VIDEOS", "cat"], ["NUMBER_OF_VIDEOS"], ["STATUS"]):
+        player.sink.clear()
+        parser.execute_command(command)
+        assert player.sink.text().startswith(
+            "Videos could not be loaded: [Errno 2] No such file"), command
+    for command in (["MEMORY"], ["STATS"], ["SHOW_ALL_PLAYLISTS"]):
+        player.sink.clear()
+        parser.execute_command(command)
+        assert "could not be loaded" not in player.sink.text(), command
+    assert "mine" in player.sink.text()
+    result = player.show_all_videos()
+    assert [output.event for output in result.outputs] == ["load_failed"]
@@ -0,0 +1,88 @@
+"""Boolean tag queries must match evaluating the query on every video."""
+
+import random
+
+import pytest
+
+TAGS = ["#a", "#b", "#c", "#d", "#e", "#missing"]
+
+
+def matches(query, video):
+    kind, value = query
+    if kind == "tag":
+        return value in video.tags
+    if kind == "not":
+        return not matches(value, video)
+    results = [matches(term, video) for term in value]
+    return all(results) if kind == "and" else any(results)
+
+
+def random_query(rng, depth=0):
+    roll = rng.random()
+    if depth > 3 or roll < 0.4:
+        return rng.choice(TAGS)
+    if roll < 0.55:
+        return "NOT " + random_query(rng, depth + 1)
+    operator = rng.choice([" AND ", " OR ", " ", " and ", " or "])
+    return f"({random_query(rng, depth + 1)}{operator}{random_query(rng, depth + 1)})"
+
+
+def check_queries(app, library, rng, count=200):
+    videos = library.get_all_videos()
+    for _ in range(count):
+        text = random_query(rng)
+        query = app.parse_tag_query(text)
+        expected = [v for v in videos if matches(query, v) and not v.is_flagged]
+        assert list(library.query_tags(text)) == expected, text
+        assert list(library.query_tags(text, offset=2, limit=7)) == expected[2:9], text
+        if expected:
+            after = library.sort_key(expected[0])
+            assert list(library.query_tags(text, after=after)) == expected[1:], text
+
+
+def test_queries_before_and_after_flags_and_reload(app, catalog):
+    rng = random.Random(5)
+    path = catalog(rows=2000)
+    library = app.VideoLibrary(path=path, use_snapshot=False)
+    check_queries(app, library, rng)
+
+    videos = list(library.get_all_videos())
+    for video in rng.sample(videos, 300):
+        video.flag("test")
+    check_queries(app, library, rng)
+    library.allow_videos([v.video_id for v in videos if v.is_flagged][:100])
+    check_queries(app, library, rng)
+
+    lines = path.read_text().splitlines()
+    lines = (lines[:1500] + [line.replace("#a", "#e") for line in lines[1500:1800]]
+             + [f"new {i} | new_{i} | #a , #b" for i in range(50)])
+    path.write_text("\n".join(lines) + "\n")
+    library.reload()
+    check_queries(app, library, rng)
+
+
+@pytest.mark.parametrize("text", ["", "AND", "#a AND", "(#a", "#a )", "NOT",
+                                  "#a OR OR #b", "()"])
+def test_invalid_queries(app, text):
+    with pytest.raises(app.TagQueryError):
+        app.parse_tag_query(text)
+
+
+def test_equivalent_queries_share_a_form(app):
+    assert (app.format_tag_query(app.parse_tag_query("#a and (#b OR #c)"))
+            == app.format_tag_query(app.parse_tag_query("#a (#b or #c)")))
+
+
+def test_long_queries_are_not_cut_off(app, catalog):
+    library = app.VideoLibrary(path=catalog(rows=200), use_snapshot=False)
+    player = app.VideoPlayer(chooser=None, sink=app.CollectorSink(), videos=library)
+    parser = app.CommandParser(player)
+    tags = ["#a", "#b", "#c", "#d", "#e"] * 30
+    parser.execute_command(["SEARCH_VIDEOS_WITH_TAG", *" OR ".join(tags).split()])
+    assert "Here are the results for" in player.sink.text()
+    player.sink.clear()
+    player.answer_choice("no")
+    player.sink.clear()
+    parser.execute_command(["SEARCH_RANKED", *["cat", "dog"] * 10, "LIMIT", "3"])
+    assert "Please enter" not in player.sink.text()
+    assert player.sink.text().count("video_") == 3
@@ -0,0 +1,24 @@
+"""Updating the term index must give the scores building it afresh gives."""
+
+import random
+
+import pytest
+
+
+def test_update_matches_rebuild(app, catalog):
+    library = app.VideoLibrary(path=catalog(rows=1500), use_snapshot=False)
+    videos = list(library.get_all_videos())
+    removed = random.Random(4).sample(videos[:1000], 300)
+    index = app.TermIndex(videos[:1000])
+    index.update(remove=removed[:100])
+    index.update(remove=removed[100:], add=videos[1000:1200])
+    for video in videos[1200:]:
+        index.add(video)
+    kept = [video for video in videos if video not in removed]
+    rebuilt = app.TermIndex(kept)
+    assert len(index) == len(rebuilt)
+    for terms in (["cat"], ["dog", "car"], ["a", "go", "tac"], ["ca"], ["missing"]):
+        scores, expected = index.scores(terms), rebuilt.scores(terms)
+        assert scores.keys() == expected.keys()
+        for video, score in expected.items():
+            assert scores[video] == pytest.approx(score)
@@ -0,0 +1,63 @@
+"""The trigram index must find exactly what `term in title.lower()` finds."""
+
+import random
+
+import pytest
+
+TERMS = ["", "c", "a", "ca", "cat", "CAT", "at d", "car", "tac g", "go 1", "1",
+         "12", "dog car", "xyz", "a ", " "]
+
+
+def brute_force(videos, term):
+    return {video for video in videos if term.lower() in video.title.lower()}
+
+
+def test_search_matches_substring_test(app, catalog):
+    library = app.VideoLibrary(path=catalog(), use_snapshot=False)
+    videos = list(library.get_all_videos())
+    index = app.TitleIndex(videos)
+    for term in TERMS:
+        assert set(index.search(term.lower())) == brute_force(videos, term), term
+
+
+def test_search_after_add_and_remove(app, catalog):
+    library = app.VideoLibrary(path=catalog(), use_snapshot=False)
+    videos = list(library.get_all_videos())
+    rng = random.Random(1)
+    index = app.TitleIndex(videos[:300])
+    for video in videos[300:]:
+        index.add(video)
+    removed = rng.sample(videos, 100)
+    for video in removed:
+        index.remove(video)
+    kept = [video for video in videos if video not in removed]
+    for term in TERMS:
+        assert set(index.search(term.lower())) == brute_force(kept, term), term
+
+
+@pytest.mark.parametrize("use_snapshot", [False, True])
+def test_library_search(app, catalog, use_snapshot):
+    path = catalog()
+    if use_snapshot:
+        # Written by the first load, read by the second.
+        app.VideoLibrary(path=path)
+    library = app.VideoLibrary(path=path, use_snapshot=use_snapshot)
+    videos = library.get_all_videos()
+    for video in random.Random(2).sample(list(videos), 50):
+        video.flag("test")
+    for term in TERMS:
+        expected = sorted((v for v in brute_force(videos, term) if not v.is_flagged),
+                          key=library.sort_key)
+        assert list(library.search_videos(term)) == expected, term
+        assert list(library.search_videos(term, offset=3, limit=5)) == expected[3:8], term
+
+
+def test_batched_update(app, catalog):
+    library = app.VideoLibrary(path=catalog(), use_snapshot=False)
+    videos = list(library.get_all_videos())
+    index = app.TitleIndex(videos[:400])
+    removed = random.Random(3).sample(videos[:400], 150)
+    index.update(remove=removed, add=videos[400:])
+    kept = [video for video in videos if video not in removed]
+    for term in TERMS:
+        assert set(index.search(term.lower())) == brute_force(kept, term), term